@@ -0,0 +1,333 @@
+"""Admission control and priority scheduling for upstream calls.
+
+Every route used to compete equally for the event loop and the upstream
+quotas: a burst of long uploads or GPT calls from one client slowed
+everyone down, and nothing bounded in-flight upstream calls. Three layers
+now sit in front of the work:
+
+* Per-client token buckets (`AdmissionMiddleware`). Each `/chat`,
+  `/chat/batch` or `/transcribe` request takes tokens from its client's
+  bucket; uploads cost extra per MiB. An empty bucket is answered with 429
+  and Retry-After before the body is read. Clients are keyed on the peer
+  address (uvicorn resolves X-Forwarded-For from the proxy), with
+  X-Client-Id only as a sub-key: each id gets its own bucket within the
+  address, and the address as a whole has a bucket ADMISSION_PEER_CLIENTS
+  times larger, so rotating ids can't mint fresh buckets.
+* Per-upstream concurrency limits (`PriorityLimiter`): at most N calls in
+  flight to the chat model, speech-to-text and TTS each. Extra calls wait
+  in a priority queue: voice turns (0) before text chat (1), book mode (2)
+  and background work such as phrase pre-rendering (3).
+* Load shedding: when a limiter's queue is full, or the expected wait
+  (queue depth x recent service time / limit) exceeds
+  ADMISSION_MAX_WAIT, new work gets 503 and a Retry-After instead of
+  joining a queue it would time out in. The middleware checks this too,
+  so an upload isn't spooled only to be rejected.
+
+Queue depths, waits, admissions and sheds per upstream are in
+/debug/metrics under "admission".
+
+Environment:
+    ADMISSION_ENABLED            enforce limits (default true)
+    ADMISSION_RATE               tokens per second per client (default 1)
+    ADMISSION_BURST              bucket size per client (default 10)
+    ADMISSION_PEER_CLIENTS       clients' worth of rate and burst per peer address (default 8)
+    ADMISSION_UPLOAD_MIB_COST    extra tokens per MiB uploaded (default 1)
+    ADMISSION_CHAT_CONCURRENCY   in-flight chat completions (default 16)
+    ADMISSION_STT_CONCURRENCY    in-flight transcriptions (default 8)
+    ADMISSION_TTS_CONCURRENCY    in-flight TTS syntheses (default 8)
+    ADMISSION_MAX_QUEUE          waiting calls per upstream (default 64)
+    ADMISSION_MAX_WAIT           seconds a call may wait for a slot (default 10)
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from serialization import dumps
+from latency import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND = 3
+
+class Overloaded(Exception):
+    """Raised when work is shed; carries the HTTP status and a Retry-After hint in seconds."""
+
+    def __init__(self, upstream: str, reason: str, retry_after: float, status_code: int = 503):
+        super().__init__(f"{upstream} {reason}")
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.status_code = status_code
+
+class ClientBuckets:
+    """Token bucket per client, in an LRU bounded by max_clients."""
+
+    def __init__(self, rate: float = 1.0, burst: float = 10.0, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self.allowed = 0
+        self.throttled = 0
+
+    def take(self, client: str, cost: float = 1.0) -> Optional[float]:
+        """Spend tokens; returns None when allowed, else seconds until the request would be."""
+        now = time.monotonic()
+        cost = min(cost, self.burst)
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = [self.burst, now]
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            self.allowed += 1
+            return None
+        self.throttled += 1
+        return (cost - bucket[0]) / self.rate if self.rate > 0 else 60.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "clients": len(self._buckets),
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+        }
+
+class PriorityLimiter:
+    """At most `limit` concurrent holders; waiters are granted slots by priority, then arrival."""
+
+    def __init__(self, name: str, limit: int, max_queue: int = 64, max_wait: float = 10.0):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiting = 0
+        self._waiters: list = []
+        self._sequence = itertools.count()
+        # Recent time a slot is held, for the expected-wait estimate
+        self.service_time = 0.0
+        self.wait = LatencyWindow(200)
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.timeouts = 0
+        self.waiting_by_priority: Dict[int, int] = {}
+
+    def expected_wait(self) -> float:
+        if self.in_flight < self.limit:
+            return 0.0
+        return (self.waiting + 1) * self.service_time / self.limit
+
+    def check(self):
+        """Raise Overloaded if a new call would be shed right now."""
+        if self.in_flight < self.limit:
+            return
+        expected = self.expected_wait()
+        if self.waiting >= self.max_queue:
+            raise Overloaded(self.name, "queue full", expected or self.max_wait)
+        if expected > self.max_wait:
+            raise Overloaded(self.name, "expected wait too long", expected)
+
+    async def acquire(self, priority: int = 1):
+        if self.in_flight < self.limit and not self.waiting:
+            self.in_flight += 1
+            self.admitted += 1
+            self.wait.add(0.0)
+            return
+        try:
+            self.check()
+        except Overloaded:
+            self.shed += 1
+            raise
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self.waiting += 1
+        self.queued += 1
+        self.waiting_by_priority[priority] = self.waiting_by_priority.get(priority, 0) + 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.shed += 1
+            raise Overloaded(self.name, "timed out waiting for a slot", self.expected_wait() or self.max_wait)
+        except asyncio.CancelledError:
+            # Granted just as the caller went away: hand the slot on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self.waiting -= 1
+            self.waiting_by_priority[priority] -= 1
+        self.admitted += 1
+        self.wait.add(time.monotonic() - started)
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # The slot passes straight to the waiter; in_flight is unchanged
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 1):
+        await self.acquire(priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - started
+            self.service_time = held if not self.service_time else 0.8 * self.service_time + 0.2 * held
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "waiting_by_priority": {p: n for p, n in sorted(self.waiting_by_priority.items()) if n},
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+            "timeouts": self.timeouts,
+            "service_ms": round(self.service_time * 1000, 1),
+            "expected_wait_ms": round(self.expected_wait() * 1000, 1),
+            "wait": self.wait.summary(),
+        }
+
+class AdmissionController:
+    def __init__(self, buckets: ClientBuckets, limiters: Dict[str, PriorityLimiter], upload_mib_cost: float = 1.0, enabled: bool = True,
+                 peers: Optional[ClientBuckets] = None):
+        self.buckets = buckets
+        self.peers = peers
+        self.limiters = limiters
+        self.upload_mib_cost = upload_mib_cost
+        self.enabled = enabled
+        self.rejected: Dict[int, int] = {}
+
+    @asynccontextmanager
+    async def limit(self, upstream: str, priority: int = 1):
+        """Hold a slot for one upstream call; raises Overloaded when the call is shed."""
+        limiter = self.limiters.get(upstream)
+        if not self.enabled or limiter is None:
+            yield
+            return
+        async with limiter.slot(priority):
+            yield
+
+    def admit(self, peer: str, client_id: Optional[str], upstream: Optional[str], content_length: int = 0):
+        """Request-level checks for the middleware; raises Overloaded (429 or 503)."""
+        if not self.enabled:
+            return
+        cost = 1.0 + self.upload_mib_cost * content_length / (1024 * 1024)
+        retry_after = self.peers.take(peer, cost) if self.peers and client_id else None
+        if retry_after is None:
+            retry_after = self.buckets.take(f"{peer}/{client_id}" if client_id else peer, cost)
+        if retry_after is not None:
+            raise Overloaded("client", "rate limited", retry_after, status_code=429)
+        limiter = self.limiters.get(upstream)
+        if limiter is not None:
+            try:
+                limiter.check()
+            except Overloaded:
+                limiter.shed += 1
+                raise
+
+    def record_rejection(self, e: Overloaded):
+        self.rejected[e.status_code] = self.rejected.get(e.status_code, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "rejected": self.rejected,
+            "clients": self.buckets.stats(),
+            "peers": self.peers.stats() if self.peers else None,
+            "upstreams": {name: limiter.stats() for name, limiter in self.limiters.items()},
+        }
+
+def overloaded_body(e: Overloaded) -> Dict[str, Any]:
+    error = "Too many requests" if e.status_code == 429 else "Service overloaded"
+    return {"error": error, "details": f"{e.upstream}: {e.reason}; retry after {e.retry_after}s"}
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware: rate-limit clients and shed doomed requests before their body is read."""
+
+    def __init__(self, app, paths: Optional[Dict[str, str]] = None):
+        self.app = app
+        self.paths = paths or {"/chat": "chat", "/chat/batch": "chat", "/transcribe": "stt"}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") != "POST" or scope.get("path") not in self.paths:
+            return await self.app(scope, receive, send)
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        # The header is client-controlled, so it only splits the peer's allowance
+        peer = (scope.get("client") or ("unknown",))[0]
+        client_id = headers.get("x-client-id", "").strip()[:64] or None
+        client = f"{peer}/{client_id}" if client_id else peer
+        try:
+            content_length = int(headers.get("content-length", "0"))
+        except ValueError:
+            content_length = 0
+        try:
+            admission.admit(peer, client_id, self.paths[scope["path"]], content_length)
+        except Overloaded as e:
+            admission.record_rejection(e)
+            logger.warning(f"Rejected {scope['path']} from {client}: {e} ({e.status_code})")
+            body = dumps(overloaded_body(e))
+            await send({
+                "type": "http.response.start",
+                "status": e.status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                    (b"retry-after", str(e.retry_after).encode("latin-1")),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        await self.app(scope, receive, send)
+
+def _limiter(name: str, env: str, default: int) -> PriorityLimiter:
+    return PriorityLimiter(
+        name,
+        limit=int(os.getenv(env, str(default))),
+        max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "64")),
+        max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+    )
+
+_PEER_CLIENTS = float(os.getenv("ADMISSION_PEER_CLIENTS", "8"))
+
+admission = AdmissionController(
+    ClientBuckets(
+        rate=float(os.getenv("ADMISSION_RATE", "1")),
+        burst=float(os.getenv("ADMISSION_BURST", "10"))
+    ),
+    {
+        "chat": _limiter("chat", "ADMISSION_CHAT_CONCURRENCY", 16),
+        "stt": _limiter("stt", "ADMISSION_STT_CONCURRENCY", 8),
+        "tts": _limiter("tts", "ADMISSION_TTS_CONCURRENCY", 8),
+    },
+    upload_mib_cost=float(os.getenv("ADMISSION_UPLOAD_MIB_COST", "1")),
+    enabled=os.getenv("ADMISSION_ENABLED", "true").lower() == "true",
+    peers=ClientBuckets(
+        rate=float(os.getenv("ADMISSION_RATE", "1")) * _PEER_CLIENTS,
+        burst=float(os.getenv("ADMISSION_BURST", "10")) * _PEER_CLIENTS
+    )
+)
@@ -0,0 +1,199 @@
+"""Per-client delivery formats for generated audio.
+
+TTS clips are stored as the backend produced them (128 kbps MP3 from
+ElevenLabs), which is far more than a phone on cellular needs. `/chat`
+now picks a delivery format per request and tags the audio URLs with
+`?format=`:
+
+    opus      Opus in WebM, for Chrome, Firefox and Edge
+    aac       AAC in MP4, for desktop Safari
+    aac_low   low-bitrate mono AAC, for iOS (`device: "ios"`)
+    original  the stored clip as-is
+
+The client can ask for one explicitly with `audio_format`; otherwise the
+`browser` / `device` fields nag-core.js sends decide, then the
+User-Agent. A rendition is transcoded on the first request for it, on the
+transcoder's process pool, and stored in the audio store as a variant of
+the clip, so each (clip, format) is encoded once. Concurrent requests for
+the same rendition share one job. When a rendition would not be smaller,
+or ffmpeg is unavailable or busy, the original is served. Serving a
+rendition keeps its original fresh in the store, so the janitor doesn't
+expire the clips people play most.
+
+Bytes served per format are counted by `/audio/{id}`, and the frontend
+reports time-to-play (clip URL known to first `playing` event) to
+`/audio/report`; both are in /debug/metrics.
+
+Environment:
+    AUDIO_FORMAT_NEGOTIATION   pick a format per client (default true)
+    AUDIO_OPUS_BITRATE         Opus bitrate (default 32k)
+    AUDIO_AAC_BITRATE          AAC bitrate (default 64k)
+    AUDIO_AAC_LOW_BITRATE      AAC bitrate for iOS (default 24k)
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import ffmpeg
+
+from audio_store import AudioStore, audio_store
+from latency import LatencyWindow
+from transcoder import AudioTranscoder, run_ffmpeg, transcoder
+
+logger = logging.getLogger(__name__)
+
+ORIGINAL = "original"
+
+DELIVERY_FORMATS = {
+    # format: (extension, ffmpeg output options)
+    "opus": (".webm", {"acodec": "libopus", "ac": 1, "audio_bitrate": os.getenv("AUDIO_OPUS_BITRATE", "32k"),
+                       "application": "voip", "format": "webm"}),
+    "aac": (".m4a", {"acodec": "aac", "ac": 1, "ar": 44100, "audio_bitrate": os.getenv("AUDIO_AAC_BITRATE", "64k"),
+                     "movflags": "+faststart", "format": "mp4"}),
+    "aac_low": (".m4a", {"acodec": "aac", "ac": 1, "ar": 22050, "audio_bitrate": os.getenv("AUDIO_AAC_LOW_BITRATE", "24k"),
+                         "movflags": "+faststart", "format": "mp4"}),
+}
+
+def _encode_job(data: bytes, source_extension: str, fmt: str, timeout: float) -> Dict[str, Any]:
+    """Runs in a transcoder worker process."""
+    started = time.time()
+    extension, options = DELIVERY_FORMATS[fmt]
+    with tempfile.TemporaryDirectory(prefix="audio_fmt_") as directory:
+        src = os.path.join(directory, f"source{source_extension}")
+        dst = os.path.join(directory, f"output{extension}")
+        with open(src, "wb") as f:
+            f.write(data)
+        run_ffmpeg(ffmpeg.input(src).audio.output(dst, **options), timeout)
+        with open(dst, "rb") as f:
+            output = f.read()
+    return {"started": started, "run_s": time.time() - started, "output": output}
+
+class AudioFormatter:
+    def __init__(self, store: AudioStore, transcoder: AudioTranscoder, enabled: bool = True):
+        self.store = store
+        self.transcoder = transcoder
+        self.enabled = enabled
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.formats: Dict[str, Dict[str, Any]] = {}
+
+    def _format_stats(self, fmt: str) -> Dict[str, Any]:
+        stats = self.formats.get(fmt)
+        if stats is None:
+            stats = self.formats[fmt] = {
+                "negotiated": 0, "transcodes": 0, "transcode_ms": 0.0, "not_smaller": 0, "failures": 0,
+                "variant_hits": 0, "served": 0, "bytes_served": 0, "time_to_play": LatencyWindow(200),
+            }
+        return stats
+
+    def negotiate(self, requested: Optional[str], device: Optional[str] = None, browser: Optional[str] = None,
+                  user_agent: str = "") -> str:
+        """Delivery format for a client, from its explicit choice, its browser/device fields or its User-Agent."""
+        if requested in DELIVERY_FORMATS or requested == ORIGINAL:
+            fmt = requested
+        elif not self.enabled:
+            fmt = ORIGINAL
+        else:
+            if device is None and browser is None:
+                device = "ios" if any(d in user_agent for d in ("iPhone", "iPad", "iPod")) else None
+                if "Chrome" in user_agent or "Firefox" in user_agent or "Edg/" in user_agent:
+                    browser = "chrome"
+                elif "Safari" in user_agent:
+                    browser = "safari"
+            # Every iOS browser is WebKit; AAC is its safe compact codec
+            if device == "ios":
+                fmt = "aac_low"
+            elif browser == "safari":
+                fmt = "aac"
+            elif browser in ("chrome", "firefox", "edge"):
+                fmt = "opus"
+            else:
+                fmt = ORIGINAL
+        self._format_stats(fmt)["negotiated"] += 1
+        return fmt
+
+    @staticmethod
+    def tag(url: Optional[str], fmt: str) -> Optional[str]:
+        """One audio URL in the delivery format (stored URLs stay canonical)."""
+        return f"{url}?format={fmt}" if url and fmt != ORIGINAL and "?" not in url else url
+
+    @classmethod
+    def apply(cls, audio: Optional[Dict[str, Any]], fmt: str) -> Optional[Dict[str, Any]]:
+        """Tag a reply's audio URLs with the delivery format."""
+        if not audio or fmt == ORIGINAL:
+            return audio
+        return {**audio, "audio_url": cls.tag(audio.get("audio_url"), fmt),
+                "audio_segments": [cls.tag(u, fmt) for u in audio.get("audio_segments", [])]}
+
+    async def resolve(self, oid: str, fmt: Optional[str]) -> str:
+        """The object to serve for a clip in `fmt`, transcoding it on first request."""
+        if not self.enabled or fmt not in DELIVERY_FORMATS:
+            return oid
+        stats = self._format_stats(fmt)
+        variant = await self.store.variant(oid, fmt)
+        if variant:
+            stats["variant_hits"] += 1
+            # The variant is only found through its original; keep that from looking idle
+            self.store.touch(oid)
+            return variant
+        if not self.transcoder.accepts_job():
+            return oid
+        key = (oid, fmt)
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            inflight = self._inflight[key] = asyncio.ensure_future(self._transcode(oid, fmt))
+            inflight.add_done_callback(lambda _: self._inflight.pop(key, None))
+        served = await asyncio.shield(inflight)
+        if served != oid:
+            self.store.touch(oid)
+        return served
+
+    async def _transcode(self, oid: str, fmt: str) -> str:
+        stats = self._format_stats(fmt)
+        data = await self.store.read(oid)
+        if data is None:
+            return oid
+        try:
+            result = await self.transcoder.submit(_encode_job, data, os.path.splitext(oid)[1], fmt, self.transcoder.timeout)
+        except Exception as e:
+            stats["failures"] += 1
+            logger.warning(f"Encoding {oid} as {fmt} failed, serving the original: {str(e)}")
+            return oid
+        stats["transcodes"] += 1
+        stats["transcode_ms"] += result["run_s"] * 1000
+        output = result["output"]
+        if len(output) >= len(data):
+            # Remember that the original is already the better rendition
+            stats["not_smaller"] += 1
+            return await self.store.put_variant(oid, fmt, None, "")
+        return await self.store.put_variant(oid, fmt, output, DELIVERY_FORMATS[fmt][0])
+
+    def record_served(self, fmt: Optional[str], size: int):
+        """Count a clip served in `fmt`: the format actually sent, not the one asked for."""
+        stats = self._format_stats(fmt if fmt in DELIVERY_FORMATS else ORIGINAL)
+        stats["served"] += 1
+        stats["bytes_served"] += size
+
+    def record_play(self, fmt: Optional[str], time_to_play_ms: float):
+        fmt = fmt if fmt in DELIVERY_FORMATS else ORIGINAL
+        self._format_stats(fmt)["time_to_play"].add(max(0.0, time_to_play_ms) / 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        report = {}
+        for fmt, stats in self.formats.items():
+            ttp = stats["time_to_play"]
+            report[fmt] = {
+                **{k: v for k, v in stats.items() if k not in ("time_to_play", "transcode_ms")},
+                "avg_bytes_served": round(stats["bytes_served"] / stats["served"]) if stats["served"] else None,
+                "avg_transcode_ms": round(stats["transcode_ms"] / stats["transcodes"], 1) if stats["transcodes"] else None,
+                "time_to_play": ttp.summary(),
+            }
+        return {"enabled": self.enabled, "formats": report}
+
+audio_formats = AudioFormatter(
+    audio_store,
+    transcoder,
+    enabled=os.getenv("AUDIO_FORMAT_NEGOTIATION", "true").lower() == "true"
+)
@@ -0,0 +1,285 @@
+"""Background TTS jobs, decoupled from the /chat response.
+
+With `async_audio` set, `/chat` returns the reply text right away with an
+`audio_job_id`; synthesis runs here on a bounded pool of worker tasks. The
+finished clip is pushed to the client over `/ws` (an `audio_ready` or
+`audio_failed` message) and can also be polled at `/audio/jobs/{id}`.
+
+Jobs are ordered by priority (lower runs first: a voice turn the user is
+waiting to hear beats a book-mode reply), then by arrival. When more than
+AUDIO_JOB_MAX_PENDING jobs are waiting, `submit` returns None and the
+caller synthesizes inline instead. Finished jobs are kept for
+AUDIO_JOB_RETENTION seconds so late polls still find them.
+
+With several uvicorn workers (WORKERS > 1) a job runs in the worker that
+served `/chat`, while the client's socket and its polls may land on any
+worker. Job state is therefore also written to a small SQLite file shared
+by the workers on the host (AUDIO_JOB_INDEX_PATH), and `/audio/jobs/{id}`
+answers from it when the job isn't local. Pushes (`audio_segment`,
+`audio_ready`) only reach sockets held by the job's own worker, so `/chat`
+tells the client whether to expect a push (`audio_push`); without one it
+polls right away and plays the finished clip instead of sentence by
+sentence.
+
+Environment:
+    AUDIO_JOB_WORKERS       concurrent synthesis jobs (default 4)
+    AUDIO_JOB_MAX_PENDING   jobs allowed to wait (default 64)
+    AUDIO_JOB_RETENTION     seconds a finished job stays queryable (default 600)
+    AUDIO_JOB_INDEX_PATH    job state shared by the workers (default data/audio_jobs.db)
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {"voice": 0, "chat": 1, "book": 2}
+
+class AudioJob:
+    __slots__ = ("id", "priority", "client_id", "request_id", "synthesize", "status", "audio", "error",
+                 "created_at", "started_at", "finished_at")
+
+    def __init__(self, synthesize: Callable[[], Awaitable[Optional[Dict[str, Any]]]], priority: int, client_id: Optional[str], request_id: Optional[str]):
+        self.id = uuid.uuid4().hex
+        self.priority = priority
+        self.client_id = client_id
+        self.request_id = request_id
+        self.synthesize = synthesize
+        self.status = "queued"
+        self.audio: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        audio = self.audio or {}
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "request_id": self.request_id,
+            "audio_url": audio.get("audio_url"),
+            "audio_segments": audio.get("audio_segments", []),
+            "error": self.error,
+        }
+
+class SharedJobIndex:
+    """Job state in SQLite, so any worker on the host can answer a poll."""
+
+    STAGES = {"queued": 0, "running": 1, "done": 2, "failed": 2}
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.errors = 0
+
+    def _db(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            if self._conn is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA busy_timeout=5000")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, stage INTEGER NOT NULL, state TEXT NOT NULL, "
+                    "finished_at REAL) WITHOUT ROWID"
+                )
+                self._conn = conn
+            return self._conn.execute(sql, params).fetchall()
+
+    async def save(self, job: "AudioJob"):
+        try:
+            # Saves run on threads and may land out of order; never step a job back
+            await asyncio.to_thread(
+                self._db,
+                "INSERT INTO jobs (id, stage, state, finished_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET stage = excluded.stage, state = excluded.state, "
+                "finished_at = excluded.finished_at WHERE excluded.stage >= jobs.stage",
+                (job.id, self.STAGES.get(job.status, 0), json.dumps(job.to_dict()), job.finished_at)
+            )
+        except Exception as e:
+            # Local polls and pushes still work; only other workers miss this update
+            self.errors += 1
+            logger.warning(f"Could not share audio job {job.id}: {str(e)}")
+
+    async def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        rows = await asyncio.to_thread(self._db, "SELECT state FROM jobs WHERE id = ?", (job_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def expire(self, cutoff: float):
+        await asyncio.to_thread(self._db, "DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class AudioJobQueue:
+    def __init__(self, workers: int = 4, max_pending: int = 64, retention: float = 600.0,
+                 shared: Optional[SharedJobIndex] = None):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.retention = retention
+        self.shared = shared
+        self.on_complete: Optional[Callable[[AudioJob], Awaitable[None]]] = None
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._jobs: "OrderedDict[str, AudioJob]" = OrderedDict()
+        # Finished jobs in finishing order, so a slow job never holds back the expiry of later ones
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._sequence = itertools.count()
+        self._sharing = set()
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.total_run_ms = 0.0
+        self.shared_lookups = 0
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"audio-job-{i}") for i in range(self.workers)]
+        logger.info(f"Started {self.workers} audio job workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.shared:
+            self.shared.close()
+
+    def submit(self, synthesize: Callable[[], Awaitable[Optional[Dict[str, Any]]]], priority: int = 1,
+               client_id: Optional[str] = None, request_id: Optional[str] = None) -> Optional[AudioJob]:
+        """Queue a synthesis coroutine factory; None when the queue is full (synthesize inline instead)."""
+        if not self._tasks:
+            self.start()
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            logger.warning(f"Audio job queue full ({self.pending} pending)")
+            return None
+        self._expire()
+        job = AudioJob(synthesize, priority, client_id, request_id)
+        self._jobs[job.id] = job
+        self._queue.put_nowait((priority, next(self._sequence), job))
+        self.submitted += 1
+        if self.shared:
+            self._share(job)
+        return job
+
+    def _share(self, job: AudioJob):
+        task = asyncio.create_task(self.shared.save(job))
+        self._sharing.add(task)
+        task.add_done_callback(self._sharing.discard)
+
+    def get(self, job_id: str) -> Optional[AudioJob]:
+        """A job of this worker."""
+        self._expire()
+        return self._jobs.get(job_id)
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """A job's state from this worker, else from the index shared with the other workers."""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.shared is None:
+            return None
+        self.shared_lookups += 1
+        return await self.shared.load(job_id)
+
+    def _expire(self):
+        cutoff = time.time() - self.retention
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if finished_at > cutoff:
+                break
+            self._finished.popitem(last=False)
+            self._jobs.pop(job_id, None)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            self.running += 1
+            if self.shared:
+                self._share(job)
+            try:
+                job.audio = await job.synthesize()
+                job.status = "done" if job.audio else "failed"
+                if not job.audio:
+                    job.error = "TTS generation failed"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                logger.error(f"Audio job {job.id} failed: {str(e)}")
+            finally:
+                self.running -= 1
+                job.finished_at = time.time()
+                job.synthesize = None
+                self._finished[job.id] = job.finished_at
+            if job.status == "done":
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.total_wait_ms += (job.started_at - job.created_at) * 1000
+            self.total_run_ms += (job.finished_at - job.started_at) * 1000
+            if self.shared:
+                # Written before the push, so a poll racing it already sees the result
+                await self.shared.save(job)
+                try:
+                    await self.shared.expire(time.time() - self.retention)
+                except Exception as e:
+                    logger.warning(f"Could not expire shared audio jobs: {str(e)}")
+            if self.on_complete:
+                try:
+                    await self.on_complete(job)
+                except Exception as e:
+                    logger.error(f"Audio job {job.id} notification failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "running": self.running,
+            "max_pending": self.max_pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected_queue_full": self.rejected,
+            "shared_lookups": self.shared_lookups,
+            "share_errors": self.shared.errors if self.shared else None,
+            "avg_wait_ms": round(self.total_wait_ms / finished, 1) if finished else None,
+            "avg_run_ms": round(self.total_run_ms / finished, 1) if finished else None,
+        }
+
+audio_jobs = AudioJobQueue(
+    workers=int(os.getenv("AUDIO_JOB_WORKERS", "4")),
+    max_pending=int(os.getenv("AUDIO_JOB_MAX_PENDING", "64")),
+    retention=float(os.getenv("AUDIO_JOB_RETENTION", "600")),
+    shared=SharedJobIndex(os.getenv("AUDIO_JOB_INDEX_PATH", os.path.join("data", "audio_jobs.db")))
+)
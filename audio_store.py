@@ -0,0 +1,463 @@
+"""Content-addressed storage for generated audio.
+
+`generate_tts` used to write every clip into the flat `static/audio/`
+directory under a UUID name. After weeks in production that directory
+held hundreds of thousands of files and every lookup in it got slower.
+Clips are now stored by content: the id is a hash of the bytes plus the
+extension, and the local backend shards them two levels deep by hash
+prefix (`ab/cd/abcd....mp3`). Identical clips (stock phrases, repeated
+short replies) are stored once.
+
+A small SQLite index records each object's size, creation time and last
+access, plus stable names for stock phrases and the transcoded variants of each clip
+(`audio_formats.py`). Serving (`/audio/{id}`), existence checks and
+the janitor all work from the index; nothing lists a directory. The
+janitor sizes the store from the index itself, since every worker shares
+it and the per-process counters only see that worker's own puts. Access
+times are batched in memory and written by the janitor; serving a variant
+also counts as an access of its original, which the variant mapping
+depends on. The janitor
+deletes objects not accessed for AUDIO_STORE_MAX_AGE seconds, then the
+least recently used ones while the store exceeds AUDIO_STORE_MAX_BYTES.
+Named objects are kept.
+
+AUDIO_STORE_BACKEND=s3 keeps the objects in an S3-compatible bucket
+(boto3 required; AUDIO_S3_ENDPOINT_URL points it at MinIO or at
+`mock_upstream.py`, which implements the few calls used). Clips are
+proxied through `/audio/{id}` unless AUDIO_S3_PUBLIC_URL is set, in which
+case clients are redirected there.
+
+Environment:
+    AUDIO_STORE_BACKEND      local or s3 (default local)
+    AUDIO_STORE_DIR          local object directory (default data/audio)
+    AUDIO_INDEX_PATH         index database (default data/audio_index.db)
+    AUDIO_STORE_MAX_BYTES    size budget enforced by the janitor (default 2 GiB)
+    AUDIO_STORE_MAX_AGE      seconds since last access before deletion (default 604800)
+    AUDIO_JANITOR_INTERVAL   seconds between janitor runs (default 300)
+    AUDIO_S3_BUCKET          bucket for the s3 backend
+    AUDIO_S3_PREFIX          key prefix inside the bucket (default audio/)
+    AUDIO_S3_ENDPOINT_URL    S3-compatible endpoint (default AWS)
+    AUDIO_S3_REGION          region name (default us-east-1)
+    AUDIO_S3_PUBLIC_URL      public base URL of the bucket prefix, to redirect instead of proxying
+"""
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import mimetypes
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi.responses import FileResponse, RedirectResponse, Response
+
+from file_io import read_bytes, remove_quietly, write_atomic
+
+logger = logging.getLogger(__name__)
+
+URL_PREFIX = "/audio/"
+_OBJECT_ID_RE = re.compile(r"^[0-9a-f]{32}\.[a-z0-9]{2,5}$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS objects_last_access ON objects (last_access);
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT PRIMARY KEY,
+    id TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS names_id ON names (id);
+CREATE TABLE IF NOT EXISTS variants (
+    id TEXT NOT NULL,
+    format TEXT NOT NULL,
+    variant_id TEXT NOT NULL,
+    PRIMARY KEY (id, format)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS variants_variant_id ON variants (variant_id);
+"""
+
+def object_id(data: bytes, extension: str) -> str:
+    return f"{hashlib.sha256(data).hexdigest()[:32]}{extension.lower()}"
+
+def shard_key(oid: str) -> str:
+    return f"{oid[:2]}/{oid[2:4]}/{oid}"
+
+CONTENT_TYPES = {".mp3": "audio/mpeg", ".wav": "audio/wav", ".webm": "audio/webm", ".m4a": "audio/mp4", ".ogg": "audio/ogg"}
+
+def content_type_for(oid: str) -> str:
+    return CONTENT_TYPES.get(os.path.splitext(oid)[1]) or mimetypes.guess_type(oid)[0] or "application/octet-stream"
+
+# -------------------- Backends --------------------
+class AudioBackend:
+    name = "base"
+    available = True
+
+    async def write(self, key: str, data: bytes, content_type: str):
+        raise NotImplementedError
+
+    async def read(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def response(self, key: str, content_type: str) -> Response:
+        return Response(await self.read(key), media_type=content_type)
+
+class LocalAudioBackend(AudioBackend):
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    async def write(self, key: str, data: bytes, content_type: str):
+        await write_atomic(self.path(key), data)
+
+    async def read(self, key: str) -> bytes:
+        return await read_bytes(self.path(key))
+
+    async def delete(self, key: str):
+        await remove_quietly(self.path(key))
+
+    async def response(self, key: str, content_type: str) -> Response:
+        return FileResponse(self.path(key), media_type=content_type)
+
+class S3AudioBackend(AudioBackend):
+    name = "s3"
+
+    def __init__(self, bucket: str, prefix: str = "audio/", endpoint_url: Optional[str] = None,
+                 region: str = "us-east-1", public_url: Optional[str] = None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.available = bool(bucket) and importlib.util.find_spec("boto3") is not None
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # boto3 clients are thread-safe; create one lazily for the worker threads
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+                from botocore.config import Config
+                self._client = boto3.client(
+                    "s3",
+                    endpoint_url=self.endpoint_url,
+                    region_name=self.region,
+                    config=Config(s3={"addressing_style": "path"} if self.endpoint_url else {}, retries={"max_attempts": 3})
+                )
+            return self._client
+
+    async def write(self, key: str, data: bytes, content_type: str):
+        await asyncio.to_thread(
+            self.client.put_object, Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType=content_type
+        )
+
+    async def read(self, key: str) -> bytes:
+        def _read():
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read()
+        return await asyncio.to_thread(_read)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=self.prefix + key)
+
+    async def response(self, key: str, content_type: str) -> Response:
+        if self.public_url:
+            return RedirectResponse(f"{self.public_url}/{key}", status_code=307)
+        return await super().response(key, content_type)
+
+# -------------------- Store --------------------
+class AudioStore:
+    def __init__(self, backend: AudioBackend, index_path: str, max_bytes: int = 2 << 30,
+                 max_age: float = 7 * 86400, janitor_interval: float = 300.0):
+        self.backend = backend
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.janitor_interval = janitor_interval
+        self._conn: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        # Striped by id so a put and the janitor never race on the same object
+        self._locks = [asyncio.Lock() for _ in range(64)]
+        self._touched: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.objects = 0
+        self.total_bytes = 0
+        self.puts = 0
+        self.deduplicated = 0
+        self.bytes_saved = 0
+        self.served = 0
+        self.bytes_served = 0
+        self.not_found = 0
+        self.janitor_runs = 0
+        self.expired = 0
+        self.evicted = 0
+        self.last_janitor_ms: Optional[float] = None
+
+    def open(self):
+        with self._db_lock:
+            if self._conn is not None:
+                return
+            directory = os.path.dirname(self.index_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SCHEMA)
+            self.objects, self.total_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+            self._conn = conn
+            logger.info(f"Opened audio index {self.index_path} ({self.objects} objects, {self.total_bytes} bytes, {self.backend.name} backend)")
+
+    def close(self):
+        with self._db_lock:
+            if self._conn is not None:
+                self._flush_touched()
+                self._conn.close()
+                self._conn = None
+
+    def _db(self, sql: str, params: Tuple = ()) -> List[tuple]:
+        if self._conn is None:
+            self.open()
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _lock_for(self, oid: str) -> asyncio.Lock:
+        return self._locks[int(oid[:2], 16) % len(self._locks)]
+
+    @staticmethod
+    def url(oid: str) -> str:
+        return f"{URL_PREFIX}{oid}"
+
+    @staticmethod
+    def id_from_url(url: Optional[str]) -> Optional[str]:
+        if not url or not url.startswith(URL_PREFIX):
+            return None
+        oid = url[len(URL_PREFIX):]
+        return oid if _OBJECT_ID_RE.match(oid) else None
+
+    async def put(self, data: bytes, extension: str, name: Optional[str] = None) -> str:
+        """Store a clip (once per distinct content) and return its URL; `name` pins it under a stable alias."""
+        oid = object_id(data, extension)
+        now = time.time()
+        async with self._lock_for(oid):
+            existing = await asyncio.to_thread(self._db, "SELECT size FROM objects WHERE id = ?", (oid,))
+            if existing:
+                await asyncio.to_thread(self._db, "UPDATE objects SET last_access = ? WHERE id = ?", (now, oid))
+                self.deduplicated += 1
+                self.bytes_saved += len(data)
+            else:
+                await self.backend.write(shard_key(oid), data, content_type_for(oid))
+                await asyncio.to_thread(
+                    self._db,
+                    "INSERT INTO objects (id, size, created_at, last_access) VALUES (?, ?, ?, ?)",
+                    (oid, len(data), now, now)
+                )
+                self.objects += 1
+                self.total_bytes += len(data)
+            if name:
+                await asyncio.to_thread(self._db, "INSERT OR REPLACE INTO names (name, id) VALUES (?, ?)", (name, oid))
+        self.puts += 1
+        return self.url(oid)
+
+    async def named(self, name: str) -> Optional[str]:
+        """URL of the object stored under a stable name, if it's still there."""
+        rows = await asyncio.to_thread(
+            self._db, "SELECT n.id FROM names n JOIN objects o ON o.id = n.id WHERE n.name = ?", (name,)
+        )
+        return self.url(rows[0][0]) if rows else None
+
+    async def read(self, oid: str) -> Optional[bytes]:
+        if not _OBJECT_ID_RE.match(oid) or not await asyncio.to_thread(self._db, "SELECT 1 FROM objects WHERE id = ?", (oid,)):
+            return None
+        return await self.backend.read(shard_key(oid))
+
+    async def variant(self, oid: str, fmt: str) -> Optional[str]:
+        """Id of the stored `fmt` rendition of an object, if there is one."""
+        rows = await asyncio.to_thread(
+            self._db,
+            "SELECT v.variant_id FROM variants v JOIN objects o ON o.id = v.variant_id WHERE v.id = ? AND v.format = ?",
+            (oid, fmt)
+        )
+        return rows[0][0] if rows else None
+
+    async def put_variant(self, oid: str, fmt: str, data: Optional[bytes], extension: str) -> str:
+        """Record the `fmt` rendition of an object; with data None the object serves as its own rendition."""
+        variant_id = oid
+        if data is not None:
+            await self.put(data, extension)
+            variant_id = object_id(data, extension)
+        await asyncio.to_thread(
+            self._db, "INSERT OR REPLACE INTO variants (id, format, variant_id) VALUES (?, ?, ?)", (oid, fmt, variant_id)
+        )
+        return variant_id
+
+    async def exists(self, url: Optional[str]) -> bool:
+        oid = self.id_from_url(url)
+        if oid is None:
+            return False
+        return bool(await asyncio.to_thread(self._db, "SELECT 1 FROM objects WHERE id = ?", (oid,)))
+
+    async def response(self, oid: str) -> Optional[Tuple[Response, int]]:
+        """Serve an object through the backend; returns (response, size), or None when the index doesn't know it."""
+        rows = await asyncio.to_thread(self._db, "SELECT size FROM objects WHERE id = ?", (oid,)) if _OBJECT_ID_RE.match(oid) else []
+        if not rows:
+            self.not_found += 1
+            return None
+        self._touched[oid] = time.time()
+        self.served += 1
+        self.bytes_served += rows[0][0]
+        response = await self.backend.response(shard_key(oid), content_type_for(oid))
+        # Ids are content hashes, so a URL never changes meaning
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response, rows[0][0]
+
+    def touch(self, oid: str):
+        """Count an access without serving the object (the original behind a served variant)."""
+        self._touched[oid] = time.time()
+
+    def _flush_touched(self):
+        """Write batched access times (caller holds the index lock or runs single-threaded)."""
+        if not self._touched or self._conn is None:
+            return
+        touched, self._touched = self._touched, {}
+        self._conn.executemany(
+            "UPDATE objects SET last_access = MAX(last_access, ?) WHERE id = ?",
+            [(at, oid) for oid, at in touched.items()]
+        )
+
+    async def sweep(self) -> Dict[str, int]:
+        """Janitor pass: expire stale objects, then evict LRU objects while over budget."""
+        started = time.perf_counter()
+
+        def _plan() -> Tuple[List[tuple], List[tuple]]:
+            if self._conn is None:
+                self.open()
+            with self._db_lock:
+                self._flush_touched()
+                # Other workers write to the same index; resync the counters from it
+                self.objects, self.total_bytes = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects"
+                ).fetchone()
+                unnamed = "id NOT IN (SELECT id FROM names)"
+                stale = self._conn.execute(
+                    f"SELECT id, size, last_access FROM objects WHERE last_access < ? AND {unnamed}",
+                    (time.time() - self.max_age,)
+                ).fetchall() if self.max_age else []
+                over = self.total_bytes - sum(size for _, size, _ in stale) - self.max_bytes
+                lru = []
+                if self.max_bytes and over > 0:
+                    stale_ids = {oid for oid, _, _ in stale}
+                    for oid, size, last_access in self._conn.execute(f"SELECT id, size, last_access FROM objects WHERE {unnamed} ORDER BY last_access"):
+                        if over <= 0:
+                            break
+                        if oid not in stale_ids:
+                            lru.append((oid, size, last_access))
+                            over -= size
+                return stale, lru
+
+        stale, lru = await asyncio.to_thread(_plan)
+        expired = await self._delete(stale)
+        evicted = await self._delete(lru)
+        self.expired += expired
+        self.evicted += evicted
+        self.janitor_runs += 1
+        self.last_janitor_ms = round((time.perf_counter() - started) * 1000, 1)
+        if expired or evicted:
+            logger.info(f"Audio janitor removed {expired} expired and {evicted} evicted objects in {self.last_janitor_ms}ms")
+        return {"expired": expired, "evicted": evicted}
+
+    async def _delete(self, victims: List[tuple]) -> int:
+        deleted = 0
+        for oid, size, last_access in victims:
+            async with self._lock_for(oid):
+                # Skip objects a put touched since the plan was made
+                rows = await asyncio.to_thread(
+                    self._db, "DELETE FROM objects WHERE id = ? AND last_access <= ? RETURNING id", (oid, last_access)
+                )
+                if not rows:
+                    continue
+                await asyncio.to_thread(self._db, "DELETE FROM variants WHERE id = ? OR variant_id = ?", (oid, oid))
+                try:
+                    await self.backend.delete(shard_key(oid))
+                except Exception as e:
+                    logger.error(f"Error deleting audio object {oid}: {str(e)}")
+                self.objects -= 1
+                self.total_bytes -= size
+                deleted += 1
+        return deleted
+
+    def start(self):
+        if self._task is None and self.janitor_interval > 0:
+            self._task = asyncio.create_task(self._run(), name="audio-janitor")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.janitor_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Audio janitor failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "objects": self.objects,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "puts": self.puts,
+            "deduplicated": self.deduplicated,
+            "bytes_saved": self.bytes_saved,
+            "served": self.served,
+            "bytes_served": self.bytes_served,
+            "not_found": self.not_found,
+            "pending_access_updates": len(self._touched),
+            "janitor_runs": self.janitor_runs,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "last_janitor_ms": self.last_janitor_ms,
+        }
+
+def configure_audio_store() -> AudioStore:
+    backend: AudioBackend = LocalAudioBackend(os.getenv("AUDIO_STORE_DIR", os.path.join("data", "audio")))
+    if os.getenv("AUDIO_STORE_BACKEND", "local").lower() == "s3":
+        s3 = S3AudioBackend(
+            bucket=os.getenv("AUDIO_S3_BUCKET", ""),
+            prefix=os.getenv("AUDIO_S3_PREFIX", "audio/"),
+            endpoint_url=os.getenv("AUDIO_S3_ENDPOINT_URL") or None,
+            region=os.getenv("AUDIO_S3_REGION", "us-east-1"),
+            public_url=os.getenv("AUDIO_S3_PUBLIC_URL") or None
+        )
+        if s3.available:
+            backend = s3
+        else:
+            logger.warning("S3 audio storage needs boto3 and AUDIO_S3_BUCKET; using local storage")
+    return AudioStore(
+        backend,
+        index_path=os.getenv("AUDIO_INDEX_PATH", os.path.join("data", "audio_index.db")),
+        max_bytes=int(os.getenv("AUDIO_STORE_MAX_BYTES", str(2 << 30))),
+        max_age=float(os.getenv("AUDIO_STORE_MAX_AGE", str(7 * 86400))),
+        janitor_interval=float(os.getenv("AUDIO_JANITOR_INTERVAL", "300"))
+    )
+
+audio_store = configure_audio_store()
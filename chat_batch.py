@@ -0,0 +1,306 @@
+"""Batch chat: many messages in one request, for bulk and offline generation.
+
+`POST /chat/batch` takes
+
+    {"job_id": "reading-prompts", "concurrency": 4,
+     "items": [{"id": "q1", "message": "...", "mode": "book"}, ...]}
+
+and streams NDJSON back: a "job" line, one "result" line per item as it
+completes (completion order, not input order) and a closing "summary" line.
+Items are ordinary /chat bodies and run through the same chat turn (prompt,
+GPT, TTS), `concurrency` at a time, except that they are not captured as
+memories (a batch would rewrite the twin's prompt under its own later
+items) and use the semantic cache only with `"semantic_cache": true`. They run
+at background priority, so the admission limiters serve interactive turns
+first and a batch soaks up whatever upstream quota is left; an item that is
+shed waits out its Retry-After and is retried up to BATCH_MAX_RETRIES times.
+
+Jobs are checkpointed under BATCH_DIR/<job_id>/: job.json keeps the items
+and their hash, and results.ndjson gets a line as each item finishes.
+Posting the same job_id again, with the same items or none, replays the
+finished results and runs only the rest (failed items are retried); with
+different items it is refused with 409, since the old results would be
+replayed as answers to the new items. Without a job_id one is
+generated; it is in the first line and the X-Batch-Job-Id header.
+`local_client.py batch` is the command-line runner.
+
+Environment:
+    BATCH_DIR               checkpoint directory (default data/batches)
+    BATCH_CONCURRENCY       items in flight per job by default (default 4)
+    BATCH_MAX_CONCURRENCY   most items in flight a job may ask for (default 16)
+    BATCH_MAX_ITEMS         items per job (default 1000)
+    BATCH_MAX_RETRIES       retries of an item that was shed (default 3)
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from admission import Overloaded
+from serialization import dumps
+from latency import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+_JOB_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+class BatchError(ValueError):
+    """An invalid batch request (400)."""
+
+class BatchConflict(Exception):
+    """The job is already running in this worker (409)."""
+
+class BatchMismatch(BatchConflict):
+    """The job exists with other items (409)."""
+
+def items_hash(items: List[Dict[str, Any]]) -> str:
+    return hashlib.sha256(json.dumps(items, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+class BatchJob:
+    def __init__(self, job_id: str, directory: str, items: List[Dict[str, Any]], concurrency: int,
+                 semantic_cache: bool = False):
+        self.id = job_id
+        self.directory = directory
+        self.items = items
+        self.concurrency = concurrency
+        self.semantic_cache = semantic_cache
+        # Finished items from earlier runs, by id
+        self.done: Dict[str, Dict[str, Any]] = {}
+        self._results = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def results_path(self) -> str:
+        return os.path.join(self.directory, "results.ndjson")
+
+    def load(self):
+        """Blocking: read the checkpoint and open it for appending."""
+        if os.path.exists(self.results_path):
+            with open(self.results_path, "r") as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash; the item just runs again
+                        continue
+                    if result.get("status") == "ok":
+                        self.done[result.get("id")] = result
+                    else:
+                        self.done.pop(result.get("id"), None)
+        self._results = open(self.results_path, "ab")
+
+    def _append(self, line: bytes):
+        self._results.write(line)
+        self._results.flush()
+
+    async def checkpoint(self, line: bytes):
+        async with self._lock:
+            await asyncio.to_thread(self._append, line)
+
+    def close(self):
+        if self._results is not None:
+            self._results.close()
+            self._results = None
+
+class BatchRunner:
+    def __init__(self, base_dir: str = os.path.join("data", "batches"), concurrency: int = 4, max_concurrency: int = 16,
+                 max_items: int = 1000, max_retries: int = 3):
+        self.base_dir = base_dir
+        self.concurrency = concurrency
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_items = max_items
+        self.max_retries = max_retries
+        self.running: Dict[str, Optional[BatchJob]] = {}
+        self.latency = LatencyWindow(500)
+        self.jobs_started = 0
+        self.jobs_resumed = 0
+        self.jobs_completed = 0
+        self.items_ok = 0
+        self.items_failed = 0
+        self.items_replayed = 0
+        self.retries = 0
+
+    def _open(self, job_id: str, items: Optional[List[Any]], concurrency: int, semantic_cache: Optional[bool]) -> BatchJob:
+        """Blocking: create the job directory or pick up an existing checkpoint."""
+        directory = os.path.join(self.base_dir, job_id)
+        job_file = os.path.join(directory, "job.json")
+        saved = None
+        if os.path.isfile(job_file):
+            with open(job_file, "r") as f:
+                saved = json.load(f)
+        if items is None:
+            if saved is None:
+                raise BatchError(f"No items given and no checkpoint for job {job_id}")
+            items = saved["items"]
+        elif saved is not None and (saved.get("items_hash") or items_hash(saved["items"])) != items_hash(items):
+            raise BatchMismatch(f"Job {job_id} already exists with other items; use a new job_id")
+        if semantic_cache is None:
+            semantic_cache = bool(saved and saved.get("semantic_cache"))
+        if saved is None or saved.get("semantic_cache", False) != semantic_cache:
+            os.makedirs(directory, exist_ok=True)
+            temp_path = f"{job_file}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(dumps({
+                    "job_id": job_id, "created_at": saved["created_at"] if saved else time.time(),
+                    "items_hash": items_hash(items), "semantic_cache": semantic_cache, "items": items,
+                }))
+            os.replace(temp_path, job_file)
+        job = BatchJob(job_id, directory, items, concurrency, semantic_cache)
+        job.load()
+        return job
+
+    async def prepare(self, body: Dict[str, Any], validate: Callable[[Dict[str, Any]], Any]) -> BatchJob:
+        """Validate a batch request and open its job; raises BatchError, BatchConflict or BatchMismatch."""
+        job_id = body.get("job_id") or uuid.uuid4().hex
+        if not isinstance(job_id, str) or not _JOB_ID_RE.match(job_id):
+            raise BatchError("job_id must be 1-64 letters, digits, '-' or '_'")
+        if job_id in self.running:
+            raise BatchConflict(f"Job {job_id} is already running")
+        items = body.get("items")
+        if items is not None:
+            if not isinstance(items, list) or not items:
+                raise BatchError("items must be a non-empty list")
+            if len(items) > self.max_items:
+                raise BatchError(f"At most {self.max_items} items per batch")
+            items = [self._normalize(item, i, validate) for i, item in enumerate(items)]
+            ids = [item["id"] for item in items]
+            if len(set(ids)) != len(ids):
+                raise BatchError("Item ids must be unique")
+        try:
+            concurrency = int(body.get("concurrency") or self.concurrency)
+        except (TypeError, ValueError):
+            raise BatchError("concurrency must be an integer")
+        concurrency = min(max(1, concurrency), self.max_concurrency)
+        semantic_cache = body.get("semantic_cache")
+        if semantic_cache is not None and not isinstance(semantic_cache, bool):
+            raise BatchError("semantic_cache must be true or false")
+        # Reserved before the await so a second request for the job is refused
+        self.running[job_id] = None
+        try:
+            job = await asyncio.to_thread(self._open, job_id, items, concurrency, semantic_cache)
+        except BaseException:
+            del self.running[job_id]
+            raise
+        self.running[job_id] = job
+        return job
+
+    @staticmethod
+    def _normalize(item: Any, index: int, validate: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:
+        if isinstance(item, str):
+            item = {"message": item}
+        if not isinstance(item, dict):
+            raise BatchError(f"Item {index}: expected an object or a string")
+        try:
+            validate(item)
+        except ValueError as e:
+            raise BatchError(f"Item {index}: {str(e)}")
+        return {**item, "id": str(item.get("id", index))}
+
+    async def _run_item(self, job: BatchJob, index: int, item: Dict[str, Any],
+                        turn: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        result = {"type": "result", "id": item["id"], "index": index}
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result.update(status="ok", reply=await turn(item))
+                self.items_ok += 1
+                break
+            except Overloaded as e:
+                if attempt > self.max_retries:
+                    result.update(status="error", error=f"{e.upstream}: {e.reason}")
+                    self.items_failed += 1
+                    break
+                self.retries += 1
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Batch {job.id} item {item['id']} failed: {str(e)}")
+                result.update(status="error", error=str(e))
+                self.items_failed += 1
+                break
+        elapsed = time.perf_counter() - started
+        self.latency.add(elapsed)
+        result.update(attempts=attempt, elapsed_ms=round(elapsed * 1000, 1))
+        return result
+
+    async def run(self, job: BatchJob, turn: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+        """Run a job's unfinished items, yielding NDJSON lines as they complete."""
+        started = time.perf_counter()
+        pending = [(i, item) for i, item in enumerate(job.items) if item["id"] not in job.done]
+        finished = [job.done[item["id"]] for item in job.items if item["id"] in job.done]
+        self.jobs_started += 1
+        if finished:
+            self.jobs_resumed += 1
+        queue: asyncio.Queue = asyncio.Queue()
+        work = iter(pending)
+        counts = {"ok": len(finished), "error": 0}
+
+        async def worker():
+            # Workers share one iterator, so each item is taken once
+            for index, item in work:
+                result = await self._run_item(job, index, item, turn)
+                line = dumps(result) + b"\n"
+                try:
+                    await job.checkpoint(line)
+                except Exception as e:
+                    logger.error(f"Could not checkpoint batch {job.id}: {str(e)}")
+                await queue.put((result["status"], line))
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(job.concurrency, len(pending)))]
+        try:
+            yield dumps({
+                "type": "job", "job_id": job.id, "total": len(job.items),
+                "pending": len(pending), "concurrency": job.concurrency, "semantic_cache": job.semantic_cache,
+            }) + b"\n"
+            for result in finished:
+                self.items_replayed += 1
+                yield dumps({**result, "replayed": True}) + b"\n"
+            for _ in pending:
+                status, line = await queue.get()
+                counts[status] += 1
+                yield line
+            self.jobs_completed += 1
+            yield dumps({
+                "type": "summary", "job_id": job.id, "total": len(job.items),
+                "ok": counts["ok"], "failed": counts["error"], "replayed": len(finished),
+                "elapsed_s": round(time.perf_counter() - started, 2),
+            }) + b"\n"
+        finally:
+            # Client gone or job finished: stop the workers; finished items are checkpointed
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.release(job)
+
+    def release(self, job: BatchJob):
+        """Close a prepared job; also run after the response in case streaming never started."""
+        job.close()
+        if self.running.get(job.id) is job:
+            del self.running[job.id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": {job_id: len(job.items) if job else None for job_id, job in self.running.items()},
+            "jobs_started": self.jobs_started,
+            "jobs_resumed": self.jobs_resumed,
+            "jobs_completed": self.jobs_completed,
+            "items_ok": self.items_ok,
+            "items_failed": self.items_failed,
+            "items_replayed": self.items_replayed,
+            "retries": self.retries,
+            "item_latency": self.latency.summary(),
+        }
+
+batch_runner = BatchRunner(
+    base_dir=os.getenv("BATCH_DIR", os.path.join("data", "batches")),
+    concurrency=int(os.getenv("BATCH_CONCURRENCY", "4")),
+    max_concurrency=int(os.getenv("BATCH_MAX_CONCURRENCY", "16")),
+    max_items=int(os.getenv("BATCH_MAX_ITEMS", "1000")),
+    max_retries=int(os.getenv("BATCH_MAX_RETRIES", "3"))
+)
@@ -0,0 +1,208 @@
+"""Event-loop stall detection and an on-demand sampling profiler.
+
+`LoopMonitor` runs a heartbeat coroutine on the event loop and a watchdog
+thread beside it. The coroutine measures how late each wake-up is (loop
+lag). When the heartbeat goes quiet for longer than the stall threshold,
+the watchdog grabs the loop thread's Python stack from another thread, so
+the report shows the code that is blocking the loop, not the victim.
+
+`SamplingProfiler` samples thread stacks for a fixed window from a
+background thread and returns them in the collapsed "frame;frame;frame
+count" format read by flamegraph.pl, speedscope and inferno.
+
+Both only ever read interpreter state from a side thread, so they are
+safe to leave on in production. Their routes, like every /debug route,
+expose stacks and internals, so they answer only requests carrying
+DEBUG_TOKEN (X-Debug-Token header or a bearer token) and are off (404)
+when it is unset.
+
+Environment:
+    DEBUG_TOKEN             secret required by the /debug routes (default unset: routes disabled)
+    LOOP_MONITOR_ENABLED    start the monitor on app startup (default true)
+    LOOP_MONITOR_INTERVAL   heartbeat interval in seconds (default 0.1)
+    LOOP_STALL_THRESHOLD    seconds without a heartbeat that count as a stall (default 0.25)
+    PROFILE_MAX_SECONDS     longest profiling window allowed (default 60)
+"""
+import asyncio
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+def _format_frame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+def _collapse_stack(frame) -> List[str]:
+    names = []
+    while frame is not None:
+        names.append(_format_frame(frame))
+        frame = frame.f_back
+    return names[::-1]
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.1, stall_threshold: float = 0.25, history: int = 50):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.last_heartbeat = time.monotonic()
+        self.lags = deque(maxlen=600)
+        self.stalls = deque(maxlen=history)
+        self.stall_count = 0
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._in_stall = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-monitor")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"Event loop monitor started (interval={self.interval}s, stall threshold={self.stall_threshold}s)")
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.last_heartbeat = now
+            if self._in_stall:
+                self._in_stall = False
+                if self.stalls:
+                    self.stalls[-1]["duration_ms"] = round(lag * 1000 + self.interval * 1000, 1)
+
+    def _watch(self):
+        check_every = min(self.interval, self.stall_threshold / 2)
+        while not self._stop.wait(check_every):
+            silent_for = time.monotonic() - self.last_heartbeat - self.interval
+            if silent_for > self.stall_threshold and not self._in_stall:
+                self._in_stall = True
+                self._capture_stall(silent_for)
+
+    def _capture_stall(self, silent_for: float):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        task = asyncio.current_task(self.loop) if self.loop else None
+        event = {
+            "timestamp": time.time(),
+            "blocked_for_ms": round(silent_for * 1000, 1),
+            "duration_ms": None,
+            "task": task.get_name() if task else None,
+            "coroutine": getattr(task.get_coro(), "__qualname__", None) if task else None,
+            "stack": traceback.format_stack(frame)[-15:],
+        }
+        self.stall_count += 1
+        self.stalls.append(event)
+        logger.warning(
+            f"Event loop blocked for >{event['blocked_for_ms']}ms in task {event['task']} "
+            f"at {_format_frame(frame)}"
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        lags = sorted(self.lags)
+
+        def pct(p):
+            return round(lags[min(len(lags) - 1, int(p / 100 * len(lags)))] * 1000, 2) if lags else None
+
+        return {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "stall_threshold_ms": self.stall_threshold * 1000,
+            "lag_p50_ms": pct(50),
+            "lag_p99_ms": pct(99),
+            "lag_max_ms": round(self.max_lag * 1000, 2),
+            "stall_count": self.stall_count,
+        }
+
+    def recent_stalls(self, limit: int = 10) -> List[Dict[str, Any]]:
+        return list(self.stalls)[-limit:][::-1]
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+class SamplingProfiler:
+    """Wall-clock stack sampler that runs in its own thread."""
+
+    def __init__(self, max_seconds: float = 60.0):
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, seconds: float, interval: float = 0.005, thread_id: Optional[int] = None) -> Dict[str, Any]:
+        """Blocking; call from a worker thread. Samples one thread, or all threads when thread_id is None."""
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+        try:
+            seconds = min(seconds, self.max_seconds)
+            own_id = threading.get_ident()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            counts: Counter = Counter()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_id or (thread_id is not None and ident != thread_id):
+                        continue
+                    stack = [names.get(ident, str(ident))] + _collapse_stack(frame)
+                    counts[";".join(stack)] += 1
+                samples += 1
+                time.sleep(interval)
+            return {"seconds": seconds, "samples": samples, "counts": counts}
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def to_collapsed(counts: Counter) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in counts.most_common()) + "\n"
+
+loop_monitor = LoopMonitor(
+    interval=float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1")),
+    stall_threshold=float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+)
+profiler = SamplingProfiler(max_seconds=float(os.getenv("PROFILE_MAX_SECONDS", "60")))
+
+def debug_access(token: Optional[str]) -> Optional[bool]:
+    """None when the debug routes are disabled, else whether the token matches DEBUG_TOKEN."""
+    expected = os.getenv("DEBUG_TOKEN", "")
+    if not expected:
+        return None
+    return hmac.compare_digest((token or "").encode("utf-8"), expected.encode("utf-8"))
+
+def monitor_enabled() -> bool:
+    return os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
@@ -0,0 +1,99 @@
+"""Non-blocking disk helpers for the request path.
+
+Every helper runs the actual I/O in aiofiles' thread pool and holds a
+shared semaphore, so a slow disk cannot tie up the event loop or swamp the
+default executor. Writes are atomic: data goes to a temp file in the same
+directory and is renamed into place, so readers never see a partial file.
+
+Environment:
+    FILE_IO_CONCURRENCY   concurrent disk operations allowed (default 8)
+    UPLOAD_CHUNK_SIZE     bytes read per chunk when spooling uploads (default 1 MiB)
+"""
+import asyncio
+import os
+import uuid
+import logging
+from typing import Optional
+
+import aiofiles
+import aiofiles.os
+
+logger = logging.getLogger(__name__)
+
+FILE_IO_CONCURRENCY = int(os.getenv("FILE_IO_CONCURRENCY", "8"))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+_io_semaphore = asyncio.Semaphore(FILE_IO_CONCURRENCY)
+
+class UploadTooLarge(Exception):
+    pass
+
+def _temp_path_for(path: str) -> str:
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{uuid.uuid4().hex[:8]}.tmp")
+
+async def write_atomic(path: str, data: bytes):
+    """Write bytes to path via temp file + rename."""
+    temp_path = _temp_path_for(path)
+    async with _io_semaphore:
+        try:
+            try:
+                f = await aiofiles.open(temp_path, "wb")
+            except FileNotFoundError:
+                await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = await aiofiles.open(temp_path, "wb")
+            try:
+                await f.write(data)
+            finally:
+                await f.close()
+            await aiofiles.os.replace(temp_path, path)
+        except BaseException:
+            await _remove(temp_path)
+            raise
+
+async def spool_upload(upload, path: str, max_bytes: Optional[int] = None, chunk_size: int = UPLOAD_CHUNK_SIZE) -> int:
+    """Stream an UploadFile to disk in chunks; returns the number of bytes written."""
+    temp_path = _temp_path_for(path)
+    size = 0
+    async with _io_semaphore:
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                while True:
+                    chunk = await upload.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise UploadTooLarge(f"Upload exceeds {max_bytes} bytes")
+                    await f.write(chunk)
+            await aiofiles.os.replace(temp_path, path)
+        except BaseException:
+            await _remove(temp_path)
+            raise
+    return size
+
+async def read_bytes(path: str) -> bytes:
+    async with _io_semaphore:
+        async with aiofiles.open(path, "rb") as f:
+            return await f.read()
+
+async def _remove(path: str) -> bool:
+    try:
+        await aiofiles.os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+async def remove_quietly(path: Optional[str]) -> bool:
+    """Delete a file if it exists; never raises. Returns True if a file was removed."""
+    if not path:
+        return False
+    try:
+        async with _io_semaphore:
+            return await _remove(path)
+    except Exception as e:
+        logger.error(f"Error removing file {path}: {str(e)}")
+        return False
+
+async def is_file(path: str) -> bool:
+    return await aiofiles.os.path.isfile(path)
@@ -0,0 +1,276 @@
+"""Resource governor: degrade in steps under memory pressure instead of getting OOM-killed.
+
+Under heavy load a worker's RSS climbed until the container was killed.
+`ResourceGovernor` samples the worker's RSS, open file descriptors and the
+bytes currently held by requests (upload bodies and TTS clips, registered
+with `hold()`). Each is compared with its limit, and the largest ratio is
+the pressure. The worker then degrades in steps:
+
+    normal          everything on
+    text_only       /chat skips TTS and returns the reply with audio_url None
+    reject_uploads  also /transcribe is answered 503
+    shed            all chat and /transcribe requests get 503, /ready reports
+                    not ready so the load balancer drains the worker
+
+A level is entered when pressure reaches its threshold and left only once
+pressure falls GOVERNOR_HYSTERESIS below it, so the worker doesn't flap.
+Recovery is automatic. Every transition is logged and counted, with time
+spent per level, in /debug/metrics under "governor".
+
+The memory limit defaults to the container's cgroup limit (else physical
+memory) divided by WORKERS; the fd limit is the soft RLIMIT_NOFILE. RSS
+comes from /proc; where that's missing (macOS) only the peak RSS is known,
+so memory is shown in stats but left out of the pressure.
+
+Environment:
+    GOVERNOR_ENABLED          degrade under pressure (default true)
+    GOVERNOR_INTERVAL         seconds between samples (default 1)
+    GOVERNOR_MEMORY_LIMIT     RSS limit per worker in bytes (default: see above)
+    GOVERNOR_INFLIGHT_LIMIT   bytes held by requests (default 256 MiB)
+    GOVERNOR_THRESHOLDS       pressure entering text_only,reject_uploads,shed (default 0.75,0.85,0.95)
+    GOVERNOR_HYSTERESIS       pressure drop needed to step back down (default 0.1)
+    GOVERNOR_RETRY_AFTER      Retry-After seconds on rejected requests (default 5)
+"""
+import asyncio
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from admission import Overloaded, admission, overloaded_body
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+NORMAL, TEXT_ONLY, REJECT_UPLOADS, SHED = 0, 1, 2, 3
+LEVELS = ["normal", "text_only", "reject_uploads", "shed"]
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def read_rss() -> Optional[int]:
+    """Current RSS in bytes, or None where only the peak is available (no /proc)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+def read_peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def count_fds() -> int:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+def default_memory_limit() -> int:
+    """Container memory limit (cgroup v2, then v1, else physical memory) shared by the workers."""
+    limit = 0
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path, "r") as f:
+                value = f.read().strip()
+            if value.isdigit():
+                limit = int(value)
+                break
+        except OSError:
+            continue
+    try:
+        physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        physical = 0
+    # cgroup v1 reports a huge number when unlimited
+    if not limit or (physical and limit > physical):
+        limit = physical
+    return limit // max(1, int(os.getenv("WORKERS", "1")))
+
+class ResourceGovernor:
+    def __init__(self, memory_limit: int, fd_limit: int, inflight_limit: int, thresholds: List[float],
+                 hysteresis: float = 0.1, interval: float = 1.0, retry_after: float = 5.0, enabled: bool = True):
+        self.memory_limit = memory_limit
+        self.fd_limit = fd_limit
+        self.inflight_limit = inflight_limit
+        self.thresholds = thresholds
+        self.hysteresis = hysteresis
+        self.interval = interval
+        self.retry_after = retry_after
+        self.enabled = enabled
+        self.level = NORMAL
+        self.inflight_bytes = 0
+        self.peak_inflight_bytes = 0
+        self.rss = 0
+        self.rss_is_peak = False
+        self.fds = 0
+        self.pressure = 0.0
+        self.cause: Optional[str] = None
+        self.level_since = time.monotonic()
+        self.time_in_level = [0.0] * len(LEVELS)
+        self.transitions: Dict[str, int] = {}
+        self.last_transition: Optional[Dict[str, Any]] = None
+        self.degraded: Dict[str, int] = {"tts_skipped": 0, "uploads_rejected": 0, "requests_shed": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    @contextmanager
+    def hold(self, nbytes: int):
+        """Count bytes a request keeps in memory while the block runs."""
+        self.inflight_bytes += nbytes
+        self.peak_inflight_bytes = max(self.peak_inflight_bytes, self.inflight_bytes)
+        try:
+            yield
+        finally:
+            self.inflight_bytes -= nbytes
+
+    @property
+    def text_only(self) -> bool:
+        return self.level >= TEXT_ONLY
+
+    def sample(self) -> int:
+        """Measure, update the level and return it."""
+        rss = read_rss()
+        if rss is None and not self.rss_is_peak:
+            logger.warning("Current RSS unavailable on this platform; the governor ignores memory, "
+                           "watching only fds and in-flight bytes")
+        self.rss_is_peak = rss is None
+        # A peak never comes back down, so it would pin the worker in a degraded level
+        self.rss = read_peak_rss() if rss is None else rss
+        self.fds = count_fds()
+        ratios = {
+            "memory": self.rss / self.memory_limit if self.memory_limit and rss is not None else 0.0,
+            "fds": self.fds / self.fd_limit if self.fd_limit else 0.0,
+            "inflight_bytes": self.inflight_bytes / self.inflight_limit if self.inflight_limit else 0.0,
+        }
+        self.cause, self.pressure = max(ratios.items(), key=lambda item: item[1])
+        if self.enabled:
+            self._set_level(self._target_level())
+        return self.level
+
+    def _target_level(self) -> int:
+        level = self.level
+        # Step up to the highest threshold reached
+        while level < SHED and self.pressure >= self.thresholds[level]:
+            level += 1
+        # Step down only once pressure is clearly below the current level's threshold
+        while level > NORMAL and self.pressure < self.thresholds[level - 1] - self.hysteresis:
+            level -= 1
+        return level
+
+    def _set_level(self, level: int):
+        if level == self.level:
+            return
+        now = time.monotonic()
+        self.time_in_level[self.level] += now - self.level_since
+        key = f"{LEVELS[self.level]}->{LEVELS[level]}"
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        self.last_transition = {"transition": key, "at": time.time(), "pressure": round(self.pressure, 3), "cause": self.cause}
+        log = logger.warning if level > self.level else logger.info
+        log(f"Resource governor {key} (pressure {self.pressure:.2f} from {self.cause}, rss {self.rss >> 20} MiB, "
+            f"fds {self.fds}, in-flight {self.inflight_bytes >> 10} KiB)")
+        self.level = level
+        self.level_since = now
+
+    def start(self):
+        if self._task is None and self.enabled:
+            self._task = asyncio.create_task(self._run(), name="resource-governor")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                logger.error(f"Resource governor sample failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def rejection(self, path: str) -> Optional[Overloaded]:
+        """Overloaded to answer a request with at the current level, or None to let it through."""
+        if self.level >= SHED:
+            self.degraded["requests_shed"] += 1
+            return Overloaded("worker", "shedding load under resource pressure", self.retry_after)
+        if self.level >= REJECT_UPLOADS and path == "/transcribe":
+            self.degraded["uploads_rejected"] += 1
+            return Overloaded("worker", "not accepting uploads under resource pressure", self.retry_after)
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        time_in_level = list(self.time_in_level)
+        time_in_level[self.level] += time.monotonic() - self.level_since
+        return {
+            "enabled": self.enabled,
+            "level": LEVELS[self.level],
+            "pressure": round(self.pressure, 3),
+            "cause": self.cause,
+            "rss_mb": round(self.rss / (1 << 20), 1),
+            "rss_is_peak": self.rss_is_peak,
+            "memory_limit_mb": round(self.memory_limit / (1 << 20), 1),
+            "fds": self.fds,
+            "fd_limit": self.fd_limit,
+            "inflight_bytes": self.inflight_bytes,
+            "peak_inflight_bytes": self.peak_inflight_bytes,
+            "inflight_limit": self.inflight_limit,
+            "thresholds": dict(zip(LEVELS[1:], self.thresholds)),
+            "transitions": self.transitions,
+            "last_transition": self.last_transition,
+            "seconds_in_level": {name: round(t, 1) for name, t in zip(LEVELS, time_in_level)},
+            "degraded": self.degraded,
+        }
+
+class GovernorMiddleware:
+    """Pure ASGI middleware answering 503 for work the current level doesn't accept."""
+
+    def __init__(self, app, paths=("/chat", "/chat/batch", "/transcribe")):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("method") != "POST" or scope.get("path") not in self.paths:
+            return await self.app(scope, receive, send)
+        rejection = governor.rejection(scope["path"])
+        if rejection is None:
+            # The upload body is spooled, then read into memory for the upstream call
+            headers = dict(scope.get("headers", []))
+            try:
+                content_length = int(headers.get(b"content-length", b"0"))
+            except ValueError:
+                content_length = 0
+            with governor.hold(content_length):
+                return await self.app(scope, receive, send)
+        admission.record_rejection(rejection)
+        body = dumps(overloaded_body(rejection))
+        await send({
+            "type": "http.response.start",
+            "status": rejection.status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"retry-after", str(rejection.retry_after).encode("latin-1")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+def _thresholds() -> List[float]:
+    values = [float(v) for v in os.getenv("GOVERNOR_THRESHOLDS", "0.75,0.85,0.95").split(",")]
+    if len(values) != 3 or values != sorted(values):
+        raise ValueError("GOVERNOR_THRESHOLDS needs three increasing values")
+    return values
+
+governor = ResourceGovernor(
+    memory_limit=int(os.getenv("GOVERNOR_MEMORY_LIMIT", "0")) or default_memory_limit(),
+    fd_limit=max(0, resource.getrlimit(resource.RLIMIT_NOFILE)[0]),
+    inflight_limit=int(os.getenv("GOVERNOR_INFLIGHT_LIMIT", str(256 << 20))),
+    thresholds=_thresholds(),
+    hysteresis=float(os.getenv("GOVERNOR_HYSTERESIS", "0.1")),
+    interval=float(os.getenv("GOVERNOR_INTERVAL", "1")),
+    retry_after=float(os.getenv("GOVERNOR_RETRY_AFTER", "5")),
+    enabled=os.getenv("GOVERNOR_ENABLED", "true").lower() == "true"
+)
@@ -0,0 +1,30 @@
+"""Rolling latency window shared by the backends, limiters and caches.
+
+Kept free of app imports so any module (and its tests) can use it without
+pulling in the STT, TTS or transcoding stacks.
+"""
+from collections import deque
+from typing import Any, Dict, Optional
+
+class LatencyWindow:
+    """Rolling window of call latencies."""
+
+    def __init__(self, size: int = 100):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+    def summary(self) -> Dict[str, Any]:
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            "calls": len(self.samples),
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
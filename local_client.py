@@ -1,56 +1,448 @@
-import requests
+import argparse
+import asyncio
+import glob
+import hashlib
 import json
-import time
 import os
+import random
+import sys
+import time
+from itertools import cycle
+from typing import Optional, List, Dict, Any, AsyncIterator
+
+import httpx
+
+AUDIO_CONTENT_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".mp4": "audio/mp4",
+    ".m4a": "audio/mp4",
+    ".webm": "audio/webm",
+    ".ogg": "audio/ogg",
+    ".wav": "audio/wav",
+}
+
+class ResultWriter:
+    """Stream results as JSON lines to stdout or a file."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.stream = open(path, "a", buffering=1) if path else sys.stdout
+
+    def write(self, record: Dict[str, Any]):
+        record.setdefault("ts", time.time())
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        if self.path:
+            self.stream.close()
 
 class NagLocalClient:
-    def __init__(self, base_url="http://127.0.0.1:9000"):
-        self.base_url = base_url
-        self.session = requests.Session()
-    
-    def send_message(self, message):
-        """Send a message to the chat endpoint"""
+    def __init__(self, base_url="http://127.0.0.1:9000", timeout: float = 60.0, max_connections: int = 100):
+        self.base_url = base_url.rstrip("/")
+        self.session = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        # Audio fixtures are read once, off the event loop, then reused for every upload
+        self._audio: Dict[str, bytes] = {}
+
+    async def close(self):
+        await self.session.aclose()
+
+    async def send_message(self, message: str, mode: str = "chat") -> Dict[str, Any]:
+        """Send a message to the chat endpoint and return a result record"""
+        start = time.perf_counter()
+        record = {"type": "chat", "message": message[:100]}
         try:
-            print(f"\nSending message: {message}")
-            response = self.session.post(
-                f"{self.base_url}/chat",
-                json={"message": message}
-            )
-            
+            response = await self.session.post("/chat", json={"message": message, "mode": mode})
+            record["status"] = response.status_code
+            record["bytes"] = len(response.content)
             if response.status_code == 200:
                 data = response.json()
-                print("\nResponse:")
-                print(f"Text: {data.get('response', 'No response text')}")
-                if 'audio_url' in data:
-                    print(f"Audio URL: {data['audio_url']}")
-                if 'debug' in data:
-                    print("\nDebug info:")
-                    print(json.dumps(data['debug'], indent=2))
+                record["response"] = data.get("response")
+                record["audio_url"] = data.get("audio_url")
+                if data.get("error"):
+                    record["error"] = data["error"]
+            else:
+                record["error"] = response.text[:500]
+        except Exception as e:
+            record["status"] = None
+            record["error"] = f"{type(e).__name__}: {str(e)}"
+        record["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return record
+
+    async def transcribe(self, path: str) -> Dict[str, Any]:
+        """Upload an audio file to the transcribe endpoint and return a result record"""
+        start = time.perf_counter()
+        record = {"type": "transcribe", "file": os.path.basename(path)}
+        try:
+            content = self._audio.get(path)
+            if content is None:
+                content = self._audio[path] = await asyncio.to_thread(_read_file, path)
+            ext = os.path.splitext(path)[1].lower()
+            files = {"file": (os.path.basename(path), content, AUDIO_CONTENT_TYPES.get(ext, "audio/mpeg"))}
+            response = await self.session.post("/transcribe", files=files)
+            record["status"] = response.status_code
+            record["upload_bytes"] = len(content)
+            if response.status_code == 200:
+                record["transcription"] = response.json().get("transcription")
             else:
-                print(f"Error: {response.status_code}")
-                print(response.text)
-                
+                record["error"] = response.text[:500]
         except Exception as e:
-            print(f"Error sending message: {str(e)}")
+            record["status"] = None
+            record["error"] = f"{type(e).__name__}: {str(e)}"
+        record["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return record
+
+    async def stream_batch(self, body: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """POST a batch to /chat/batch and yield its NDJSON lines as they arrive"""
+        async with self.session.stream("POST", "/chat/batch", json=body, timeout=httpx.Timeout(None, connect=10.0)) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise httpx.HTTPStatusError(f"{response.status_code}: {response.text[:500]}", request=response.request, response=response)
+            async for line in response.aiter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+# -------------------- Workload Loading --------------------
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def load_transcripts(paths: List[str]) -> List[Dict[str, Any]]:
+    """Load recorded conversation turns from JSON, JSON lines or plain text files."""
+    turns = []
+    for path in paths:
+        with open(path, "r") as f:
+            raw = f.read()
+        if path.endswith(".json"):
+            data = json.loads(raw)
+            items = data if isinstance(data, list) else data.get("turns", data.get("messages", []))
+        elif path.endswith(".jsonl"):
+            items = [json.loads(line) for line in raw.splitlines() if line.strip()]
+        else:
+            items = [line for line in raw.splitlines() if line.strip()]
+
+        for item in items:
+            if isinstance(item, str):
+                turns.append({"message": item, "mode": "chat"})
+            elif isinstance(item, dict):
+                # Only replay the user's side of recorded conversations
+                if item.get("role", "user") != "user":
+                    continue
+                message = item.get("message") or item.get("text") or item.get("content")
+                if message:
+                    turns.append({"message": message, "mode": item.get("mode", "chat")})
+    return turns
+
+def load_audio_files(patterns: List[str]) -> List[str]:
+    files = []
+    for pattern in patterns:
+        files.extend(sorted(glob.glob(pattern)))
+    return files
+
+def build_workload(transcripts: List[Dict[str, Any]], audio_files: List[str]):
+    """Interleave chat turns and audio uploads into one endless request stream."""
+    items = [("chat", t) for t in transcripts] + [("transcribe", a) for a in audio_files]
+    if not items:
+        raise ValueError("Nothing to replay: pass --transcripts and/or --audio")
+    return cycle(items)
+
+# -------------------- Resource Sampling --------------------
+def sample_process(pid: int) -> Optional[Dict[str, Any]]:
+    """Read RSS and open file descriptors for a local server process from /proc."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        rss_kb = int(status.get("VmRSS", "0 kB").strip().split()[0])
+        num_fds = len(os.listdir(f"/proc/{pid}/fd"))
+        num_threads = int(status.get("Threads", "0").strip())
+        return {"rss_mb": round(rss_kb / 1024, 1), "fds": num_fds, "threads": num_threads}
+    except (OSError, ValueError):
+        return None
+
+def slope_per_hour(samples: List[Dict[str, Any]], key: str) -> Optional[float]:
+    """Least-squares growth rate of a sampled metric, in units per hour."""
+    points = [(s["elapsed_s"], s[key]) for s in samples if key in s]
+    if len(points) < 2:
+        return None
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return None
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    return round(cov / var_x * 3600, 3)
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# -------------------- Replay / Soak --------------------
+class TrafficGenerator:
+    """Open-loop traffic generator that issues requests at a target rate."""
+
+    # Latencies kept for the percentiles; a uniform sample past this, so multi-hour soaks stay flat
+    RESERVOIR_SIZE = 10000
+
+    def __init__(self, client: NagLocalClient, writer: ResultWriter, rate: float, concurrency: int):
+        self.client = client
+        self.writer = writer
+        self.rate = rate
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.latencies: List[float] = []
+        self.completed = 0
+        self.sent = 0
+        self.errors = 0
+        self.dropped = 0
+        self.tasks = set()
+
+    async def _issue(self, kind: str, payload):
+        try:
+            if kind == "chat":
+                record = await self.client.send_message(payload["message"], payload.get("mode", "chat"))
+            else:
+                record = await self.client.transcribe(payload)
+            self._record_latency(record["latency_ms"])
+            if record.get("status") != 200:
+                self.errors += 1
+            self.writer.write(record)
+        finally:
+            self.semaphore.release()
+
+    def _record_latency(self, latency_ms: float):
+        """Reservoir sampling: every completed request has the same chance of being in `latencies`."""
+        self.completed += 1
+        if len(self.latencies) < self.RESERVOIR_SIZE:
+            self.latencies.append(latency_ms)
+        else:
+            slot = random.randrange(self.completed)
+            if slot < self.RESERVOIR_SIZE:
+                self.latencies[slot] = latency_ms
+
+    async def run(self, workload, total: Optional[int] = None, duration: Optional[float] = None):
+        interval = 1.0 / self.rate if self.rate > 0 else 0
+        start = time.perf_counter()
+        next_at = start
+        for kind, payload in workload:
+            if total is not None and self.sent >= total:
+                break
+            if duration is not None and time.perf_counter() - start >= duration:
+                break
+
+            # Keep the schedule fixed; if the server falls behind, count the miss instead of slowing down
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_at += interval
+
+            if self.semaphore.locked():
+                self.dropped += 1
+                self.writer.write({"type": "dropped", "kind": kind, "reason": "concurrency limit"})
+                continue
+            await self.semaphore.acquire()
+            self.sent += 1
+            task = asyncio.create_task(self._issue(kind, payload))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        return time.perf_counter() - start
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        return {
+            "type": "summary",
+            "sent": self.sent,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "elapsed_s": round(elapsed, 1),
+            "achieved_rate": round(self.sent / elapsed, 2) if elapsed else None,
+            "p50_ms": percentile(self.latencies, 50),
+            "p95_ms": percentile(self.latencies, 95),
+            "p99_ms": percentile(self.latencies, 99),
+        }
+
+async def monitor_resources(pid: int, writer: ResultWriter, interval: float, samples: List[Dict[str, Any]], stop: asyncio.Event):
+    start = time.perf_counter()
+    while not stop.is_set():
+        sample = sample_process(pid)
+        if sample is not None:
+            sample["elapsed_s"] = round(time.perf_counter() - start, 1)
+            samples.append(sample)
+            writer.write({"type": "resources", "pid": pid, **sample})
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def run_replay(args, soak: bool = False):
+    transcripts = load_transcripts(args.transcripts or [])
+    audio_files = load_audio_files(args.audio or [])
+    workload = build_workload(transcripts, audio_files)
+
+    writer = ResultWriter(args.output)
+    client = NagLocalClient(args.base_url, timeout=args.timeout, max_connections=args.concurrency)
+    generator = TrafficGenerator(client, writer, args.rate, args.concurrency)
+
+    samples: List[Dict[str, Any]] = []
+    stop = asyncio.Event()
+    monitor = None
+    if soak:
+        if sample_process(args.server_pid) is None:
+            raise SystemExit(f"Cannot read /proc/{args.server_pid}; soak needs the PID of a local server process")
+        monitor = asyncio.create_task(monitor_resources(args.server_pid, writer, args.sample_interval, samples, stop))
+
+    try:
+        if soak:
+            elapsed = await generator.run(workload, duration=args.duration)
+        else:
+            total = args.count or len(transcripts) + len(audio_files)
+            elapsed = await generator.run(workload, total=total)
+    finally:
+        stop.set()
+        if monitor:
+            await monitor
+        await client.close()
+
+    summary = generator.summary(elapsed)
+    if soak and samples:
+        rss_growth = slope_per_hour(samples, "rss_mb")
+        fd_growth = slope_per_hour(samples, "fds")
+        summary.update({
+            "rss_start_mb": samples[0]["rss_mb"],
+            "rss_end_mb": samples[-1]["rss_mb"],
+            "rss_growth_mb_per_hour": rss_growth,
+            "fds_start": samples[0]["fds"],
+            "fds_end": samples[-1]["fds"],
+            "fd_growth_per_hour": fd_growth,
+            "suspected_memory_leak": rss_growth is not None and rss_growth > args.rss_leak_threshold,
+            "suspected_fd_leak": fd_growth is not None and fd_growth > args.fd_leak_threshold,
+        })
+    writer.write(summary)
+    writer.close()
+
+async def run_batch(args):
+    turns = load_transcripts(args.messages)
+    if not turns:
+        raise ValueError("Nothing to send: no user messages in the given files")
+    items = [{"id": str(i), "message": t["message"], "mode": args.mode or t.get("mode", "chat")} for i, t in enumerate(turns)]
+    # Same input, same job: re-running the command resumes from the server's checkpoint
+    job_id = args.job_id or hashlib.sha1(json.dumps(items, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    body = {"job_id": job_id, "items": items, "concurrency": args.concurrency}
+    if args.tenant:
+        body["tenant"] = args.tenant
+    if args.semantic_cache:
+        body["semantic_cache"] = True
+
+    writer = ResultWriter(args.output)
+    client = NagLocalClient(args.base_url, timeout=args.timeout)
+    seen = set()
+    attempt = 0
+    try:
+        while True:
+            try:
+                async for record in client.stream_batch(body):
+                    if record.get("type") == "result":
+                        # A resumed stream replays results already written; failed items run again
+                        if record["id"] in seen:
+                            continue
+                        if record.get("status") == "ok":
+                            seen.add(record["id"])
+                    writer.write(record)
+                    if record.get("type") == "summary":
+                        return
+                raise httpx.RemoteProtocolError("Stream ended without a summary")
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                attempt += 1
+                # The job id is taken by other messages; retrying won't help
+                if attempt > args.retries or "Batch items changed" in str(e):
+                    raise
+                # 409: the server is still winding down the previous stream of this job
+                delay = min(30.0, 2.0 ** attempt)
+                writer.write({"type": "retry", "job_id": job_id, "attempt": attempt, "delay_s": delay, "error": str(e)})
+                await asyncio.sleep(delay)
+    finally:
+        await client.close()
+        writer.close()
+
+async def run_interactive(args):
+    client = NagLocalClient(args.base_url, timeout=args.timeout)
 
-def main():
-    client = NagLocalClient()
-    
     print("=== Nag Local Client ===")
     print("Type 'quit' to exit")
     print("Type 'test' to send a test message")
-    
-    while True:
-        message = input("\nEnter your message: ").strip()
-        
-        if message.lower() == 'quit':
-            break
-        elif message.lower() == 'test':
-            message = "Hi, this is a test message"
-        
-        if message:
-            client.send_message(message)
-            time.sleep(1)  # Small delay between messages
+
+    try:
+        while True:
+            message = (await asyncio.to_thread(input, "\nEnter your message: ")).strip()
+
+            if message.lower() == 'quit':
+                break
+            elif message.lower() == 'test':
+                message = "Hi, this is a test message"
+
+            if message:
+                record = await client.send_message(message)
+                print(json.dumps(record, indent=2))
+    finally:
+        await client.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Nag local client, replay tool and soak tester")
+    parser.add_argument("--base-url", default=os.getenv("NAG_BASE_URL", "http://127.0.0.1:9000"))
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request timeout in seconds")
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("interactive", help="Send messages typed at the prompt (default)")
+
+    def add_workload_args(sub):
+        sub.add_argument("--transcripts", nargs="*", help="Conversation files (.json, .jsonl or plain text)")
+        sub.add_argument("--audio", nargs="*", help="Audio files or globs, e.g. 'archive/audio_*.mp3'")
+        sub.add_argument("--rate", type=float, default=1.0, help="Target requests per second")
+        sub.add_argument("--concurrency", type=int, default=10, help="Maximum requests in flight")
+        sub.add_argument("--output", help="Write JSON lines here instead of stdout")
+
+    replay = subparsers.add_parser("replay", help="Replay recorded turns and audio at a target rate")
+    add_workload_args(replay)
+    replay.add_argument("--count", type=int, help="Total requests to send (default: one pass)")
+
+    soak = subparsers.add_parser("soak", help="Run a long replay while watching the server for leaks")
+    add_workload_args(soak)
+    soak.add_argument("--duration", type=float, default=3600.0, help="Soak duration in seconds")
+    soak.add_argument("--server-pid", type=int, required=True, help="PID of the local server process to sample (leak detection needs it)")
+    soak.add_argument("--sample-interval", type=float, default=30.0, help="Seconds between resource samples")
+    soak.add_argument("--rss-leak-threshold", type=float, default=50.0, help="RSS growth (MB/hour) flagged as a leak")
+    soak.add_argument("--fd-leak-threshold", type=float, default=20.0, help="FD growth (per hour) flagged as a leak")
+
+    batch = subparsers.add_parser("batch", help="Generate replies for many messages through /chat/batch (resumable)")
+    batch.add_argument("messages", nargs="+", help="Message files (.json, .jsonl or plain text, one message per line)")
+    batch.add_argument("--mode", choices=["chat", "book", "voice"], help="Mode for every message (default: per message, else chat)")
+    batch.add_argument("--job-id", help="Checkpoint name on the server (default: derived from the messages)")
+    batch.add_argument("--concurrency", type=int, default=4, help="Messages in flight on the server")
+    batch.add_argument("--tenant", help="Twin to answer as (default: the server's default tenant)")
+    batch.add_argument("--semantic-cache", action="store_true", help="Let items reuse (and fill) the server's semantic reply cache")
+    batch.add_argument("--retries", type=int, default=5, help="Reconnect attempts if the stream breaks")
+    batch.add_argument("--output", help="Write JSON lines here instead of stdout")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "replay":
+        asyncio.run(run_replay(args))
+    elif args.command == "soak":
+        asyncio.run(run_replay(args, soak=True))
+    elif args.command == "batch":
+        asyncio.run(run_batch(args))
+    else:
+        asyncio.run(run_interactive(args))
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
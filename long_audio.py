@@ -0,0 +1,242 @@
+"""Parallel chunked transcription for long recordings.
+
+Whisper latency grows with clip length, and a multi-minute monologue can
+run past the Whisper client's timeout. For recordings longer than
+LONG_AUDIO_THRESHOLD, `LongAudioTranscriber`:
+
+  1. runs ffmpeg's silencedetect over the normalized audio (in the
+     transcoder's process pool) to find pauses,
+  2. plans segments of roughly LONG_AUDIO_SEGMENT seconds that end in a
+     pause, each padded with LONG_AUDIO_OVERLAP seconds of overlap,
+  3. cuts and transcribes the segments concurrently (at most
+     LONG_AUDIO_PARALLELISM Whisper calls per recording),
+  4. stitches the texts in order, dropping words repeated in the overlap.
+
+End-to-end latency then tracks the slowest segment, not the whole clip.
+
+Environment:
+    LONG_AUDIO_THRESHOLD     seconds above which a recording is split (default 60, 0 disables)
+    LONG_AUDIO_SEGMENT       target segment length in seconds (default 30)
+    LONG_AUDIO_MAX_SEGMENT   hard cap when no pause is found (default 45)
+    LONG_AUDIO_OVERLAP       seconds of overlap on each side of a cut (default 1.0)
+    LONG_AUDIO_PARALLELISM   concurrent Whisper calls per recording (default 4)
+    LONG_AUDIO_SILENCE_DB    silencedetect noise floor (default -35)
+"""
+import asyncio
+import logging
+import os
+import re
+import subprocess
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import ffmpeg
+
+from file_io import read_bytes, remove_quietly
+from transcoder import AudioTranscoder, OUTPUT_FORMATS, FFMPEG_BINARY, TranscodeError, TranscodeTimeout, run_ffmpeg, transcoder
+
+logger = logging.getLogger(__name__)
+
+# Approximate output bitrates, used to guess duration from the normalized file size
+BYTES_PER_SECOND = {"opus": 3000, "wav": 32000}
+
+_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+_TIME_RE = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
+_SILENCE_START_RE = re.compile(r"silence_start: (-?\d+(?:\.\d+)?)")
+_SILENCE_END_RE = re.compile(r"silence_end: (\d+(?:\.\d+)?)")
+_WORD_RE = re.compile(r"[\w']+")
+
+def _seconds(match) -> float:
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+def _detect_silences_job(src: str, noise_db: float, min_silence: float, timeout: float) -> Dict[str, Any]:
+    """Runs in a worker process. Returns the duration and (start, end) pauses."""
+    started = time.time()
+    stream = ffmpeg.input(src).audio.filter("silencedetect", noise=f"{noise_db}dB", d=min_silence).output("-", format="null")
+    args = ffmpeg.compile(stream.global_args("-nostdin", "-hide_banner"), cmd=FFMPEG_BINARY)
+    try:
+        process = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise TranscodeTimeout(f"silencedetect timed out after {timeout}s")
+    if process.returncode != 0:
+        raise TranscodeError(f"silencedetect failed with exit code {process.returncode}")
+    log = process.stderr.decode("utf-8", "replace")
+
+    duration = None
+    match = _DURATION_RE.search(log)
+    if match:
+        duration = _seconds(match)
+    else:
+        times = list(_TIME_RE.finditer(log))
+        if times:
+            duration = _seconds(times[-1])
+
+    starts = [float(m.group(1)) for m in _SILENCE_START_RE.finditer(log)]
+    ends = [float(m.group(1)) for m in _SILENCE_END_RE.finditer(log)]
+    silences = []
+    for i, start in enumerate(starts):
+        end = ends[i] if i < len(ends) else duration
+        if end is not None:
+            silences.append((max(0.0, start), end))
+    return {"started": started, "run_s": time.time() - started, "duration": duration, "silences": silences}
+
+def _cut_segment_job(src: str, dst: str, start: float, length: float, output_format: str, timeout: float) -> Dict[str, Any]:
+    """Runs in a worker process."""
+    started = time.time()
+    options = OUTPUT_FORMATS[output_format][2]
+    stream = ffmpeg.input(src, ss=round(start, 3), t=round(length, 3)).audio.output(dst, **options)
+    run_ffmpeg(stream, timeout)
+    return {"started": started, "run_s": time.time() - started, "output_bytes": os.path.getsize(dst)}
+
+def plan_segments(
+    duration: float,
+    silences: List[Tuple[float, float]],
+    target: float = 30.0,
+    max_length: float = 45.0,
+    overlap: float = 1.0
+) -> List[Tuple[float, float]]:
+    """Split [0, duration] at pauses near `target` seconds; returns padded (start, end) ranges."""
+    # Each cut must move forward, or the loop below never ends
+    if target <= 0 or max_length < target:
+        raise ValueError(f"Segment target must be > 0 and at most the max length (target={target}, max={max_length})")
+    if overlap < 0:
+        raise ValueError(f"Segment overlap must be >= 0 (got {overlap})")
+    pauses = [(start + end) / 2 for start, end in silences]
+    cuts = []
+    position = 0.0
+    while duration - position > max_length:
+        window = [p for p in pauses if position + target / 2 <= p <= position + max_length]
+        cut = min(window, key=lambda p: abs(p - position - target)) if window else position + max_length
+        cuts.append(cut)
+        position = cut
+
+    bounds = [0.0] + cuts + [duration]
+    segments = []
+    for start, end in zip(bounds, bounds[1:]):
+        segments.append((max(0.0, start - overlap), min(duration, end + overlap)))
+    return segments
+
+def stitch_texts(texts: List[str], max_overlap_words: int = 12) -> str:
+    """Join segment transcripts, dropping words repeated across an overlap."""
+    stitched: List[str] = []
+    for text in texts:
+        words = text.split()
+        if not words:
+            continue
+        if stitched:
+            tail = [w.lower() for w in _normalized(stitched[-max_overlap_words:])]
+            head = [w.lower() for w in _normalized(words[:max_overlap_words])]
+            for size in range(min(len(tail), len(head)), 0, -1):
+                if tail[-size:] == head[:size]:
+                    words = words[size:]
+                    break
+        stitched.extend(words)
+    return " ".join(stitched)
+
+def _normalized(words: List[str]) -> List[str]:
+    return ["".join(_WORD_RE.findall(w)) for w in words]
+
+class LongAudioTranscriber:
+    def __init__(
+        self,
+        transcoder: AudioTranscoder,
+        threshold: float = 60.0,
+        target: float = 30.0,
+        max_length: float = 45.0,
+        overlap: float = 1.0,
+        parallelism: int = 4,
+        noise_db: float = -35.0
+    ):
+        if target <= 0 or overlap < 0 or parallelism < 1:
+            raise ValueError(f"LONG_AUDIO_SEGMENT must be > 0, LONG_AUDIO_OVERLAP >= 0 and LONG_AUDIO_PARALLELISM >= 1 "
+                             f"(got {target}, {overlap}, {parallelism})")
+        self.transcoder = transcoder
+        self.threshold = threshold
+        self.target = target
+        self.max_length = max(max_length, target)
+        self.overlap = overlap
+        self.parallelism = parallelism
+        self.noise_db = noise_db
+        self.recordings = 0
+        self.segments = 0
+        self.total_audio_s = 0.0
+        self.total_wall_ms = 0.0
+
+    def likely_long(self, output_bytes: int) -> bool:
+        if self.threshold <= 0 or not self.transcoder.available:
+            return False
+        bytes_per_second = BYTES_PER_SECOND.get(self.transcoder.output_format, 3000)
+        # Probe anything that might be long; silencedetect on compact audio is cheap
+        return output_bytes / bytes_per_second > self.threshold * 0.8
+
+    async def transcribe(self, path: str, transcribe_segment: Callable[[bytes, str, str], Awaitable[dict]]) -> Optional[Dict[str, Any]]:
+        """Transcribe a long normalized recording in parallel; None if it's short enough to send whole."""
+        started = time.perf_counter()
+        probe = await self.transcoder.submit(_detect_silences_job, path, self.noise_db, 0.4, self.transcoder.timeout)
+        duration = probe["duration"]
+        if not duration or duration <= self.threshold:
+            return None
+
+        plan = plan_segments(duration, probe["silences"], self.target, self.max_length, self.overlap)
+        extension, content_type, _ = OUTPUT_FORMATS[self.transcoder.output_format]
+        semaphore = asyncio.Semaphore(self.parallelism)
+        logger.info(f"Splitting {duration:.1f}s recording into {len(plan)} segments")
+
+        async def run_segment(index: int, start: float, end: float) -> Dict[str, Any]:
+            segment_path = f"{os.path.splitext(path)[0]}.part{index}{extension}"
+            try:
+                await self.transcoder.submit(
+                    _cut_segment_job, path, segment_path, start, end - start,
+                    self.transcoder.output_format, self.transcoder.timeout
+                )
+                content = await read_bytes(segment_path)
+                async with semaphore:
+                    return await transcribe_segment(content, os.path.basename(segment_path), content_type)
+            finally:
+                await remove_quietly(segment_path)
+
+        tasks = [asyncio.ensure_future(run_segment(i, start, end)) for i, (start, end) in enumerate(plan)]
+        try:
+            results = await asyncio.gather(*tasks)
+        finally:
+            # One failed segment fails the recording: stop the others' Whisper calls and
+            # wait for their cleanup, so no segment file outlives the request
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.recordings += 1
+        self.segments += len(plan)
+        self.total_audio_s += duration
+        wall_ms = (time.perf_counter() - started) * 1000
+        self.total_wall_ms += wall_ms
+        logger.info(f"Transcribed {duration:.1f}s in {len(plan)} segments in {wall_ms:.0f}ms")
+
+        return {
+            "text": stitch_texts([r["text"] for r in results]),
+            "language": results[0].get("language") if results else None,
+            "segments": [s for r in results for s in r.get("segments", [])],
+            "chunks": len(plan),
+            "duration": duration,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "threshold_s": self.threshold,
+            "recordings": self.recordings,
+            "segments": self.segments,
+            "audio_seconds": round(self.total_audio_s, 1),
+            "avg_wall_ms": round(self.total_wall_ms / self.recordings, 1) if self.recordings else None,
+            "realtime_factor": round(self.total_wall_ms / 1000 / self.total_audio_s, 3) if self.total_audio_s else None,
+        }
+
+long_audio = LongAudioTranscriber(
+    transcoder,
+    threshold=float(os.getenv("LONG_AUDIO_THRESHOLD", "60")),
+    target=float(os.getenv("LONG_AUDIO_SEGMENT", "30")),
+    max_length=float(os.getenv("LONG_AUDIO_MAX_SEGMENT", "45")),
+    overlap=float(os.getenv("LONG_AUDIO_OVERLAP", "1.0")),
+    parallelism=int(os.getenv("LONG_AUDIO_PARALLELISM", "4")),
+    noise_db=float(os.getenv("LONG_AUDIO_SILENCE_DB", "-35"))
+)
@@ -1,11 +1,12 @@
-from fastapi import FastAPI, Request, UploadFile, File, HTTPException, WebSocket
-from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException, WebSocket, Depends, Query
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse, StreamingResponse
+from fastapi.exceptions import RequestValidationError
+from starlette.background import BackgroundTask
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr, ValidationError, field_validator
 from enum import Enum
 import os
 import logging
@@ -14,11 +15,39 @@ import tempfile
 import uuid
 import httpx
 import json
-from typing import Optional, List
+import asyncio
+import threading
+import time
+from typing import Awaitable, Callable, Optional, List
 from fastapi import WebSocketDisconnect
-from elevenlabs.client import ElevenLabs
 import traceback
 import uvicorn
+from upstream import get_upstream_provider
+from tracing import TracingMiddleware, tracer, span, set_request_id, annotate
+from diagnostics import loop_monitor, profiler, monitor_enabled, debug_access, ProfilerBusy
+from file_io import spool_upload, read_bytes, remove_quietly, is_file
+from transcription_cache import transcription_cache, content_key, pcm_fingerprint, pcm_fingerprint_enabled
+from transcript_filter import transcript_filter
+from transcoder import transcoder
+from long_audio import long_audio
+from stt import configure_stt_backend
+from tts import configure_tts_router, join_audio
+from model_router import model_router
+from token_accounting import token_accounting, trim_to_sentence
+from semantic_cache import semantic_cache, prompt_version
+from memory_store import memory_store
+from memory_capture import memory_capture
+from tenants import tenant_registry, UnknownTenant
+from audio_jobs import audio_jobs, PRIORITIES
+from audio_store import audio_store
+from audio_formats import audio_formats, DELIVERY_FORMATS
+from admission import admission, AdmissionMiddleware, Overloaded, overloaded_body, BACKGROUND
+from governor import governor, GovernorMiddleware, SHED
+from chat_batch import batch_runner, BatchError, BatchConflict, BatchMismatch
+from serialization import FastJSONResponse, error_response, encode_message, loads, serialization, validation_details
+from warmup import warm_up, warm_up_blocking, load_phrases, tts_failure_phrase, FirstRequestMiddleware, request_latency
+import openai
+from elevenlabs.core.api_error import ApiError as ElevenLabsApiError
 
 # -------------------- Logging Setup --------------------
 class JSONFormatter(logging.Formatter):
@@ -61,10 +90,35 @@ class ChatMode(str, Enum):
     VOICE = "voice"
 
 class ChatRequest(BaseModel):
-    text: str
+    """Body of POST /chat; the message may come as "message" or "text"."""
+    # Unknown fields from older or newer clients are accepted and ignored
+    model_config = ConfigDict(extra="allow")
+    
+    message: Optional[str] = None
+    text: Optional[str] = None
     mode: ChatMode = ChatMode.CHAT
     email: Optional[EmailStr] = None
     request_id: Optional[str] = None
+    tenant: Optional[str] = None
+    client_id: Optional[str] = None
+    async_audio: bool = False
+    audio_format: Optional[str] = None
+    device: Optional[str] = None
+    browser: Optional[str] = None
+    
+    @field_validator("mode", mode="before")
+    @classmethod
+    def default_mode(cls, value):
+        return value or ChatMode.CHAT
+    
+    @property
+    def user_message(self) -> str:
+        return self.message or self.text or ""
+    
+    @property
+    def user_key(self) -> Optional[str]:
+        """Who captured memories belong to: the email, else the client id."""
+        return (self.email or "").lower() or self.client_id or None
 
 class MessageRequest(BaseModel):
     message: str
@@ -72,13 +126,16 @@ class MessageRequest(BaseModel):
 
 # -------------------- Load Environment Variables --------------------
 load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    logger.error("OPENAI_API_KEY not found in environment variables")
-    raise ValueError("OPENAI_API_KEY environment variable is required")
 
-client = AsyncOpenAI(api_key=api_key, http_client=httpx.AsyncClient(timeout=30.0, verify=True))
-tts_client = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
+# -------------------- Upstream Clients --------------------
+# UPSTREAM_PROVIDER=mock points these at mock_upstream.py for offline load tests
+upstream = get_upstream_provider()
+api_key = upstream.openai_api_key
+client = upstream.create_chat_client()
+whisper_client = upstream.create_whisper_client()
+tts_client = upstream.create_tts_client()
+stt_backend = configure_stt_backend(whisper_client)
+tts_router = configure_tts_router(tts_client)
 
 # -------------------- App Setup --------------------
 app = FastAPI(
@@ -86,9 +143,14 @@ app = FastAPI(
     description="API for Nag App",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=FastJSONResponse
 )
 
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request: Request, exc: RequestValidationError):
+    return error_response(400, "Invalid request", validation_details(exc.errors()))
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -97,26 +159,52 @@ app.add_middleware(
     allow_headers=["*"]
 )
 app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(GovernorMiddleware)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(FirstRequestMiddleware)
 
 STATIC_BASE = "static"
-os.makedirs(os.path.join(STATIC_BASE, "audio"), exist_ok=True)
 app.mount("/static", StaticFiles(directory=STATIC_BASE), name="static")
 
 # -------------------- WebSocket Manager --------------------
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        # Clients identify themselves with a "hello" message so jobs can push to them
+        self.clients: dict = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
 
+    def register(self, client_id: str, websocket: WebSocket):
+        self.clients[client_id] = websocket
+
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+        for client_id, connection in list(self.clients.items()):
+            if connection is websocket:
+                del self.clients[client_id]
+
+    async def send_to_client(self, client_id: Optional[str], message: dict) -> bool:
+        websocket = self.clients.get(client_id) if client_id else None
+        if websocket is None:
+            return False
+        try:
+            await websocket.send_text(encode_message(message))
+            return True
+        except Exception as e:
+            logger.warning(f"WebSocket push to {client_id} failed: {str(e)}")
+            self.disconnect(websocket)
+            return False
 
-    async def broadcast(self, message: str):
+    async def broadcast(self, message: dict):
+        # Encoded once for every connection
+        text = encode_message(message)
         for connection in self.active_connections:
-            await connection.send_text(message)
+            await connection.send_text(text)
 
 manager = ConnectionManager()
 
@@ -138,15 +226,140 @@ async def health_check():
         "version": "1.0.0"
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe: 503 until the startup warm-up has finished, and while shedding load"""
+    if not warm_up.is_ready:
+        return FastJSONResponse(status_code=503, content={"status": "warming_up", **warm_up.stats()})
+    if governor.level >= SHED:
+        # Let the load balancer drain this worker until pressure drops
+        return FastJSONResponse(status_code=503, content={"status": "shedding", "governor": governor.stats()})
+    return {"status": "ready", **warm_up.stats()}
+
+@app.get("/audio/jobs/{job_id}")
+async def audio_job_status(job_id: str):
+    """Polling fallback for clients without a WebSocket push, answered by any worker"""
+    job = await audio_jobs.status(job_id)
+    if job is None:
+        return error_response(404, "Not found", f"Audio job {job_id} not found or expired")
+    return job
+
+@app.get("/audio/{object_id}")
+async def serve_audio(object_id: str, format: Optional[str] = None):
+    """Generated clips, resolved through the audio store's index, in the client's delivery format."""
+    served_id = await audio_formats.resolve(object_id, format)
+    served = await audio_store.response(served_id)
+    if served is None:
+        raise HTTPException(status_code=404, detail=f"Audio {object_id} not found")
+    response, size = served
+    # Resolving falls back to the original when there's no smaller rendition
+    audio_formats.record_served(format if served_id != object_id else None, size)
+    if format in DELIVERY_FORMATS and served_id == object_id:
+        # Transcoder busy or failed: don't let browsers pin the original under the format's URL
+        response.headers["Cache-Control"] = "public, max-age=60"
+    return response
+
+@app.post("/audio/report")
+async def audio_report(request: Request):
+    """Client-side playback timing: {"format": ..., "time_to_play_ms": ...}."""
+    try:
+        data = await request.json()
+        audio_formats.record_play(data.get("format"), float(data["time_to_play_ms"]))
+        return {"status": "ok"}
+    except (KeyError, TypeError, ValueError) as e:
+        return error_response(400, "Invalid report", f"Expected format and time_to_play_ms: {str(e)}")
+
+# -------------------- Debug Routes --------------------
+def require_debug_token(request: Request):
+    """Debug routes expose internals to any origin (CORS is open), so they need DEBUG_TOKEN."""
+    authorization = request.headers.get("authorization", "")
+    token = request.headers.get("x-debug-token") or (authorization[7:] if authorization.lower().startswith("bearer ") else None)
+    allowed = debug_access(token)
+    if allowed is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not allowed:
+        raise HTTPException(status_code=403, detail="Debug token required")
+
+@app.get("/debug/traces", dependencies=[Depends(require_debug_token)])
+async def debug_traces(limit: int = 50, slowest: bool = False):
+    """Recent (or slowest) sampled request traces"""
+    traces = tracer.memory.get_slowest(limit) if slowest else tracer.memory.get_recent(limit)
+    return {"sample_rate": tracer.sample_rate, "count": len(traces), "traces": traces}
+
+@app.get("/debug/metrics", dependencies=[Depends(require_debug_token)])
+async def debug_metrics():
+    """Counters from the caches and other request-path subsystems"""
+    return {
+        "transcription_cache": transcription_cache.stats(),
+        "transcript_filter": transcript_filter.stats(),
+        "stt": stt_backend.stats(),
+        "tts": tts_router.stats(),
+        "model_router": model_router.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "transcoder": transcoder.stats(),
+        "long_audio": long_audio.stats(),
+        "audio_jobs": audio_jobs.stats(),
+        "audio_store": audio_store.stats(),
+        "audio_formats": audio_formats.stats(),
+        "admission": admission.stats(),
+        "governor": governor.stats(),
+        "serialization": serialization.stats(),
+        "tracing": tracer.stats(),
+        "tokens": token_accounting.stats(),
+        "batch": batch_runner.stats(),
+        "memory_store": await asyncio.to_thread(memory_store.stats),
+        "memory_capture": memory_capture.stats(),
+        "tenants": tenant_registry.stats(),
+        "warm_up": {**warm_up.stats(), "first_requests": request_latency.stats()},
+    }
+
+@app.get("/debug/traces/{trace_id}", dependencies=[Depends(require_debug_token)])
+async def debug_trace(trace_id: str):
+    """Look up one trace by trace id or client request_id"""
+    trace = tracer.memory.find(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"Trace {trace_id} not found")
+    return trace
+
+@app.get("/debug/loop", dependencies=[Depends(require_debug_token)])
+async def debug_loop(limit: int = 10):
+    """Event loop lag statistics and stacks captured during recent stalls"""
+    return {"stats": loop_monitor.stats(), "stalls": loop_monitor.recent_stalls(limit)}
+
+@app.get("/debug/profile", response_class=PlainTextResponse, dependencies=[Depends(require_debug_token)])
+async def debug_profile(seconds: float = Query(5.0, gt=0), interval_ms: float = Query(5.0, ge=1, le=1000), thread: str = "loop"):
+    """Sample stacks for a time window; returns collapsed stacks for flamegraph tools"""
+    if profiler.busy:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    thread_id = (loop_monitor.loop_thread_id or threading.get_ident()) if thread == "loop" else None
+    try:
+        result = await asyncio.to_thread(profiler.sample, seconds, interval_ms / 1000, thread_id)
+    except ProfilerBusy:
+        # Another request started one between the check and the thread
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    logger.info(f"Profile captured: {result['samples']} samples over {result['seconds']}s")
+    return PlainTextResponse(profiler.to_collapsed(result["counts"]))
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
+    await manager.connect(websocket)
     logger.info("WebSocket connection accepted")
-    manager.active_connections.append(websocket)
     try:
         while True:
             data = await websocket.receive_text()
-            await websocket.send_text(f"Message received: {data}")
+            try:
+                message = loads(data)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                await websocket.send_text(encode_message({"type": "error", "error": "Invalid message", "details": "Expected a JSON object"}))
+            elif message.get("type") == "hello" and message.get("client_id"):
+                manager.register(str(message["client_id"]), websocket)
+                await websocket.send_text(encode_message({"type": "welcome", "client_id": message["client_id"]}))
+            elif message.get("type") == "ping":
+                await websocket.send_text(encode_message({"type": "pong"}))
+            else:
+                await websocket.send_text(encode_message({"type": "ack", "received": message.get("type")}))
     except WebSocketDisconnect:
         logger.info("WebSocket client disconnected")
     finally:
@@ -155,78 +368,109 @@ async def websocket_endpoint(websocket: WebSocket):
 @app.post("/chat")
 async def chat(request: Request):
     try:
-        data = await request.json()
+        # Parsed and validated in one pass by pydantic-core
+        body = await request.body()
+        started = time.perf_counter()
+        try:
+            payload = ChatRequest.model_validate_json(body or b"{}")
+        except ValidationError as e:
+            return error_response(400, "Invalid request", validation_details(e.errors()))
+        finally:
+            serialization.record("http.parse", time.perf_counter() - started, len(body))
         logger.info("[chat] Request received")
+        set_request_id(payload.request_id)
+        annotate(mode=payload.mode.value)
         
         # Get message from either "message" or "text" parameter
-        user_message = data.get("message", data.get("text", ""))
+        user_message = payload.user_message
         logger.info("[chat] Processing message")
         
         if not user_message:
             error_msg = "No message provided"
             logger.error(error_msg)
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Invalid request", "details": error_msg}
-            )
+            return error_response(400, "Invalid request", error_msg)
         
-        # Get response from OpenAI
         try:
-            # Create system prompt from context
-            system_prompt = create_system_prompt()
-            logger.info("[chat] Using personalized system prompt")
-            
-            response = await client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.7
-            )
-            
-            assistant_message = response.choices[0].message.content
-            logger.info("[chat] Response generated")
-            
-            # Generate TTS
-            try:
-                audio_url = await generate_tts(assistant_message)
-                logger.info("[chat] TTS generated successfully")
-                return {
-                    "response": assistant_message,
-                    "audio_url": audio_url,
-                    "tts_url": audio_url  # For backward compatibility
-                }
-            except Exception as e:
-                logger.error(f"[chat] TTS generation failed: {str(e)}")
-                logger.error(traceback.format_exc())
-                return {
-                    "response": assistant_message,
-                    "error": "TTS generation failed",
-                    "audio_url": None,
-                    "tts_url": None  # For backward compatibility
-                }
+            tenant = await tenant_registry.acquire(tenant_id_for(request, payload.tenant))
+        except UnknownTenant as e:
+            return unknown_tenant_response(e)
+        annotate(tenant=tenant.id)
+        
+        try:
+            return FastJSONResponse(await chat_turn(payload, tenant, request.headers.get("user-agent", "")))
+        except Overloaded as e:
+            return overloaded_response(e)
         except Exception as e:
             error_msg = f"Error generating response: {str(e)}"
             logger.error(error_msg)
             logger.error(traceback.format_exc())
-            return JSONResponse(
-                status_code=500,
-                content={"error": "Internal server error", "details": error_msg}
-            )
+            return error_response(500, "Internal server error", error_msg)
+        finally:
+            tenant.release()
     except Exception as e:
         error_msg = f"Error processing request: {str(e)}"
         logger.error(error_msg)
         logger.error(traceback.format_exc())
-        return JSONResponse(
-            status_code=500,
-            content={"error": "Internal server error", "details": error_msg}
-        )
+        return error_response(500, "Internal server error", error_msg)
+
+@app.post("/chat/batch")
+async def chat_batch(request: Request):
+    """Many chat turns in one request, streamed back as NDJSON as each completes (see chat_batch.py)."""
+    try:
+        body = loads(await request.body() or b"{}")
+        if not isinstance(body, dict):
+            raise BatchError("Expected a JSON object")
+        job = await batch_runner.prepare(body, validate_batch_item)
+    except BatchMismatch as e:
+        return error_response(409, "Batch items changed", str(e))
+    except BatchConflict as e:
+        return error_response(409, "Batch already running", str(e))
+    except ValueError as e:
+        return error_response(400, "Invalid batch", str(e))
+    
+    default_tenant = tenant_id_for(request, body.get("tenant"))
+    user_agent = request.headers.get("user-agent", "")
+    logger.info(f"[batch] Job {job.id}: {len(job.items)} items, {len(job.done)} already done, concurrency {job.concurrency}")
+    
+    async def turn(item: dict) -> dict:
+        # No client is listening on /ws for a batch, so audio is always inline
+        payload = ChatRequest.model_validate({**item, "async_audio": False})
+        try:
+            tenant = await tenant_registry.acquire(payload.tenant or default_tenant)
+        except UnknownTenant as e:
+            raise ValueError(f"No profile for tenant {e.args[0]}")
+        try:
+            # Offline items don't become memories, and share cached replies only when the job asks to
+            return await chat_turn(payload, tenant, user_agent, priority=BACKGROUND, capture=False, use_cache=job.semantic_cache)
+        finally:
+            tenant.release()
+    
+    return StreamingResponse(
+        batch_runner.run(job, turn),
+        media_type="application/x-ndjson",
+        # GZipMiddleware would hold lines back in its compressor; an explicit encoding makes it pass the stream through
+        headers={"X-Batch-Job-Id": job.id, "Content-Encoding": "identity"},
+        background=BackgroundTask(batch_runner.release, job)
+    )
+
+def validate_batch_item(item: dict):
+    try:
+        payload = ChatRequest.model_validate(item)
+    except ValidationError as e:
+        raise ValueError(validation_details(e.errors()))
+    if not payload.user_message:
+        raise ValueError("No message provided")
 
 @app.post("/transcribe")
-async def transcribe_audio(file: UploadFile = File(...)):
+async def transcribe_audio(request: Request, file: UploadFile = File(...)):
     temp_file_path = None
+    tenant = None
     try:
+        try:
+            tenant = await tenant_registry.acquire(tenant_id_for(request))
+        except UnknownTenant as e:
+            return unknown_tenant_response(e)
+        
         # Log the incoming file details
         logger.info(f"Received file: {file.filename} ({file.content_type})")
         
@@ -236,98 +480,94 @@ async def transcribe_audio(file: UploadFile = File(...)):
             file.content_type = "audio/mp4"  # Default for Safari
             logger.info(f"Using fallback MIME type: {file.content_type}")
         
-        # Read and validate file content
-        content = await file.read()
-        file_size = len(content)
-        logger.info(f"Received audio file size: {file_size} bytes")
+        # Spool the upload to disk in chunks instead of buffering it on the event loop
+        file_ext = os.path.splitext(file.filename)[1] if file.filename and '.' in file.filename else ".mp4"
+        temp_file_path = os.path.join(tempfile.gettempdir(), f"input_{uuid.uuid4()}{file_ext}")
+        with span("disk.write", kind="upload"):
+            file_size = await spool_upload(file, temp_file_path)
+        logger.info(f"Saved input file: {temp_file_path} ({file_size} bytes)")
         
         if file_size < 1000:
             error_msg = f"File too small: {file_size} bytes"
             logger.error(error_msg)
-            return JSONResponse(
-                status_code=400,
-                content={"error": "File too small", "details": error_msg}
-            )
-        
-        # Save the uploaded file
-        file_ext = os.path.splitext(file.filename)[1] if file.filename and '.' in file.filename else ".mp4"
-        temp_file_path = os.path.join(tempfile.gettempdir(), f"input_{uuid.uuid4()}{file_ext}")
-        with open(temp_file_path, "wb") as f:
-            f.write(content)
-        logger.info(f"Saved input file: {temp_file_path} ({os.path.getsize(temp_file_path)} bytes)")
+            return error_response(400, "File too small", error_msg)
         
         # Directly use the file with OpenAI Whisper API
         logger.info(f"Sending audio directly to Whisper API")
         
-        # Create a client with longer timeout for transcription
-        whisper_client = AsyncOpenAI(
-            api_key=api_key, 
-            http_client=httpx.AsyncClient(timeout=60.0, verify=True)  # Longer timeout
-        )
-        
         try:
-            with open(temp_file_path, "rb") as audio_file:
-                # Log API details for debugging
-                logger.info(f"OpenAI API key (first/last 3 chars): {api_key[:3]}...{api_key[-3:]}")
-                logger.info(f"File size being sent to API: {os.path.getsize(temp_file_path)} bytes")
-                
-                # Send to OpenAI Whisper API
-                transcript = await whisper_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="en"
+            with span("disk.read"):
+                audio_content = await read_bytes(temp_file_path)
+            
+            # Log API details for debugging
+            logger.info(f"OpenAI API key (first/last 3 chars): {api_key[:3]}...{api_key[-3:]}")
+            logger.info(f"File size being sent to API: {file_size} bytes")
+            
+            # Identical (or, with PCM fingerprinting, re-encoded) uploads share one Whisper call
+            cache_key = await content_key(audio_content, stt_backend.cache_id, "en")
+            envelope = None
+            # Decoding costs far more than the hash, so only when the exact upload isn't known
+            if pcm_fingerprint_enabled() and not transcription_cache.has(cache_key, partition=tenant.id):
+                with span("audio.fingerprint"):
+                    envelope = await pcm_fingerprint(temp_file_path)
+            
+            # Send to the speech-to-text backend (Whisper API by default)
+            with span("stt.transcribe", backend=stt_backend.name, bytes=file_size) as stt_span:
+                result, cache_status = await transcription_cache.get_or_transcribe(
+                    cache_key,
+                    lambda: transcribe_upload(temp_file_path, audio_content, file.content_type),
+                    partition=tenant.id,
+                    envelope=envelope
                 )
-                
-                # Log successful response
-                logger.info(f"Transcription successful. Text length: {len(transcript.text)}")
-                logger.info(f"Transcription text: {transcript.text[:100]}...")
-                
-                return {"transcription": transcript.text.strip()}
-                
+                stt_span.set(cache=cache_status)
+            
+            # Log successful response
+            text = result["text"]
+            logger.info(f"Transcription successful ({cache_status}). Text length: {len(text)}")
+            logger.info(f"Transcription text: {text[:100]}...")
+            
+            # Don't hand Whisper's silence hallucinations to the client as speech
+            verdict = transcript_filter.classify(text, result.get("language"), result.get("segments"))
+            if verdict.is_junk:
+                transcript_filter.record_avoided("chat", "tts")
+                annotate(filtered=verdict.reason)
+                return {"transcription": "", "filtered": True, "reason": verdict.reason}
+            
+            return {"transcription": verdict.text}
+            
         except httpx.TimeoutException:
             error_msg = "Transcription request timed out"
             logger.error(error_msg)
-            return JSONResponse(
-                status_code=504,
-                content={"error": "Transcription timed out", "details": error_msg}
-            )
+            return error_response(504, "Transcription timed out", error_msg)
         except httpx.HTTPStatusError as http_err:
             # This captures HTTP errors with the full response
             error_msg = f"HTTP error from OpenAI: {http_err.response.status_code}"
             logger.error(f"{error_msg} - Response: {http_err.response.text}")
-            return JSONResponse(
-                status_code=500,
-                content={"error": "OpenAI API error", "details": error_msg}
-            )
+            return error_response(500, "OpenAI API error", error_msg)
+        except Overloaded as e:
+            return overloaded_response(e)
         except Exception as e:
             # Log the full exception details
             logger.error("Error during Whisper API call:")
             logger.error(traceback.format_exc())
-            return JSONResponse(
-                status_code=500,
-                content={"error": "Transcription failed", "details": str(e)}
-            )
+            return error_response(500, "Transcription failed", str(e))
         
     except Exception as e:
         logger.error("Unhandled error in transcription endpoint:")
         logger.error(traceback.format_exc())
-        return JSONResponse(
-            status_code=500,
-            content={"error": "Transcription failed", "details": str(e)}
-        )
+        return error_response(500, "Transcription failed", str(e))
     finally:
+        if tenant is not None:
+            tenant.release()
         # Clean up temporary files
-        try:
-            if temp_file_path and os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+        with span("disk.remove"):
+            if await remove_quietly(temp_file_path):
                 logger.info(f"Cleaned up file: {temp_file_path}")
-        except Exception as e:
-            logger.error(f"Error cleaning up file {temp_file_path}: {str(e)}")
 
 @app.get("/{file_path:path}")
 async def serve_static(file_path: str):
     file_location = os.path.join(STATIC_BASE, file_path)
-    if os.path.isfile(file_location):
+    if await is_file(file_location):
         return FileResponse(file_location)
     else:
         raise HTTPException(status_code=404, detail=f"File {file_path} not found")
@@ -343,58 +583,425 @@ async def read_nag():
 @app.on_event("startup")
 async def on_startup():
     logger.info("App startup")
+    if monitor_enabled():
+        loop_monitor.start()
+    warm_up.add_step("connections", warm_connections)
+    warm_up.add_step("workers", warm_workers)
+    warm_up.add_step("tokenizer", warm_tokenizer)
+    warm_up.add_step("prompt", warm_prompt)
+    warm_up.add_step("phrases", warm_phrases)
+    audio_jobs.on_complete = notify_audio_job
+    audio_jobs.start()
+    governor.start()
+    await asyncio.to_thread(audio_store.open)
+    audio_store.start()
+    tenant_registry.on_load = on_tenant_load
+    tenant_registry.on_evict = on_tenant_evict
+    # Not blocking by default: the worker accepts traffic and /ready flips when done
+    pending = warm_up.start(blocking=warm_up_blocking())
+    if pending:
+        await pending
 
 @app.on_event("shutdown")
 async def on_shutdown():
     logger.info("App shutdown")
+    await warm_up.stop()
+    await audio_jobs.stop()
+    await governor.stop()
+    await tenant_registry.close()
+    await audio_store.stop()
+    audio_store.close()
+    await loop_monitor.stop()
+    await asyncio.to_thread(tracer.close)
+    transcoder.shutdown()
+    await stt_backend.shutdown()
+    await tts_router.shutdown()
+    await client.close()
+    await whisper_client.close()
 
-# -------------------- GPT & ElevenLabs --------------------
-async def get_gpt_response(prompt: str) -> str:
+# -------------------- Audio Jobs --------------------
+async def notify_audio_job(job):
+    """Push a finished audio job to the client that asked for it."""
+    message = {"type": "audio_ready" if job.status == "done" else "audio_failed", **job.to_dict()}
+    if await manager.send_to_client(job.client_id, message):
+        logger.info(f"Pushed audio job {job.id} to client {job.client_id}")
+
+# -------------------- Admission --------------------
+def overloaded_response(e: Overloaded) -> FastJSONResponse:
+    """429/503 with Retry-After for shed work."""
+    admission.record_rejection(e)
+    logger.warning(f"Shed request: {str(e)} ({e.status_code})")
+    return FastJSONResponse(
+        status_code=e.status_code,
+        content=overloaded_body(e),
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+# -------------------- Tenants --------------------
+def tenant_id_for(request: Request, tenant: Optional[str] = None) -> Optional[str]:
+    """Tenant named by the JSON body, the X-Tenant-Id header or the ?tenant= query parameter."""
+    return tenant or request.headers.get("x-tenant-id") or request.query_params.get("tenant")
+
+def unknown_tenant_response(e: UnknownTenant) -> FastJSONResponse:
+    error_msg = f"No profile for tenant {e.args[0]}"
+    logger.error(error_msg)
+    return error_response(404, "Unknown tenant", error_msg)
+
+phrase_tasks = set()
+
+async def on_tenant_load(tenant):
+    # The default tenant's phrases are rendered by the warm-up; others in the background
+    if not tenant.pinned:
+        tenant.lease()
+        task = asyncio.create_task(prerender_tenant_phrases(tenant))
+        phrase_tasks.add(task)
+        task.add_done_callback(phrase_tasks.discard)
+
+async def prerender_tenant_phrases(tenant):
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7
+        result = await prerender_phrases(tenant)
+        logger.info(f"Pre-rendered phrases for tenant {tenant.id}: {result}")
+    except Exception as e:
+        logger.warning(f"Pre-rendering phrases for tenant {tenant.id} failed: {str(e)}")
+    finally:
+        tenant.release()
+
+async def on_tenant_evict(tenant_id: str):
+    """Drop the evicted tenant's partition of every shared cache."""
+    dropped = semantic_cache.drop_tenant(tenant_id)
+    dropped += tts_router.phrases.drop_tenant(tenant_id)
+    dropped += transcription_cache.drop_partition(tenant_id)
+    logger.info(f"Dropped {dropped} cache entries of tenant {tenant_id}")
+
+# -------------------- Warm-up --------------------
+async def warm_connections():
+    """Open pooled connections (DNS, TCP, TLS) to the upstreams before the first request."""
+    async def touch_openai(openai_client):
+        try:
+            await openai_client.models.list()
+        except openai.APIStatusError:
+            pass  # Any HTTP response means the connection is open
+    
+    def touch_elevenlabs():
+        try:
+            tts_client.voices.get_all()
+        except ElevenLabsApiError:
+            pass
+    
+    await asyncio.gather(touch_openai(client), touch_openai(whisper_client), asyncio.to_thread(touch_elevenlabs))
+
+async def warm_workers():
+    """Start the process pools so models are loaded before the first request."""
+    transcoder.warm_up()
+    stt_backend.warm_up()
+    tts_router.warm_up()
+
+async def warm_tokenizer():
+    # tiktoken may fetch its encoding on first use; counts are estimated until then
+    return await asyncio.to_thread(token_accounting.load, model_router.models())
+
+async def warm_prompt():
+    tenant = await tenant_registry.get()
+    return {"prompt_chars": len(await get_system_prompt(tenant))}
+
+async def warm_phrases():
+    return await prerender_phrases(await tenant_registry.get())
+
+async def prerender_phrases(tenant):
+    """Render frequent replies into the tenant's phrase cache, reusing clips stored by earlier workers."""
+    voice_id = tenant.voice_id
+    extension = tts_router.primary.extension
+    rendered, reused, shed = 0, 0, 0
+    for phrase in load_phrases():
+        name = f"phrase_{tts_router.phrases.key(phrase, voice_id)}{extension}"
+        audio_url = await audio_store.named(name)
+        if audio_url:
+            reused += 1
+        else:
+            try:
+                backend, _, clips = await tts_router.synthesize_reply(phrase, voice_id, priority=BACKGROUND)
+            except Overloaded:
+                # Live traffic comes first; the phrase is synthesized on demand instead
+                shed += 1
+                continue
+            if backend.extension != extension:
+                continue  # Don't pin a fallback voice as the stock audio
+            audio_url = await audio_store.put(join_audio(clips, extension), extension, name=name)
+            rendered += 1
+        tts_router.phrases.put(phrase, voice_id, {"audio_url": audio_url, "audio_segments": [audio_url]}, tenant=tenant.id)
+    return {"rendered": rendered, "reused": reused, "shed": shed}
+
+# -------------------- Chat --------------------
+async def chat_turn(payload: ChatRequest, tenant, user_agent: str = "", priority: Optional[int] = None,
+                    capture: bool = True, use_cache: bool = True) -> dict:
+    """One chat turn for /chat and /chat/batch: filter, prompt, cache or GPT, memory, then TTS.
+    
+    Batch items pass capture=False and use the semantic cache only if their job opts in.
+    Raises Overloaded when the turn is shed; a TTS failure is reported in the reply."""
+    user_message = payload.user_message
+    mode = payload.mode.value
+    if priority is None:
+        priority = PRIORITIES.get(mode, 1)
+    
+    # Voice turns are transcripts; skip GPT and TTS for noise that slipped through
+    if payload.mode == ChatMode.VOICE:
+        verdict = transcript_filter.classify(user_message)
+        if verdict.is_junk:
+            transcript_filter.record_avoided("chat", "tts")
+            annotate(skipped=verdict.reason)
+            return {
+                "response": "",
+                "audio_url": None,
+                "tts_url": None,
+                "skipped": True,
+                "reason": verdict.reason
+            }
+    
+    # Create system prompt from context
+    with span("prompt.build"):
+        system_prompt = await get_system_prompt(tenant)
+    logger.info("[chat] Using personalized system prompt")
+    
+    # What this user has told the twin before; only ever shown to the same user
+    owner = payload.user_key
+    personal = []
+    if owner and tenant.capture.enabled:
+        with span("prompt.user_memories"):
+            personal = await asyncio.to_thread(tenant.store.recent_memories, 5, owner)
+    if personal:
+        lines = '\n'.join(f"- {m['content']}" for m in personal)
+        system_prompt = f"{system_prompt}\n\nWhat this user has told you before:\n{lines}"
+    
+    # Reworded repeats of a recent question reuse its reply (and audio); memories don't invalidate them
+    version = tenant.persona_version
+    cached = None
+    if use_cache:
+        with span("cache.semantic") as cache_span:
+            cached = semantic_cache.lookup(mode, user_message, version, tenant=tenant.id)
+            cache_span.set(hit=cached is not None)
+    
+    if cached:
+        assistant_message = cached["response"]
+        audio = cached["audio"]
+        if audio and not await audio_store.exists(audio["audio_url"]):
+            audio = None
+        logger.info(f"[chat] Semantic cache hit (similarity {cached['similarity']})")
+    else:
+        # Model, output cap and temperature depend on the mode, input length and latency SLO
+        route = model_router.route(mode, user_message)
+        async with admission.limit("chat", priority):
+            with span("openai.chat", model=route.model, route=route.reason) as chat_span:
+                response = await model_router.complete(
+                    client, route, model_router.messages(route, system_prompt, user_message)
+                )
+                chat_span.set(model=route.model, route=route.reason, **(route.usage or {}))
+        
+        assistant_message = response.choices[0].message.content
+        # Cut off at max_tokens: end on a full sentence so TTS doesn't read a fragment
+        if response.choices[0].finish_reason == "length":
+            assistant_message = trim_to_sentence(assistant_message)
+        audio = None
+        logger.info("[chat] Response generated")
+    
+    # Persisted in the background by the write-behind flusher
+    if capture:
+        tenant.capture.capture(user_message, assistant_message, mode, owner=owner)
+    
+    # The cache entry gets its audio once synthesis finishes; replies drawing on a user's memories aren't shared
+    cache_message = cached["message"] if cached else user_message
+    shareable = use_cache and (cached is not None or not personal)
+    if not cached and shareable:
+        semantic_cache.store(mode, user_message, version, assistant_message, audio, tenant=tenant.id)
+    
+    # Codec and bitrate for this client; the caches keep the canonical URLs
+    audio_format = audio_formats.negotiate(payload.audio_format, payload.device, payload.browser, user_agent)
+    annotate(audio_format=audio_format)
+    
+    async def synthesize(on_segment=None):
+        result = await generate_tts(assistant_message, tenant, priority, on_segment)
+        if shareable:
+            semantic_cache.update_audio(mode, cache_message, version, result, tenant=tenant.id)
+        return audio_formats.apply(result, audio_format)
+    
+    # Under resource pressure the reply goes out as text only
+    if audio is None and governor.text_only:
+        governor.degraded["tts_skipped"] += 1
+        annotate(degraded="text_only")
+        return {
+            "response": assistant_message,
+            "audio_url": None,
+            "audio_segments": [],
+            "tts_url": None,
+            "degraded": "text_only",
+            "cached": cached is not None
+        }
+    
+    # Opt-in: return the text now and deliver the audio over /ws (or polling)
+    if audio is None and payload.async_audio:
+        async def push_segment(index: int, count: int, url: str):
+            # Early playback: each sentence goes out as soon as it (and those before it) can be played
+            await manager.send_to_client(payload.client_id, {
+                "type": "audio_segment", "job_id": job.id, "request_id": payload.request_id,
+                "index": index, "count": count, "audio_url": audio_formats.tag(url, audio_format),
+            })
+        
+        async def synthesize_leased():
+            try:
+                return await synthesize(push_segment if push else None)
+            finally:
+                tenant.release()
+        
+        # Pushes only reach a socket held by this worker; anyone else polls
+        push = bool(payload.client_id) and payload.client_id in manager.clients
+        # The job outlives the request, so it keeps the tenant open on its own lease
+        tenant.lease()
+        job = audio_jobs.submit(
+            synthesize_leased,
+            priority=priority,
+            client_id=payload.client_id,
+            request_id=payload.request_id
         )
+        if not job:
+            tenant.release()
+        if job:
+            annotate(audio_job=job.id)
+            return {
+                "response": assistant_message,
+                "audio_url": None,
+                "tts_url": None,
+                "audio_job_id": job.id,
+                "audio_status": job.status,
+                "audio_push": push,
+                "audio_format": audio_format,
+                "cached": cached is not None
+            }
+    
+    # Generate TTS
+    try:
+        if audio is None:
+            audio = await synthesize()
+        else:
+            audio = audio_formats.apply(audio, audio_format)
+        audio = audio or {}
+        audio_url = audio.get("audio_url")
+        logger.info("[chat] TTS generated successfully")
+        return {
+            "response": assistant_message,
+            "audio_url": audio_url,
+            "audio_segments": audio.get("audio_segments", []),
+            "tts_url": audio_url,  # For backward compatibility
+            "audio_format": audio_format,
+            "cached": cached is not None
+        }
+    except Exception as e:
+        logger.error(f"[chat] TTS generation failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return {
+            "response": assistant_message,
+            "error": "TTS generation failed",
+            "audio_url": None,
+            "tts_url": None  # For backward compatibility
+        }
+
+# -------------------- GPT & ElevenLabs --------------------
+async def transcribe_upload(path: str, content: bytes, content_type: str) -> dict:
+    """Normalize an uploaded recording to compact mono audio, then transcribe it."""
+    normalized = None
+    try:
+        with span("audio.transcode") as transcode_span:
+            try:
+                normalized = await transcoder.transcode(path, len(content))
+            except Exception as e:
+                logger.warning(f"Transcoding failed, sending original audio: {str(e)}")
+            if normalized:
+                transcode_span.set(
+                    input_bytes=normalized.input_bytes,
+                    output_bytes=normalized.output_bytes,
+                    queue_ms=normalized.queue_ms,
+                    run_ms=normalized.run_ms
+                )
+        
+        # Long monologues are split at pauses and transcribed in parallel
+        if normalized and long_audio.likely_long(normalized.output_bytes):
+            with span("stt.chunked") as chunked_span:
+                try:
+                    result = await long_audio.transcribe(normalized.path, transcribe_limited)
+                except Overloaded:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Chunked transcription failed, sending whole recording: {str(e)}")
+                    result = None
+                if result:
+                    chunked_span.set(chunks=result["chunks"], duration=result["duration"])
+                    return result
+        
+        filename = os.path.basename(path)
+        if normalized:
+            with span("disk.read"):
+                content = await read_bytes(normalized.path)
+            filename, content_type = os.path.basename(normalized.path), normalized.content_type
+            logger.info(f"Transcoded upload {normalized.input_bytes} -> {normalized.output_bytes} bytes")
+        
+        return await transcribe_limited(content, filename, content_type)
+    finally:
+        if normalized:
+            await remove_quietly(normalized.path)
+
+async def transcribe_limited(*args, **kwargs) -> dict:
+    """Speech-to-text call holding an STT slot; transcription is always an interactive voice turn."""
+    async with admission.limit("stt", PRIORITIES["voice"]):
+        return await stt_backend.transcribe(*args, **kwargs)
+
+async def get_gpt_response(prompt: str, mode: str = ChatMode.CHAT.value) -> str:
+    try:
+        route = model_router.route(mode, prompt)
+        async with admission.limit("chat", PRIORITIES.get(mode, 1)):
+            with span("openai.chat", model=route.model, route=route.reason):
+                response = await model_router.complete(client, route, model_router.messages(route, None, prompt))
         return response.choices[0].message.content.strip()
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"GPT error: {str(e)}")
         raise HTTPException(status_code=500, detail="GPT generation failed")
 
-async def generate_tts(text: str) -> str:
+async def generate_tts(text: str, tenant, priority: int = 1,
+                       on_segment: Optional[Callable[[int, int, str], Awaitable[None]]] = None) -> Optional[dict]:
+    """Synthesize a reply in the tenant's voice, sentence by sentence; returns the full clip URL and per-sentence URLs.
+    
+    `on_segment(index, count, url)` is awaited as each sentence becomes playable, in order."""
+    voice_id = tenant.voice_id
     try:
-        voice_id = os.getenv("DINAKARA_VOICE_ID", "q8zvC54Cb4AB0IZViZqT")
         logger.info(f"Generating TTS with voice ID: {voice_id}")
         
-        # Get the audio as a generator
-        audio_generator = tts_client.generate(
-            text=text,
-            voice=voice_id,
-            model="eleven_monolingual_v1",
-            stream=False
-        )
+        stock = tts_router.phrases.get(text, voice_id, tenant=tenant.id)
+        if stock:
+            return stock
         
-        # Convert generator to bytes
-        if hasattr(audio_generator, '__iter__'):
-            # It's a generator, convert to bytes
-            audio_bytes = b''.join(chunk for chunk in audio_generator)
-        else:
-            # It's already bytes
-            audio_bytes = audio_generator
+        async def store_clip(index: int, count: int, clip: bytes, backend) -> None:
+            await on_segment(index, count, await audio_store.put(clip, backend.extension))
         
-        filename = f"audio_{uuid.uuid4()}.mp3"
-        filepath = os.path.join("static", "audio", filename)
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with span("tts.synthesize", chars=len(text)) as tts_span:
+            # The router takes a "tts" admission slot per sentence call
+            backend, sentences, clips = await tts_router.synthesize_reply(
+                text, voice_id, on_clip=store_clip if on_segment else None, priority=priority
+            )
+            tts_span.set(backend=backend.name, sentences=len(sentences))
         
-        with open(filepath, "wb") as f:
-            f.write(audio_bytes)
+        # Content-addressed, so repeated clips are stored once
+        with span("audio.store", bytes=sum(len(c) for c in clips)), governor.hold(2 * sum(len(c) for c in clips)):
+            segment_urls = list(await asyncio.gather(*(audio_store.put(clip, backend.extension) for clip in clips)))
+            if len(clips) > 1:
+                audio_url = await audio_store.put(join_audio(clips, backend.extension), backend.extension)
+            else:
+                audio_url = segment_urls[0]
         
-        audio_url = f"/static/audio/{filename}"
-        logger.info(f"TTS audio saved at: {audio_url}")
-        return audio_url
+        logger.info(f"TTS audio saved at: {audio_url} ({len(clips)} segments, {backend.name})")
+        return {"audio_url": audio_url, "audio_segments": segment_urls}
     except Exception as e:
         logger.error(f"TTS generation failed: {str(e)}")
-        return None
+        # Pre-rendered at startup, so the user still hears something
+        return tts_router.phrases.get(tts_failure_phrase(), voice_id, tenant=tenant.id)
 
 # -------------------- Local Debug --------------------
 if __name__ == "__main__":
@@ -414,56 +1021,59 @@ if __name__ == "__main__":
     server.run()
 
 # Context management
-DINAKARA_CONTEXT = {}
-BOOK_MEMORY = {}
+async def get_system_prompt(tenant):
+    """The tenant's system prompt, rebuilt only when its memory store has changed.
+    
+    Both the version check and the rebuild query SQLite, so they run off the event loop."""
+    version = await asyncio.to_thread(lambda: tenant.store.data_version)
+    if tenant.system_prompt is None or tenant.system_prompt_version != version:
+        prompt = await asyncio.to_thread(create_system_prompt, tenant)
+        tenant.system_prompt, tenant.system_prompt_version = prompt, version
+    return tenant.system_prompt
 
-def load_context_files():
-    """Load context from JSON files."""
+def create_system_prompt(tenant):
+    """Create a system prompt based on the tenant's stored context."""
     try:
-        # Load Dinakara's context
-        with open('data/dinakara_context_full.json', 'r') as f:
-            global DINAKARA_CONTEXT
-            DINAKARA_CONTEXT = json.load(f)
-            logger.info("Loaded Dinakara's context")
+        store, name, pronoun = tenant.store, tenant.profile.name, tenant.profile.pronoun
         
-        # Load book memory
-        with open('data/book_memory.json', 'r') as f:
-            global BOOK_MEMORY
-            BOOK_MEMORY = json.load(f)
-            logger.info("Loaded book memory")
-    except Exception as e:
-        logger.error(f"Error loading context files: {str(e)}")
-        logger.error(traceback.format_exc())
-
-def create_system_prompt():
-    """Create a system prompt based on the loaded context."""
-    try:
-        # Get Dinakara's personality traits
-        personality = DINAKARA_CONTEXT.get('personality', {})
+        # Get the twin's personality traits
+        personality = store.get_context('personality', {})
         traits = personality.get('traits', [])
         traits_str = ', '.join(traits)
         
-        # Get Dinakara's background
-        background = DINAKARA_CONTEXT.get('background', {})
-        background_str = background.get('summary', '')
+        # Get the twin's background
+        background_str = store.get_context('context', {}).get('background', '')
         
         # Get recent memories
-        memories = BOOK_MEMORY.get('recent_memories', [])
-        memories_str = '\n'.join([f"- {m}" for m in memories[:5]])  # Last 5 memories
+        memories = store.recent_memories(5)
+        memory_lines = [f"- {m['content']}" for m in memories]  # Last 5 memories
         
         # Create the system prompt
-        prompt = f"""You are Dinakara, a digital twin with the following personality traits: {traits_str}
+        def render(background_str, memories_str):
+            return f"""You are {name}, a digital twin with the following personality traits: {traits_str}
 
 Background: {background_str}
 
 Recent memories:
 {memories_str}
 
-You should respond as Dinakara would, using his personality traits and background to inform your responses. Be authentic to his character while maintaining appropriate boundaries."""
+You should respond as {name} would, using {pronoun} personality traits and background to inform your responses. Be authentic to {pronoun} character while maintaining appropriate boundaries."""
+        
+        # Newest memories first, as many as the system token budget leaves room for
+        model = model_router.primary_model
+        spare = model_router.system_budget() - token_accounting.count(render(background_str, ""), model)
+        if spare < 0:
+            background_str = token_accounting.truncate(background_str, token_accounting.count(background_str, model) + spare, model)
+        kept = token_accounting.fit_lines(memory_lines, max(0, spare), model)
+        if len(kept) < len(memory_lines):
+            logger.info(f"System prompt for tenant {tenant.id} keeps {len(kept)} of {len(memory_lines)} memories (token budget)")
+        prompt = render(background_str, '\n'.join(kept))
+        tenant.persona_version = prompt_version(render(background_str, ""))
         
-        logger.info("Created system prompt")
+        logger.info(f"Created system prompt for tenant {tenant.id}")
         return prompt
     except Exception as e:
         logger.error(f"Error creating system prompt: {str(e)}")
         logger.error(traceback.format_exc())
-        return "You are a helpful assistant."  # Fallback prompt
\ No newline at end of file
+        tenant.persona_version = prompt_version(None)
+        return "You are a helpful assistant."  # Fallback prompt
@@ -0,0 +1,213 @@
+"""Write-behind capture of memories from chat turns.
+
+`create_system_prompt` shows the twin's recent memories, but nothing ever
+wrote any. Now every completed `/chat` turn is handed to
+`MemoryCapture.capture`, which only appends to a bounded in-memory buffer
+(the oldest turn is dropped when it's full). A background task drains the
+buffer when MEMORY_FLUSH_SIZE turns are waiting or every
+MEMORY_FLUSH_INTERVAL seconds. For each batch it pulls candidate memories
+out of the turns, drops duplicates, and writes the rest to the memory
+store in one transaction. A crash loses at most one flush window.
+
+Candidates are the user's first-person statements about their own life
+("I finished Siddhartha last night", "My daughter starts school in June").
+Questions, greetings and fragments are skipped.
+
+Memories belong to the user who said them (the `owner`: their email, else
+their client id). They never go into the tenant's shared system prompt;
+`/chat` adds a user's own memories to that user's turns only. Turns
+without a user identity are not captured. When a flush fails, its turns
+are put back in front of the buffer as far as there is room; the oldest of
+them are dropped (and logged) rather than newer turns.
+
+Environment:
+    MEMORY_CAPTURE_ENABLED   capture memories from chat turns (default true)
+    MEMORY_BUFFER_SIZE       turns held before the oldest is dropped (default 256)
+    MEMORY_FLUSH_SIZE        flush once this many turns are waiting (default 16)
+    MEMORY_FLUSH_INTERVAL    seconds between time-triggered flushes (default 5)
+"""
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+from memory_store import MemoryStore, memory_hash, memory_store
+
+logger = logging.getLogger(__name__)
+
+_SENTENCE_RE = re.compile(r"[^.!?\n]+[.!?]?")
+_FIRST_PERSON_RE = re.compile(r"^(i|i'm|i've|i'll|i'd|my|we|we're|we've|our)\b", re.IGNORECASE)
+_SKIP_RE = re.compile(
+    r"^(i (think|guess|mean|don't know|wonder)|i'm (fine|good|ok|okay|not sure)|my (bad|pleasure))\b|\?$",
+    re.IGNORECASE
+)
+# Statements about these tend to matter later
+_SIGNAL_WORDS = {
+    "finished", "started", "reading", "read", "book", "goal", "plan", "decided", "moved", "job",
+    "daughter", "son", "wife", "husband", "mother", "father", "family", "friend", "love", "hate",
+    "afraid", "worried", "birthday", "anniversary", "learned", "quit", "joined",
+}
+
+def extract_candidates(user_message: str, min_words: int = 4, max_chars: int = 280) -> List[Dict[str, Any]]:
+    """First-person statements from a user message, with a rough importance score."""
+    candidates = []
+    for match in _SENTENCE_RE.finditer(user_message or ""):
+        sentence = match.group(0).strip()
+        words = re.findall(r"[\w']+", sentence.lower())
+        if len(words) < min_words or len(sentence) > max_chars:
+            continue
+        if not _FIRST_PERSON_RE.match(sentence) or _SKIP_RE.search(sentence):
+            continue
+        signal = len(_SIGNAL_WORDS.intersection(words))
+        candidates.append({
+            "content": f"User shared: {sentence.rstrip('.!')}.",
+            "importance": round(min(1.0, 0.4 + 0.2 * signal), 2),
+        })
+    return candidates
+
+class MemoryCapture:
+    def __init__(
+        self,
+        store: MemoryStore,
+        buffer_size: int = 256,
+        flush_size: int = 16,
+        flush_interval: float = 5.0,
+        enabled: bool = True
+    ):
+        self.store = store
+        self.enabled = enabled
+        self.flush_size = max(1, flush_size)
+        self.flush_interval = flush_interval
+        self._buffer: deque = deque(maxlen=buffer_size)
+        # Hashes written recently, so repeats are dropped without touching the database
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._recent_size = 4096
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.captured = 0
+        self.anonymous = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.candidates = 0
+        self.written = 0
+        self.duplicates = 0
+        self.failed_flushes = 0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name="memory-capture")
+
+    async def stop(self):
+        """Cancel the flusher and write whatever is still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def capture(self, user_message: str, assistant_message: str, mode: Optional[str] = None, owner: Optional[str] = None):
+        """Request path: O(1) append; extraction and persistence happen in the background."""
+        if not self.enabled:
+            return
+        if not owner:
+            # Nobody to scope the memory to, and a shared one would reach every user's prompt
+            self.anonymous += 1
+            return
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((time.time(), user_message, assistant_message, mode, owner))
+        self.captured += 1
+        if self._wake is not None and len(self._buffer) >= self.flush_size:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Drain the buffer into the store; returns memories written."""
+        if not self._buffer:
+            return 0
+        turns = [self._buffer.popleft() for _ in range(len(self._buffer))]
+        started = time.perf_counter()
+
+        batch, seen = [], set()
+        for captured_at, user_message, _, mode, owner in turns:
+            for candidate in extract_candidates(user_message):
+                self.candidates += 1
+                digest = memory_hash(candidate["content"], owner)
+                if digest in seen or digest in self._recent:
+                    self.duplicates += 1
+                    continue
+                seen.add(digest)
+                batch.append({**candidate, "source": f"chat:{mode or 'chat'}", "created_at": captured_at, "owner": owner})
+        if not batch:
+            return 0
+
+        try:
+            written = await asyncio.to_thread(self.store.add_memories, batch)
+        except Exception as e:
+            self.failed_flushes += 1
+            logger.error(f"Memory flush of {len(batch)} candidates failed: {str(e)}")
+            self._requeue(turns)
+            return 0
+        for digest in seen:
+            self._recent[digest] = None
+        while len(self._recent) > self._recent_size:
+            self._recent.popitem(last=False)
+
+        self.flushes += 1
+        self.written += written
+        self.duplicates += len(batch) - written
+        self.total_flush_ms += (time.perf_counter() - started) * 1000
+        if written:
+            logger.info(f"Captured {written} new memories from {len(turns)} chat turns")
+        return written
+
+    def _requeue(self, turns: List[tuple]):
+        """Put failed turns back in front of the buffer, keeping newer turns captured meanwhile."""
+        room = self._buffer.maxlen - len(self._buffer)
+        if room < len(turns):
+            lost = len(turns) - room
+            self.dropped += lost
+            logger.warning(f"Memory buffer full; dropped the {lost} oldest turns of the failed flush")
+            turns = turns[lost:]
+        self._buffer.extendleft(reversed(turns))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "buffered": len(self._buffer),
+            "buffer_size": self._buffer.maxlen,
+            "captured_turns": self.captured,
+            "anonymous_turns": self.anonymous,
+            "dropped_turns": self.dropped,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "candidates": self.candidates,
+            "written": self.written,
+            "duplicates": self.duplicates,
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 1) if self.flushes else None,
+        }
+
+def create_memory_capture(store: MemoryStore) -> MemoryCapture:
+    return MemoryCapture(
+        store,
+        buffer_size=int(os.getenv("MEMORY_BUFFER_SIZE", "256")),
+        flush_size=int(os.getenv("MEMORY_FLUSH_SIZE", "16")),
+        flush_interval=float(os.getenv("MEMORY_FLUSH_INTERVAL", "5")),
+        enabled=os.getenv("MEMORY_CAPTURE_ENABLED", "true").lower() == "true"
+    )
+
+memory_capture = create_memory_capture(memory_store)
@@ -0,0 +1,432 @@
+"""SQLite store for the twin's context and memories.
+
+Replaces loading data/dinakara_context_full.json and data/book_memory.json
+into globals. Everything lives in one SQLite database (WAL mode, so reads
+never block behind a write) with a typed table per kind of record:
+
+    context          twin context sections (personality, modes, ...) as JSON
+    books            currently_reading / completed / to_read
+    insights         dated reading insights
+    recommendations  books received / given
+    goals            reading goals
+    memories         timestamped memories, deduplicated by content hash; rows
+                     captured from chat have an owner (the user who said
+                     it) and are only read back for that user
+
+Books, insights and memories have FTS5 indexes kept in sync by triggers,
+and dated rows have B-tree indexes for range queries. Updates touch single
+rows; nothing rewrites the dataset. `data_version` increases on every
+write (from this or another process), so derived state such as the
+system prompt knows when to rebuild.
+
+On first open, `import_json` loads the legacy JSON files once; template
+rows with empty titles are skipped.
+
+Environment:
+    MEMORY_DB_PATH    database file (default data/memory.db)
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS context (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL CHECK (status IN ('currently_reading', 'completed', 'to_read')),
+    start_date TEXT,
+    completion_date TEXT,
+    added_date TEXT,
+    current_page INTEGER,
+    total_pages INTEGER,
+    rating REAL,
+    priority TEXT,
+    reason TEXT,
+    review TEXT,
+    notes TEXT NOT NULL DEFAULT '[]',
+    key_takeaways TEXT NOT NULL DEFAULT '[]',
+    updated_at REAL NOT NULL,
+    UNIQUE (title, author)
+);
+CREATE INDEX IF NOT EXISTS books_status ON books (status, updated_at);
+CREATE INDEX IF NOT EXISTS books_completion ON books (completion_date);
+CREATE TABLE IF NOT EXISTS insights (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    book TEXT NOT NULL DEFAULT '',
+    thoughts TEXT NOT NULL,
+    tags TEXT NOT NULL DEFAULT '[]',
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS insights_date ON insights (date);
+CREATE TABLE IF NOT EXISTS recommendations (
+    id INTEGER PRIMARY KEY,
+    direction TEXT NOT NULL CHECK (direction IN ('received', 'given')),
+    book TEXT NOT NULL,
+    person TEXT NOT NULL DEFAULT '',
+    date TEXT,
+    priority TEXT,
+    reason TEXT,
+    UNIQUE (direction, book, person)
+);
+CREATE TABLE IF NOT EXISTS goals (
+    id INTEGER PRIMARY KEY,
+    description TEXT NOT NULL UNIQUE,
+    target_date TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    progress REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY,
+    content TEXT NOT NULL,
+    content_hash TEXT NOT NULL UNIQUE,
+    source TEXT NOT NULL DEFAULT 'import',
+    importance REAL NOT NULL DEFAULT 0.5,
+    created_at REAL NOT NULL,
+    owner TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS memories_created ON memories (created_at);
+"""
+
+# Table: columns covered by its FTS5 index
+FTS_TABLES = {
+    "books": ["title", "author", "review"],
+    "insights": ["book", "thoughts", "tags"],
+    "memories": ["content"],
+}
+
+def _fts_schema(table: str, columns: List[str]) -> str:
+    cols = ", ".join(columns)
+    new_values = ", ".join(f"new.{c}" for c in columns)
+    old_values = ", ".join(f"old.{c}" for c in columns)
+    return f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5({cols}, content='{table}', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+    INSERT INTO {table}_fts (rowid, {cols}) VALUES (new.id, {new_values});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+    INSERT INTO {table}_fts ({table}_fts, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE ON {table} BEGIN
+    INSERT INTO {table}_fts ({table}_fts, rowid, {cols}) VALUES ('delete', old.id, {old_values});
+    INSERT INTO {table}_fts (rowid, {cols}) VALUES (new.id, {new_values});
+END;
+"""
+
+def memory_hash(content: str, owner: str = "") -> str:
+    normalized = " ".join((content or "").lower().split())
+    if owner:
+        # Two users saying the same thing get a memory each
+        normalized = f"{owner}\n{normalized}"
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def _fts_query(text: str) -> Optional[str]:
+    # Quote each term so user input can't inject FTS syntax; terms are ORed, ranked by bm25
+    terms = [t for t in "".join(c if c.isalnum() else " " for c in text).split() if len(t) > 1]
+    return " OR ".join(f'"{t}"' for t in terms) or None
+
+class MemoryStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._local_version = 0
+        self.writes = 0
+        self.searches = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.open()
+        return self._conn
+
+    def open(self):
+        with self._lock:
+            if self._conn is not None:
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SCHEMA + "".join(_fts_schema(t, c) for t, c in FTS_TABLES.items()))
+            self._migrate(conn)
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+            self._conn = conn
+            logger.info(f"Opened memory store {self.path}")
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection):
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(memories)")}
+        if "owner" not in columns:
+            conn.execute("ALTER TABLE memories ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            # Captured before memories had owners: nobody can be sure whose they are, so no prompt shows them
+            moved = conn.execute("UPDATE memories SET owner = 'unattributed' WHERE source LIKE 'chat:%'").rowcount
+            logger.info(f"Added memories.owner; {moved} captured memories marked unattributed")
+        conn.execute("CREATE INDEX IF NOT EXISTS memories_owner ON memories (owner, created_at)")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _write(self, sql: str, params: Iterable = ()) -> sqlite3.Cursor:
+        with self._lock:
+            cursor = self.conn.execute(sql, tuple(params))
+            self._changed()
+            return cursor
+
+    def _changed(self):
+        self._local_version += 1
+        self.writes += 1
+
+    @property
+    def data_version(self) -> int:
+        """Changes on every write, including commits by other processes sharing the file."""
+        if self._conn is None:
+            return self._local_version
+        with self._lock:
+            # PRAGMA data_version only moves for other connections' commits; ours are counted locally
+            return self._local_version + self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _read(self, sql: str, params: Iterable = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(row) for row in self.conn.execute(sql, tuple(params)).fetchall()]
+
+    def _meta(self, key: str) -> Optional[str]:
+        rows = self._read("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0]["value"] if rows else None
+
+    # -------------------- Import --------------------
+    def import_json(self, context_path: str, book_memory_path: str, force: bool = False) -> bool:
+        """Load the legacy JSON files once; returns True when an import ran."""
+        if self._meta("imported_json") and not force:
+            return False
+        context, book_memory = {}, {}
+        for path, target in ((context_path, context), (book_memory_path, book_memory)):
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    target.update(json.load(f))
+        with self._lock, self.transaction():
+            for key, value in context.items():
+                self.set_context(key, value)
+            books = book_memory.get("books", {})
+            for status in ("currently_reading", "completed", "to_read"):
+                for book in books.get(status, []):
+                    if book.get("title"):
+                        self.upsert_book(status=status, **book)
+            for insight in book_memory.get("reading_insights", []):
+                if insight.get("thoughts"):
+                    self.add_insight(insight.get("thoughts"), insight.get("book", ""), insight.get("tags", []), insight.get("date"))
+            for direction, key in (("received", "recommended_by"), ("given", "recommended_to")):
+                for rec in book_memory.get("recommendations", {}).get(direction, []):
+                    if rec.get("book"):
+                        self.add_recommendation(direction, rec["book"], rec.get(key, ""), rec.get("date"), rec.get("priority"), rec.get("reason"))
+            for goal in book_memory.get("goals", []):
+                if goal.get("description"):
+                    self.update_goal(goal["description"], goal.get("status", "pending"), goal.get("progress", 0), goal.get("target_date"))
+            for key in ("statistics", "reading_habits"):
+                if key in book_memory:
+                    self.set_context(f"book_{key}", book_memory[key])
+            self.add_memories([{"content": m, "source": "import"} for m in book_memory.get("recent_memories", [])])
+            self._write("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_json', ?)", (str(time.time()),))
+        logger.info(f"Imported {context_path} and {book_memory_path} into {self.path}")
+        return True
+
+    def transaction(self):
+        return _Transaction(self)
+
+    # -------------------- Context --------------------
+    def set_context(self, key: str, value: Any):
+        self._write(
+            "INSERT INTO context (key, value, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+            (key, json.dumps(value), time.time())
+        )
+
+    def get_context(self, key: str, default: Any = None) -> Any:
+        rows = self._read("SELECT value FROM context WHERE key = ?", (key,))
+        return json.loads(rows[0]["value"]) if rows else default
+
+    def context(self) -> Dict[str, Any]:
+        return {row["key"]: json.loads(row["value"]) for row in self._read("SELECT key, value FROM context")}
+
+    # -------------------- Books, insights, recommendations, goals --------------------
+    def upsert_book(self, title: str, status: str, author: str = "", **fields) -> int:
+        columns = ("start_date", "completion_date", "added_date", "current_page", "total_pages", "rating", "priority", "reason", "review")
+        values = {c: fields.get(c) for c in columns}
+        notes = json.dumps(fields.get("notes") or [])
+        takeaways = json.dumps(fields.get("key_takeaways") or [])
+        assignments = ", ".join(f"{c} = COALESCE(excluded.{c}, books.{c})" for c in columns)
+        cursor = self._write(
+            f"INSERT INTO books (title, author, status, {', '.join(columns)}, notes, key_takeaways, updated_at) "
+            f"VALUES (?, ?, ?, {', '.join('?' for _ in columns)}, ?, ?, ?) "
+            f"ON CONFLICT (title, author) DO UPDATE SET status = excluded.status, {assignments}, "
+            f"notes = excluded.notes, key_takeaways = excluded.key_takeaways, updated_at = excluded.updated_at",
+            (title, author or "", status, *values.values(), notes, takeaways, time.time())
+        )
+        return cursor.lastrowid
+
+    def books(self, status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        if status:
+            return self._read("SELECT * FROM books WHERE status = ? ORDER BY updated_at DESC LIMIT ?", (status, limit))
+        return self._read("SELECT * FROM books ORDER BY updated_at DESC LIMIT ?", (limit,))
+
+    def add_insight(self, thoughts: str, book: str = "", tags: Optional[List[str]] = None, date: Optional[str] = None) -> int:
+        return self._write(
+            "INSERT INTO insights (date, book, thoughts, tags, created_at) VALUES (?, ?, ?, ?, ?)",
+            (date or time.strftime("%Y-%m-%d"), book or "", thoughts, json.dumps(tags or []), time.time())
+        ).lastrowid
+
+    def insights_between(self, start_date: str, end_date: str, limit: int = 50) -> List[Dict[str, Any]]:
+        return self._read(
+            "SELECT * FROM insights WHERE date BETWEEN ? AND ? ORDER BY date DESC LIMIT ?",
+            (start_date, end_date, limit)
+        )
+
+    def add_recommendation(self, direction: str, book: str, person: str = "", date: Optional[str] = None,
+                           priority: Optional[str] = None, reason: Optional[str] = None):
+        self._write(
+            "INSERT OR IGNORE INTO recommendations (direction, book, person, date, priority, reason) VALUES (?, ?, ?, ?, ?, ?)",
+            (direction, book, person or "", date, priority, reason)
+        )
+
+    def recommendations(self, direction: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        if direction:
+            return self._read("SELECT * FROM recommendations WHERE direction = ? ORDER BY date DESC LIMIT ?", (direction, limit))
+        return self._read("SELECT * FROM recommendations ORDER BY date DESC LIMIT ?", (limit,))
+
+    def update_goal(self, description: str, status: str = "pending", progress: float = 0, target_date: Optional[str] = None):
+        self._write(
+            "INSERT INTO goals (description, target_date, status, progress, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (description) DO UPDATE SET status = excluded.status, progress = excluded.progress, "
+            "target_date = COALESCE(excluded.target_date, goals.target_date), updated_at = excluded.updated_at",
+            (description, target_date, status, progress, time.time())
+        )
+
+    def goals(self, status: Optional[str] = None) -> List[Dict[str, Any]]:
+        if status:
+            return self._read("SELECT * FROM goals WHERE status = ? ORDER BY updated_at DESC", (status,))
+        return self._read("SELECT * FROM goals ORDER BY updated_at DESC")
+
+    # -------------------- Memories --------------------
+    def add_memory(self, content: str, source: str = "chat", importance: float = 0.5, created_at: Optional[float] = None,
+                   owner: str = "") -> bool:
+        """Insert one memory; False when an identical one already exists."""
+        return self.add_memories([{
+            "content": content, "source": source, "importance": importance, "created_at": created_at, "owner": owner,
+        }]) == 1
+
+    def add_memories(self, memories: List[Dict[str, Any]]) -> int:
+        """Insert a batch in one transaction; duplicates (by normalized content and owner) are skipped. Returns rows added."""
+        rows = [
+            (m["content"].strip(), memory_hash(m["content"], m.get("owner") or ""), m.get("source") or "chat",
+             m.get("importance", 0.5), m.get("created_at") or time.time(), m.get("owner") or "")
+            for m in memories if (m.get("content") or "").strip()
+        ]
+        if not rows:
+            return 0
+        with self._lock, self.transaction():
+            # rowcount counts inserted rows only (not ignored duplicates or FTS trigger writes)
+            added = self.conn.executemany(
+                "INSERT OR IGNORE INTO memories (content, content_hash, source, importance, created_at, owner) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            ).rowcount
+            if added:
+                self._changed()
+        return added
+
+    def recent_memories(self, limit: int = 5, owner: str = "") -> List[Dict[str, Any]]:
+        """Newest memories of one owner; the default, "", is the twin's own, shown to every user."""
+        return self._read("SELECT * FROM memories WHERE owner = ? ORDER BY created_at DESC LIMIT ?", (owner, limit))
+
+    def memories_between(self, start: float, end: float, limit: int = 100, owner: str = "") -> List[Dict[str, Any]]:
+        return self._read(
+            "SELECT * FROM memories WHERE owner = ? AND created_at BETWEEN ? AND ? ORDER BY created_at DESC LIMIT ?",
+            (owner, start, end, limit)
+        )
+
+    def has_memory(self, content: str, owner: str = "") -> bool:
+        return bool(self._read("SELECT 1 FROM memories WHERE content_hash = ?", (memory_hash(content, owner),)))
+
+    # -------------------- Search --------------------
+    def search(self, text: str, kinds: Iterable[str] = ("memories", "insights", "books"), limit: int = 10,
+               owner: str = "") -> List[Dict[str, Any]]:
+        """Full-text search across the indexed tables, best matches first; memories of `owner` only."""
+        query = _fts_query(text)
+        if not query:
+            return []
+        self.searches += 1
+        results = []
+        for kind in kinds:
+            if kind not in FTS_TABLES:
+                continue
+            owned = " AND memories.owner = ?" if kind == "memories" else ""
+            rows = self._read(
+                f"SELECT {kind}.*, bm25({kind}_fts) AS score FROM {kind}_fts "
+                f"JOIN {kind} ON {kind}.id = {kind}_fts.rowid WHERE {kind}_fts MATCH ?{owned} ORDER BY score LIMIT ?",
+                (query, owner, limit) if owned else (query, limit)
+            )
+            results.extend({"kind": kind, **row} for row in rows)
+        return sorted(results, key=lambda r: r["score"])[:limit]
+
+    def stats(self) -> Dict[str, Any]:
+        counts = {}
+        for table in ("books", "insights", "recommendations", "goals", "memories"):
+            counts[table] = self._read(f"SELECT COUNT(*) AS n FROM {table}")[0]["n"]
+        return {
+            "path": self.path,
+            "rows": counts,
+            "data_version": self.data_version,
+            "writes": self.writes,
+            "searches": self.searches,
+            "db_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+        }
+
+class _Transaction:
+    """Re-entrant BEGIN/COMMIT around a block (the connection runs in autocommit mode)."""
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+        self.outer = False
+
+    def __enter__(self):
+        self.store._lock.acquire()
+        conn = self.store.conn
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+            self.outer = True
+        return conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.outer:
+                self.store.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.store._lock.release()
+
+memory_store = MemoryStore(os.getenv("MEMORY_DB_PATH", os.path.join("data", "memory.db")))
@@ -0,0 +1,354 @@
+"""Deterministic mock of the OpenAI and ElevenLabs endpoints used by the app.
+
+Run it next to the app and point the app at it:
+
+    python mock_upstream.py --port 9100 --scenario scenario.json
+    UPSTREAM_PROVIDER=mock MOCK_UPSTREAM_URL=http://127.0.0.1:9100 python run.py
+
+Latency, error rates and payload sizes come from a scenario (JSON file,
+MOCK_UPSTREAM_SCENARIO, or POST /_mock/scenario at runtime). Every random
+choice is drawn from an RNG seeded by (seed, endpoint, request number), so a
+replay with the same seed and request order sees the same behaviour.
+
+`/s3/{bucket}/{key}` is an in-memory stand-in for the S3 object calls used
+by the audio store (AUDIO_S3_ENDPOINT_URL=http://127.0.0.1:9100/s3).
+"""
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from typing import Dict, Any, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse, PlainTextResponse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCENARIO: Dict[str, Any] = {
+    "seed": 1234,
+    "chat": {
+        "base_ms": 400,
+        "jitter_ms": 150,
+        "per_token_ms": 15,
+        "response_words": [20, 80],
+        "stream_chunk_words": 3,
+        "error_rate": 0.0,
+        "error_status": 500,
+        "timeout_rate": 0.0,
+        "timeout_ms": 120000,
+    },
+    "transcription": {
+        "base_ms": 300,
+        "jitter_ms": 100,
+        "per_kb_ms": 2,
+        "texts": [
+            "Hey, how are you doing today?",
+            "I finished the book I was reading last week.",
+            "Can you remind me what my goals were for this month?",
+            "Thank you.",
+        ],
+        "no_speech_prob": 0.02,
+        "avg_logprob": -0.25,
+        "error_rate": 0.0,
+        "error_status": 500,
+        "timeout_rate": 0.0,
+        "timeout_ms": 120000,
+    },
+    "tts": {
+        "base_ms": 500,
+        "jitter_ms": 200,
+        "per_char_ms": 3,
+        "bytes_per_char": 400,
+        "stream_chunk_bytes": 4096,
+        "error_rate": 0.0,
+        "error_status": 500,
+        "timeout_rate": 0.0,
+        "timeout_ms": 120000,
+    },
+}
+
+WORDS = (
+    "reading memory thought journey habit insight focus calm story chapter goal "
+    "practice patience family morning coffee reflection progress balance curious"
+).split()
+
+# One silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz); repeated frames form a playable MP3
+MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x64]) + bytes(413)
+
+def merge_scenario(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]:
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(value)
+        else:
+            merged[key] = value
+    return merged
+
+class MockState:
+    def __init__(self, scenario: Optional[Dict[str, Any]] = None):
+        self.scenario = merge_scenario(DEFAULT_SCENARIO, scenario or {})
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = {"chat": 0, "transcription": 0, "tts": 0}
+        self.errors = {"chat": 0, "transcription": 0, "tts": 0}
+
+    def rng(self, endpoint: str) -> random.Random:
+        n = self.counters[endpoint]
+        self.counters[endpoint] += 1
+        return random.Random(f"{self.scenario['seed']}:{endpoint}:{n}")
+
+    def config(self, endpoint: str) -> Dict[str, Any]:
+        return self.scenario[endpoint]
+
+state = MockState()
+app = FastAPI(title="Nag Mock Upstream", version="1.0.0")
+
+async def apply_behaviour(endpoint: str, rng: random.Random, units: float, unit_key: str) -> Optional[Response]:
+    """Sleep for the scripted latency and return an error response if one was drawn."""
+    cfg = state.config(endpoint)
+    if rng.random() < cfg.get("timeout_rate", 0):
+        await asyncio.sleep(cfg.get("timeout_ms", 120000) / 1000)
+    latency_ms = cfg.get("base_ms", 0) + rng.uniform(0, cfg.get("jitter_ms", 0)) + units * cfg.get(unit_key, 0)
+    await asyncio.sleep(latency_ms / 1000)
+    if rng.random() < cfg.get("error_rate", 0):
+        state.errors[endpoint] += 1
+        return JSONResponse(
+            status_code=cfg.get("error_status", 500),
+            content={"error": {"message": f"Mock {endpoint} error", "type": "server_error"}}
+        )
+    return None
+
+def make_text(rng: random.Random, words_range) -> str:
+    low, high = words_range if isinstance(words_range, (list, tuple)) else (words_range, words_range)
+    count = rng.randint(int(low), int(high))
+    words = [rng.choice(WORDS) for _ in range(count)]
+    sentences = []
+    for i in range(0, len(words), 10):
+        sentence = " ".join(words[i:i + 10])
+        sentences.append(sentence[:1].upper() + sentence[1:] + ".")
+    return " ".join(sentences)
+
+def make_mp3(num_bytes: int) -> bytes:
+    frames = max(1, num_bytes // len(MP3_FRAME))
+    return MP3_FRAME * frames
+
+# -------------------- OpenAI: Models --------------------
+@app.get("/v1/models")
+async def models():
+    # Cheap call the app uses at startup to open its connection pools
+    names = ["gpt-4", "gpt-3.5-turbo", "whisper-1"]
+    return {"object": "list", "data": [{"id": name, "object": "model", "owned_by": "mock"} for name in names]}
+
+# -------------------- OpenAI: Chat Completions --------------------
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    rng = state.rng("chat")
+    cfg = state.config("chat")
+    model = body.get("model", "gpt-4")
+
+    text = make_text(rng, cfg["response_words"])
+    max_tokens = body.get("max_tokens")
+    words = text.split()
+    if max_tokens:
+        words = words[:max_tokens]
+        text = " ".join(words)
+    prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []))
+    usage = {
+        "prompt_tokens": prompt_chars // 4,
+        "completion_tokens": len(words),
+        "total_tokens": prompt_chars // 4 + len(words),
+    }
+    completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    if body.get("stream"):
+        # Time to first token is the base latency; the remaining tokens trickle in
+        error = await apply_behaviour("chat", rng, 0, "per_token_ms")
+        if error is not None:
+            return error
+
+        async def event_stream():
+            step = max(1, int(cfg.get("stream_chunk_words", 3)))
+            for i in range(0, len(words), step):
+                piece = " ".join(words[i:i + step]) + ("" if i + step >= len(words) else " ")
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(step * cfg.get("per_token_ms", 0) / 1000)
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    error = await apply_behaviour("chat", rng, len(words), "per_token_ms")
+    if error is not None:
+        return error
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": text},
+            "finish_reason": "length" if max_tokens and len(words) >= max_tokens else "stop",
+        }],
+        "usage": usage,
+    }
+
+# -------------------- OpenAI: Audio Transcriptions --------------------
+@app.post("/v1/audio/transcriptions")
+async def audio_transcriptions(request: Request):
+    form = await request.form()
+    upload = form.get("file")
+    content = await upload.read() if upload is not None else b""
+    rng = state.rng("transcription")
+    cfg = state.config("transcription")
+
+    error = await apply_behaviour("transcription", rng, len(content) / 1024, "per_kb_ms")
+    if error is not None:
+        return error
+
+    text = rng.choice(cfg["texts"])
+    response_format = form.get("response_format", "json")
+    if response_format == "text":
+        return PlainTextResponse(text)
+    if response_format == "verbose_json":
+        duration = round(max(1.0, len(content) / 16000), 2)
+        return {
+            "task": "transcribe",
+            "language": form.get("language") or "english",
+            "duration": duration,
+            "text": text,
+            "segments": [{
+                "id": 0,
+                "seek": 0,
+                "start": 0.0,
+                "end": duration,
+                "text": text,
+                "tokens": [],
+                "temperature": 0.0,
+                "avg_logprob": cfg.get("avg_logprob", -0.25),
+                "compression_ratio": 1.2,
+                "no_speech_prob": cfg.get("no_speech_prob", 0.02),
+            }],
+        }
+    return {"text": text}
+
+# -------------------- ElevenLabs: Text to Speech --------------------
+async def synthesize(voice_id: str, request: Request):
+    body = await request.json()
+    text = body.get("text", "")
+    rng = state.rng("tts")
+    cfg = state.config("tts")
+    error = await apply_behaviour("tts", rng, len(text), "per_char_ms")
+    if error is not None:
+        return None, error
+    return make_mp3(len(text) * int(cfg.get("bytes_per_char", 400))), None
+
+@app.post("/v1/text-to-speech/{voice_id}")
+async def text_to_speech(voice_id: str, request: Request):
+    audio, error = await synthesize(voice_id, request)
+    if error is not None:
+        return error
+    return Response(content=audio, media_type="audio/mpeg")
+
+@app.post("/v1/text-to-speech/{voice_id}/stream")
+async def text_to_speech_stream(voice_id: str, request: Request):
+    audio, error = await synthesize(voice_id, request)
+    if error is not None:
+        return error
+    chunk_size = int(state.config("tts").get("stream_chunk_bytes", 4096))
+
+    async def audio_stream():
+        for i in range(0, len(audio), chunk_size):
+            yield audio[i:i + chunk_size]
+            await asyncio.sleep(0)
+
+    return StreamingResponse(audio_stream(), media_type="audio/mpeg")
+
+@app.get("/v1/voices")
+async def voices():
+    return {"voices": [{"voice_id": "q8zvC54Cb4AB0IZViZqT", "name": "Dinakara"}]}
+
+# -------------------- S3 Stand-in --------------------
+s3_objects: Dict[tuple, tuple] = {}
+
+@app.put("/s3/{bucket}/{key:path}")
+async def s3_put_object(bucket: str, key: str, request: Request):
+    body = await request.body()
+    s3_objects[(bucket, key)] = (body, request.headers.get("content-type", "application/octet-stream"))
+    return Response(status_code=200, headers={"ETag": f'"{uuid.uuid5(uuid.NAMESPACE_OID, key).hex}"'})
+
+@app.api_route("/s3/{bucket}/{key:path}", methods=["GET", "HEAD"])
+async def s3_get_object(bucket: str, key: str, request: Request):
+    stored = s3_objects.get((bucket, key))
+    if stored is None:
+        error = "<Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message></Error>"
+        return Response(error if request.method == "GET" else b"", status_code=404, media_type="application/xml")
+    body, content_type = stored
+    return Response(body if request.method == "GET" else b"", media_type=content_type, headers={"Content-Length": str(len(body))})
+
+@app.delete("/s3/{bucket}/{key:path}")
+async def s3_delete_object(bucket: str, key: str):
+    s3_objects.pop((bucket, key), None)
+    return Response(status_code=204)
+
+# -------------------- Scenario Control --------------------
+@app.get("/_mock/scenario")
+async def get_scenario():
+    return state.scenario
+
+@app.post("/_mock/scenario")
+async def set_scenario(request: Request):
+    """Merge a partial scenario into the current one and restart the deterministic sequence."""
+    override = await request.json()
+    state.scenario = merge_scenario(DEFAULT_SCENARIO if override.pop("reset", False) else state.scenario, override)
+    state.reset_counters()
+    return state.scenario
+
+@app.get("/_mock/stats")
+async def get_stats():
+    return {"requests": state.counters, "errors": state.errors, "s3_objects": len(s3_objects)}
+
+def load_scenario(path: Optional[str]) -> Dict[str, Any]:
+    if not path:
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+state.scenario = merge_scenario(DEFAULT_SCENARIO, load_scenario(os.getenv("MOCK_UPSTREAM_SCENARIO")))
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Mock OpenAI / Whisper / ElevenLabs upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--scenario", help="Path to a scenario JSON file")
+    parser.add_argument("--seed", type=int, help="Override the scenario seed")
+    args = parser.parse_args()
+
+    state.scenario = merge_scenario(state.scenario, load_scenario(args.scenario))
+    if args.seed is not None:
+        state.scenario["seed"] = args.seed
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,216 @@
+"""Chooses the chat model, max_tokens and temperature per turn.
+
+Every turn used to go to gpt-4 with unbounded output. `ModelRouter.route`
+now picks by chat mode (chat/book/voice), input length and a rolling
+latency SLO:
+
+  * each mode has a primary model, an output cap, a prompt token budget
+    (enforced by token_accounting) and a temperature; voice turns get
+    short, spoken-style answers. A budget must leave room for twice
+    TOKEN_USER_FLOOR, and the system prompt is held to the smallest budget
+    less the floor, so the user's words are never trimmed away,
+  * short inputs (small talk) go to the fast model,
+  * when the primary's recent p95 for a mode breaches that mode's SLO, the
+    fast model takes over for MODEL_SLO_COOLDOWN seconds; the primary's
+    window for that mode is then cleared, so the next turns probe it again
+    and its fresh latency decides,
+  * if a primary call fails, it is retried once on the fast model.
+
+Decisions are counted by mode, model and reason for /debug/metrics.
+
+Environment:
+    CHAT_MODEL             primary model (default gpt-4)
+    CHAT_FAST_MODEL        fallback / small-talk model (default gpt-3.5-turbo)
+    SHORT_INPUT_CHARS      inputs up to this length count as small talk (default 40)
+    MODEL_SLO_COOLDOWN     seconds on the fast model after an SLO breach (default 60)
+    MODEL_ROUTER_CONFIG    JSON file of per-mode overrides, e.g.
+                           {"voice": {"max_tokens": 120, "prompt_budget": 1000, "slo_seconds": 2.5}}
+"""
+import json
+import logging
+import os
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from latency import LatencyWindow
+from token_accounting import token_accounting
+
+logger = logging.getLogger(__name__)
+
+VOICE_STYLE = (
+    "Your reply will be spoken aloud. Answer in one to three short, natural sentences "
+    "without lists, markdown or emoji."
+)
+
+DEFAULT_POLICIES = {
+    # mode: primary model, output cap, prompt token budget, temperature, p95 SLO in seconds, extra system instruction
+    "chat": {"model": None, "max_tokens": 400, "prompt_budget": 3000, "temperature": 0.7, "slo_seconds": 6.0, "style": None},
+    "book": {"model": None, "max_tokens": 800, "prompt_budget": 3000, "temperature": 0.7, "slo_seconds": 12.0, "style": None},
+    "voice": {"model": None, "max_tokens": 150, "prompt_budget": 1500, "temperature": 0.6, "slo_seconds": 3.0, "style": VOICE_STYLE},
+}
+
+class ModelRoute:
+    __slots__ = ("mode", "model", "max_tokens", "prompt_budget", "temperature", "reason", "fallback_model", "style", "usage")
+
+    def __init__(self, mode, model, max_tokens, temperature, reason, fallback_model=None, style=None, prompt_budget=None):
+        self.mode = mode
+        self.model = model
+        self.max_tokens = max_tokens
+        self.prompt_budget = prompt_budget
+        self.temperature = temperature
+        self.reason = reason
+        self.fallback_model = fallback_model
+        self.style = style
+        # Token usage of the completion, set by ModelRouter.complete
+        self.usage: Optional[Dict[str, Any]] = None
+
+    def request_args(self) -> Dict[str, Any]:
+        return {"model": self.model, "max_tokens": self.max_tokens, "temperature": self.temperature}
+
+class ModelRouter:
+    def __init__(
+        self,
+        primary_model: str = "gpt-4",
+        fast_model: str = "gpt-3.5-turbo",
+        short_input_chars: int = 40,
+        policies: Optional[Dict[str, Dict[str, Any]]] = None,
+        slo_cooldown: float = 60.0
+    ):
+        self.primary_model = primary_model
+        self.fast_model = fast_model
+        self.short_input_chars = short_input_chars
+        self.slo_cooldown = slo_cooldown
+        # Mode -> monotonic time until which its primary is bypassed after an SLO breach
+        self.bypass_until: Dict[str, float] = {}
+        self.policies = {mode: dict(policy) for mode, policy in DEFAULT_POLICIES.items()}
+        for mode, overrides in (policies or {}).items():
+            self.policies.setdefault(mode, dict(DEFAULT_POLICIES["chat"])).update(overrides)
+        for mode, policy in self.policies.items():
+            budget = policy.get("prompt_budget")
+            if budget and budget < 2 * token_accounting.user_floor:
+                raise ValueError(f"{mode} prompt_budget {budget} is below twice TOKEN_USER_FLOOR ({token_accounting.user_floor})")
+        if self.system_budget() < token_accounting.system_budget:
+            logger.info(f"System prompt budget lowered to {self.system_budget()} tokens to fit the smallest prompt budget")
+        # Latency per (mode, model): book replies are longer, so modes don't share a window
+        self._latency: Dict[Tuple[str, str], LatencyWindow] = {}
+        self.decisions: Counter = Counter()
+        self.fallbacks = 0
+        self.errors: Counter = Counter()
+
+    def _policy(self, mode: str) -> Dict[str, Any]:
+        return self.policies.get(mode) or self.policies["chat"]
+
+    def models(self) -> List[str]:
+        """Every model a route can pick."""
+        return sorted({self.primary_model, self.fast_model} | {p["model"] for p in self.policies.values() if p.get("model")})
+
+    def system_budget(self) -> int:
+        """TOKEN_SYSTEM_BUDGET, lowered so that every mode's prompt budget leaves the user message its floor."""
+        budgets = [p["prompt_budget"] for p in self.policies.values() if p.get("prompt_budget")]
+        if not budgets:
+            return token_accounting.system_budget
+        return min(token_accounting.system_budget, min(budgets) - token_accounting.user_floor)
+
+    def latency(self, mode: str, model: str) -> LatencyWindow:
+        key = (mode, model)
+        if key not in self._latency:
+            self._latency[key] = LatencyWindow(size=50)
+        return self._latency[key]
+
+    def route(self, mode: Optional[str], user_text: str) -> ModelRoute:
+        mode = str(getattr(mode, "value", mode) or "chat")
+        policy = self._policy(mode)
+        primary = policy.get("model") or self.primary_model
+        fast = self.fast_model
+
+        model, reason = primary, "primary"
+        if fast != primary:
+            window = self.latency(mode, primary)
+            p95 = window.percentile(95)
+            if len(user_text.strip()) <= self.short_input_chars:
+                model, reason = fast, "short_input"
+            elif time.monotonic() < self.bypass_until.get(mode, 0.0):
+                model, reason = fast, "slo_breach"
+            elif p95 is not None and len(window.samples) >= 5 and p95 > policy["slo_seconds"]:
+                # The primary gets no samples while bypassed, so the breach expires instead of waiting on the window
+                logger.warning(f"{primary} p95 {p95:.1f}s over the {mode} SLO; using {fast} for {self.slo_cooldown}s")
+                self.bypass_until[mode] = time.monotonic() + self.slo_cooldown
+                window.samples.clear()
+                model, reason = fast, "slo_breach"
+
+        self.decisions[(mode, model, reason)] += 1
+        return ModelRoute(
+            mode=mode,
+            model=model,
+            max_tokens=policy["max_tokens"],
+            temperature=policy["temperature"],
+            reason=reason,
+            fallback_model=fast if model != fast else None,
+            style=policy.get("style"),
+            prompt_budget=policy.get("prompt_budget")
+        )
+
+    def messages(self, route: ModelRoute, system_prompt: Optional[str], user_text: str) -> List[Dict[str, str]]:
+        system = "\n\n".join(part for part in (system_prompt, route.style) if part)
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": user_text})
+        return messages
+
+    async def complete(self, client, route: ModelRoute, messages: List[Dict[str, str]]):
+        """Create a chat completion for the route; a failed primary call is retried once on the fast model.
+
+        The prompt is fitted to the mode's token budget first, and the response's usage is recorded."""
+        sent, prompt_tokens = token_accounting.fit(route, messages)
+        started = time.perf_counter()
+        try:
+            response = await client.chat.completions.create(messages=sent, **route.request_args())
+        except Exception as e:
+            self.errors[route.model] += 1
+            # Failures count as slow so a run of them shifts traffic to the fast model
+            self.latency(route.mode, route.model).add(max(time.perf_counter() - started, self._policy(route.mode)["slo_seconds"]))
+            if not route.fallback_model:
+                raise
+            logger.warning(f"Model {route.model} failed ({str(e)}); retrying on {route.fallback_model}")
+            self.fallbacks += 1
+            route.model, route.reason, route.fallback_model = route.fallback_model, "error_fallback", None
+            self.decisions[(route.mode, route.model, route.reason)] += 1
+            return await self.complete(client, route, messages)
+        elapsed = time.perf_counter() - started
+        self.latency(route.mode, route.model).add(elapsed)
+        route.usage = token_accounting.record(route, prompt_tokens, response, elapsed)
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        decisions: Dict[str, Dict[str, int]] = {}
+        for (mode, model, reason), count in sorted(self.decisions.items()):
+            decisions.setdefault(mode, {})[f"{model}:{reason}"] = count
+        return {
+            "primary_model": self.primary_model,
+            "fast_model": self.fast_model,
+            "system_budget": self.system_budget(),
+            "decisions": decisions,
+            "fallbacks": self.fallbacks,
+            "slo_bypass": {mode: round(until - time.monotonic(), 1) for mode, until in self.bypass_until.items() if until > time.monotonic()},
+            "errors": dict(self.errors),
+            "latency": {f"{mode}:{model}": window.summary() for (mode, model), window in self._latency.items()},
+        }
+
+def _create_router() -> ModelRouter:
+    policies = {}
+    config_path = os.getenv("MODEL_ROUTER_CONFIG")
+    if config_path:
+        try:
+            with open(config_path, "r") as f:
+                policies = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading model router config {config_path}: {str(e)}")
+    return ModelRouter(
+        primary_model=os.getenv("CHAT_MODEL", "gpt-4"),
+        fast_model=os.getenv("CHAT_FAST_MODEL", "gpt-3.5-turbo"),
+        short_input_chars=int(os.getenv("SHORT_INPUT_CHARS", "40")),
+        policies=policies,
+        slo_cooldown=float(os.getenv("MODEL_SLO_COOLDOWN", "60"))
+    )
+
+model_router = _create_router()
@@ -0,0 +1,284 @@
+"""Semantic cache for chat replies.
+
+Users ask the twin the same things in slightly different words ("Tell me
+about your childhood", "Can you tell me about your childhood?"). Before the
+completion call, `/chat` embeds the message locally and looks for a past
+message in the same mode whose cosine similarity is at least
+SEMANTIC_CACHE_THRESHOLD; a hit reuses that reply (and its audio when the
+clip still exists).
+
+Embeddings are hashed word, bigram and character-trigram features in a
+fixed-size vector, with function words down-weighted: no model download, a
+few hundred microseconds per message on CPU. Normalization expands
+contractions, maps British spellings to American ones and reduces padded
+small talk ("how're you doing today?") to its plain form. After that they
+match rewordings that share content words (case, punctuation, a polite
+"can you"), not synonyms: "what do you do for work" and "... for a living"
+stay misses. A bag of features can't tell "should I quit" from "should I
+not quit", so a hit also needs the same guard words: negations ("not",
+"never", "least"), numbers and time words ("today", "next", "month") must
+match exactly. `tests/test_semantic_cache.py` holds the pairs the default
+threshold is calibrated against. Each mode keeps its own preallocated NumPy matrix, so a
+lookup is one vectorized matrix-vector product. When a partition is full
+the least recently used row is overwritten.
+
+Entries are tagged with the persona version (name, traits and background,
+not the memories that change every few turns); a new version clears the
+partition.
+
+Partitions are per tenant and mode, so twins never share replies; when a
+tenant is evicted from the registry, `drop_tenant` frees its matrices.
+
+Environment:
+    SEMANTIC_CACHE_SIZE        entries per mode (default 1024, 0 disables)
+    SEMANTIC_CACHE_THRESHOLD   minimum cosine similarity for a hit (default 0.85)
+    SEMANTIC_CACHE_MAX_CHARS   longer messages are not cached (default 300)
+    SEMANTIC_CACHE_TTL         seconds an entry stays valid (default 86400)
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 512
+
+_CONTRACTIONS = [
+    (re.compile(r"n't\b"), " not"),
+    (re.compile(r"'re\b"), " are"),
+    (re.compile(r"'s\b"), " is"),
+    (re.compile(r"'m\b"), " am"),
+    (re.compile(r"'ll\b"), " will"),
+    (re.compile(r"'ve\b"), " have"),
+    (re.compile(r"'d\b"), " would"),
+]
+_WORD_RE = re.compile(r"[a-z0-9]+")
+# British spellings map to American ones; hashed trigrams alone leave "favourite colour" far from "favorite color"
+_SPELLINGS = {
+    "favourite": "favorite", "favourites": "favorites", "colour": "color", "colours": "colors",
+    "honour": "honor", "humour": "humor", "behaviour": "behavior", "neighbour": "neighbor",
+    "neighbours": "neighbors", "flavour": "flavor", "labour": "labor", "harbour": "harbor",
+    "centre": "center", "theatre": "theater", "travelling": "traveling", "travelled": "traveled",
+    "realise": "realize", "realised": "realized", "organise": "organize", "apologise": "apologize",
+    "recognise": "recognize", "grey": "gray", "mum": "mom", "programme": "program",
+}
+# Small talk whose padding ("doing", "today") doesn't change the answer; matched on the whole normalized message
+_SMALL_TALK = [
+    (re.compile(r"^(?:(?:hi|hey|hello) )*how are you(?: doing| going| feeling)?(?: today| tonight| now| lately| these days)?$"), "how are you"),
+    (re.compile(r"^(?:(?:hi|hey|hello) )*how is it going(?: today| tonight| lately)?$"), "how are you"),
+    (re.compile(r"^(?:(?:hi|hey|hello) )*how is your day(?: going| been)?(?: today| so far)?$"), "how is your day"),
+]
+# Function words carry little meaning; down-weighting them keeps "your father" and "your mother" apart
+_STOPWORDS = frozenset(
+    "a an the is are am was were be been do does did i you your me my we our it its of to in on at for "
+    "and or but so what how who when where why which that this with about can could would will tell".split()
+)
+
+# Words that change a question's meaning without changing its bag of features
+_NEGATIONS = frozenset(
+    "not no never nothing none nobody nowhere neither nor without least less fewer hardly barely cannot".split()
+)
+_TEMPORAL = frozenset(
+    "today tonight tomorrow yesterday now then soon later recently ago before after next last this previous "
+    "current past future morning afternoon evening night day week weekend month year decade century "
+    "monday tuesday wednesday thursday friday saturday sunday always usually often sometimes ever once "
+    "first second third".split()
+)
+_NUMBER_WORDS = frozenset(
+    "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen "
+    "seventeen eighteen nineteen twenty thirty forty fifty sixty seventy eighty ninety hundred thousand "
+    "million half twice".split()
+)
+
+def normalize(text: str) -> str:
+    text = (text or "").lower().replace("’", "'")
+    for pattern, replacement in _CONTRACTIONS:
+        text = pattern.sub(replacement, text)
+    normalized = " ".join(_SPELLINGS.get(w, w) for w in _WORD_RE.findall(text))
+    for pattern, canonical in _SMALL_TALK:
+        if pattern.match(normalized):
+            return canonical
+    return normalized
+
+def _features(text: str) -> List[tuple]:
+    words = text.split()
+    features = [(f"w:{w}", 0.3 if w in _STOPWORDS else 1.0) for w in words]
+    features += [(f"b:{a} {b}", 0.5) for a, b in zip(words, words[1:])]
+    for word in words:
+        if word not in _STOPWORDS:
+            # Character trigrams soften typos and inflections ("sibling"/"siblings")
+            padded = f"<{word}>"
+            features += [(f"c:{padded[i:i + 3]}", 0.25) for i in range(len(padded) - 2)]
+    return features
+
+def guard_terms(normalized: str) -> frozenset:
+    """Negations, numbers and time words in a normalized message; a cache hit must have the same set."""
+    return frozenset(
+        w for w in normalized.split()
+        if w in _NEGATIONS or w in _TEMPORAL or w in _NUMBER_WORDS or w.isdigit()
+    )
+
+def _guard_key(text: str) -> int:
+    return zlib.crc32(" ".join(sorted(guard_terms(normalize(text)))).encode("utf-8"))
+
+def embed(text: str, dim: int = EMBEDDING_DIM) -> Optional[np.ndarray]:
+    """Signed feature hashing into a unit-length float32 vector; None for empty text."""
+    normalized = normalize(text)
+    if not normalized:
+        return None
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, weight in _features(normalized):
+        h = zlib.crc32(feature.encode("utf-8"))
+        vector[h % dim] += weight if (h >> 31) & 1 else -weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+def prompt_version(system_prompt: Optional[str]) -> str:
+    """Version tag for cache entries; pass the persona part of the prompt, not the memories."""
+    return hashlib.sha256((system_prompt or "").encode("utf-8")).hexdigest()[:16]
+
+class _Partition:
+    """Fixed-capacity embedding matrix for one mode."""
+
+    def __init__(self, capacity: int, dim: int):
+        self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        # Guard-word key per row; rows with another key can't be hits
+        self.guards = np.zeros(capacity, dtype=np.uint32)
+        self.entries: List[Optional[Dict[str, Any]]] = [None] * capacity
+        self.size = 0
+        self.version: Optional[str] = None
+
+    def clear(self, version: Optional[str]):
+        self.matrix[:] = 0
+        self.last_used[:] = 0
+        self.guards[:] = 0
+        self.entries = [None] * len(self.entries)
+        self.size = 0
+        self.version = version
+
+class SemanticCache:
+    def __init__(self, max_entries: int = 1024, threshold: float = 0.85, max_chars: int = 300, ttl: float = 86400.0, dim: int = EMBEDDING_DIM):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self.dim = dim
+        self._partitions: Dict[tuple, _Partition] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.guarded = 0
+        self.total_lookup_ms = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _partition(self, tenant: str, mode: str, version: str) -> _Partition:
+        partition = self._partitions.get((tenant, mode))
+        if partition is None:
+            partition = self._partitions[(tenant, mode)] = _Partition(self.max_entries, self.dim)
+            partition.version = version
+        elif partition.version != version:
+            if partition.size:
+                self.invalidations += 1
+                logger.info(f"Persona changed; cleared {partition.size} cached {mode} replies")
+            partition.clear(version)
+        return partition
+
+    def cacheable(self, text: str) -> bool:
+        return self.enabled and 0 < len(text.strip()) <= self.max_chars
+
+    def lookup(self, mode: str, text: str, version: str, tenant: str = "") -> Optional[Dict[str, Any]]:
+        """Return the cached entry for the most similar past message, or None."""
+        if not self.cacheable(text):
+            return None
+        started = time.perf_counter()
+        try:
+            partition = self._partition(tenant, mode, version)
+            vector = embed(text, self.dim)
+            if vector is None or not partition.size:
+                self.misses += 1
+                return None
+            scores = partition.matrix[:partition.size] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold and partition.guards[best] != _guard_key(text):
+                # Similar words, different meaning ("quit" / "not quit"): only rows with the same guards count
+                self.guarded += 1
+                scores = np.where(partition.guards[:partition.size] == _guard_key(text), scores, -1.0)
+                best = int(np.argmax(scores))
+            entry = partition.entries[best]
+            if scores[best] < self.threshold or entry is None or (self.ttl and time.time() - entry["stored_at"] > self.ttl):
+                self.misses += 1
+                return None
+            partition.last_used[best] = time.monotonic()
+            self.hits += 1
+            logger.info(f"Semantic cache hit ({scores[best]:.3f}): {text[:60]!r} ~ {entry['message'][:60]!r}")
+            return {**entry, "similarity": round(float(scores[best]), 3)}
+        finally:
+            self.total_lookup_ms += (time.perf_counter() - started) * 1000
+
+    def store(self, mode: str, text: str, version: str, response: str, audio: Optional[Dict[str, Any]] = None, tenant: str = ""):
+        if not self.cacheable(text) or not response:
+            return
+        vector = embed(text, self.dim)
+        if vector is None:
+            return
+        partition = self._partition(tenant, mode, version)
+        if partition.size < self.max_entries:
+            row = partition.size
+            partition.size += 1
+        else:
+            row = int(np.argmin(partition.last_used))
+            self.evictions += 1
+        partition.matrix[row] = vector
+        partition.last_used[row] = time.monotonic()
+        partition.guards[row] = _guard_key(text)
+        partition.entries[row] = {"message": text, "response": response, "audio": audio, "stored_at": time.time()}
+
+    def update_audio(self, mode: str, text: str, version: str, audio: Optional[Dict[str, Any]], tenant: str = ""):
+        """Replace the audio of the entry stored for exactly this message (after re-synthesis)."""
+        partition = self._partitions.get((tenant, mode))
+        if partition is None or partition.version != version:
+            return
+        for entry in partition.entries[:partition.size]:
+            if entry is not None and entry["message"] == text:
+                entry["audio"] = audio
+
+    def drop_tenant(self, tenant: str) -> int:
+        """Free every partition of a tenant; returns the entries dropped."""
+        dropped = 0
+        for key in [key for key in self._partitions if key[0] == tenant]:
+            dropped += self._partitions.pop(key).size
+        return dropped
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "entries": {"/".join(filter(None, key)): p.size for key, p in self._partitions.items()},
+            "max_entries_per_mode": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "guard_rejections": self.guarded,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "avg_lookup_ms": round(self.total_lookup_ms / lookups, 3) if lookups else None,
+        }
+
+semantic_cache = SemanticCache(
+    max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "1024")),
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85")),
+    max_chars=int(os.getenv("SEMANTIC_CACHE_MAX_CHARS", "300")),
+    ttl=float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+)
@@ -0,0 +1,141 @@
+"""Fast JSON for HTTP responses and WebSocket messages.
+
+Every reply used to go through FastAPI's jsonable_encoder and the stdlib
+encoder, and WebSocket messages were json.dumps'd per send. This module is
+the one place the app encodes JSON:
+
+* `dumps` / `dumps_text` / `loads` use orjson when it is installed (it is
+  in requirements.txt, but the app still runs without it) and compact
+  stdlib JSON otherwise. Both write NaN and Infinity as null, as orjson
+  does, so replies don't depend on which encoder a worker has.
+* `FastJSONResponse` is the app's default response class. Handlers that
+  return it directly skip jsonable_encoder as well.
+* `error_response` builds the compact `{"error", "details"}` envelope used
+  for every error reply, including request validation failures.
+
+Parse and encode times and sizes for HTTP bodies and WebSocket messages
+are in /debug/metrics under "serialization".
+
+Environment:
+    JSON_USE_ORJSON   use orjson when installed (default true)
+"""
+import enum
+import importlib.util
+import json
+import math
+import os
+import time
+from typing import Any, Dict, Optional
+
+from fastapi.responses import JSONResponse
+
+from latency import LatencyWindow
+
+HAS_ORJSON = importlib.util.find_spec("orjson") is not None and os.getenv("JSON_USE_ORJSON", "true").lower() == "true"
+
+if HAS_ORJSON:
+    import orjson
+    # Metrics have int keys (priorities) and the caches hold numpy values
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json")
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _finite(obj: Any) -> Any:
+    """A copy with NaN and Infinity replaced by None, matching orjson."""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, (str, int, bool)) or obj is None:
+        return obj
+    if isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return [_finite(value) for value in obj]
+    try:
+        return _finite(_default(obj))
+    except TypeError:
+        return obj
+
+def _dumps_stdlib(content: Any) -> bytes:
+    return json.dumps(content, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+def dumps(content: Any) -> bytes:
+    if HAS_ORJSON:
+        return orjson.dumps(content, default=_default, option=_ORJSON_OPTIONS)
+    try:
+        return _dumps_stdlib(content)
+    except ValueError:
+        # Out-of-range floats: only then pay for a copy
+        return _dumps_stdlib(_finite(content))
+
+def dumps_text(content: Any) -> str:
+    """For WebSocket text frames."""
+    return dumps(content).decode("utf-8")
+
+def loads(data) -> Any:
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class SerializationStats:
+    def __init__(self):
+        self.kinds: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, kind: str, seconds: float, size: int):
+        stats = self.kinds.get(kind)
+        if stats is None:
+            stats = self.kinds[kind] = {"count": 0, "bytes": 0, "time": LatencyWindow(500)}
+        stats["count"] += 1
+        stats["bytes"] += size
+        stats["time"].add(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        # Microseconds: most bodies encode well under a millisecond
+        report = {}
+        for kind, s in self.kinds.items():
+            window = s["time"]
+            p50, p95 = window.percentile(50), window.percentile(95)
+            report[kind] = {
+                "count": s["count"],
+                "avg_bytes": round(s["bytes"] / s["count"]) if s["count"] else None,
+                "p50_us": round(p50 * 1e6, 1) if p50 is not None else None,
+                "p95_us": round(p95 * 1e6, 1) if p95 is not None else None,
+            }
+        return {"encoder": "orjson" if HAS_ORJSON else "json", "kinds": report}
+
+serialization = SerializationStats()
+
+def encode_message(message: Any) -> str:
+    """A WebSocket message, timed."""
+    started = time.perf_counter()
+    text = dumps_text(message)
+    serialization.record("ws.encode", time.perf_counter() - started, len(text))
+    return text
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        started = time.perf_counter()
+        body = dumps(content)
+        serialization.record("http.encode", time.perf_counter() - started, len(body))
+        return body
+
+def error_response(status_code: int, error: str, details: str, headers: Optional[Dict[str, str]] = None) -> FastJSONResponse:
+    return FastJSONResponse(status_code=status_code, content={"error": error, "details": details}, headers=headers)
+
+def validation_details(errors) -> str:
+    """One line per pydantic error, e.g. "mode: Input should be 'chat', 'book' or 'voice'"."""
+    parts = []
+    for error in errors:
+        location = ".".join(str(part) for part in error.get("loc", ()) if part != "body")
+        parts.append(f"{location}: {error.get('msg')}" if location else str(error.get("msg")))
+    return "; ".join(parts)
@@ -194,6 +194,16 @@ function setupKeyboardControls() {
     });
 }
 
+// Stable id for this page, used to route pushed audio back to it
+function getClientId() {
+    if (!window.nagState.clientId) {
+        window.nagState.clientId = (window.crypto && window.crypto.randomUUID)
+            ? window.crypto.randomUUID()
+            : `client-${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    }
+    return window.nagState.clientId;
+}
+
 // WebSocket connection with fallback and reconnection
 function connectWebSocket() {
     try {
@@ -221,6 +231,9 @@ function connectWebSocket() {
             // Reset reconnect attempts
             window.nagState.wsReconnectAttempts = 0;
             
+            // Identify this client so audio jobs can be pushed to it
+            nagWebSocket.send(JSON.stringify({ type: 'hello', client_id: getClientId() }));
+            
             // Setup periodic ping to keep connection alive
             if (window.nagState.wsPingInterval) {
                 clearInterval(window.nagState.wsPingInterval);
@@ -293,6 +306,21 @@ function connectWebSocket() {
                             case 'command':
                                 handleServerCommand(data);
                                 break;
+                            case 'ack':
+                                break;
+                            case 'error':
+                                window.logDebug("WebSocket error from server: " + (data.details || data.error));
+                                break;
+                            case 'welcome':
+                                window.logDebug("Registered with server as " + data.client_id);
+                                break;
+                            case 'audio_segment':
+                                handleAudioSegment(data);
+                                break;
+                            case 'audio_ready':
+                            case 'audio_failed':
+                                handleAudioJobResult(data);
+                                break;
                             default:
                                 window.logDebug("Received unknown message type: " + (data.type || 'undefined'));
                         }
@@ -673,6 +701,7 @@ async function processAudioAndTranscribe() {
         window.logDebug("Sending audio for transcription...");
         const fetchPromise = fetch("/transcribe", {
             method: "POST",
+            headers: window.tenantHeaders({ "X-Client-Id": getClientId() }),
             body: formData
         });
         
@@ -681,7 +710,7 @@ async function processAudioAndTranscribe() {
         
         if (!response.ok) {
             const errorData = await response.json();
-            throw new Error(errorData.detail || "Transcription failed");
+            throw new Error(errorData.details || errorData.error || "Transcription failed");
         }
         
         const data = await response.json();
@@ -733,6 +762,8 @@ async function sendToChat(message) {
           message: message,
           mode: "voice",
           request_id: Date.now().toString(),
+          async_audio: true,
+          client_id: getClientId(),
           browser: window.nagState.isSafari ? "safari" : 
                    window.nagState.isChrome ? "chrome" : 
                    window.nagState.isFirefox ? "firefox" : 
@@ -744,9 +775,10 @@ async function sendToChat(message) {
       window.logDebug("Sending to chat endpoint...");
       const fetchPromise = fetch("/chat", {
           method: "POST",
-          headers: {
-              "Content-Type": "application/json"
-          },
+          headers: window.tenantHeaders({
+              "Content-Type": "application/json",
+              "X-Client-Id": getClientId()
+          }),
           body: JSON.stringify(requestData)
       });
       
@@ -755,7 +787,7 @@ async function sendToChat(message) {
       
       if (!response.ok) {
           const errorData = await response.json();
-          throw new Error(errorData.detail || "Chat response failed");
+          throw new Error(errorData.details || errorData.error || "Chat response failed");
       }
       
       const data = await response.json();
@@ -766,102 +798,16 @@ async function sendToChat(message) {
           window.addStatusMessage(data.response, "assistant");
       }
       
-      // Play audio if available
-      if (data.audio_url || data.tts_url) {
+      // Audio is synthesized in the background and pushed over the WebSocket
+      if (data.audio_job_id) {
+          window.logDebug(`Audio job queued: ${data.audio_job_id}`);
+          waitForAudioJob(data.audio_job_id, data.audio_push);
+      } else if (data.audio_url || data.tts_url) {
           const audioUrl = data.audio_url || data.tts_url;
           window.logDebug(`Audio URL: ${audioUrl}`);
-          
-          // Update UI
-          window.nagElements.orb.classList.remove("thinking");
-          window.nagElements.orb.classList.add("speaking");
-          
-          // Play audio
-          const audio = window.nagElements.audio;
-          
-          // Add cache-busting parameter to prevent caching issues
-          const cacheBuster = Date.now();
-          const urlWithCacheBuster = audioUrl.includes('?') 
-              ? `${audioUrl}&_cb=${cacheBuster}` 
-              : `${audioUrl}?_cb=${cacheBuster}`;
-          
-          audio.src = urlWithCacheBuster;
-          
-          // Set up event handlers
-          audio.onloadeddata = () => {
-              window.logDebug("Audio loaded, playing...");
-              audio.play().catch(error => {
-                  console.error("Error playing audio:", error);
-                  window.logDebug("Error playing audio: " + error.message);
-                  
-                  // Reset UI in case of error
-                  window.nagElements.orb.classList.remove("speaking");
-                  window.nagElements.orb.classList.add("idle");
-                  
-                  // Try showing play button as fallback
-                  if (window.showPlayButton) {
-                      window.showPlayButton(audioUrl);
-                  }
-              });
-          };
-          
-          audio.onended = () => {
-              window.logDebug("Audio playback ended");
-              // Reset UI
-              window.nagElements.orb.classList.remove("speaking");
-              window.nagElements.orb.classList.add("idle");
-              
-              // In continuous mode, start listening again if not paused
-              if (!window.nagState.isWalkieTalkieMode && 
-                  window.nagState.listening && 
-                  !window.nagState.isPaused) {
-                  startListening();
-              }
-          };
-          
-          audio.onerror = (event) => {
-              window.logDebug(`Audio playback error: ${event.type}`);
-              // Reset UI
-              window.nagElements.orb.classList.remove("speaking");
-              window.nagElements.orb.classList.add("idle");
-              
-              // Try showing play button as fallback
-              if (window.showPlayButton) {
-                  window.showPlayButton(audioUrl);
-              }
-          };
-          
-          // Handle stalled playback
-          audio.onstalled = () => {
-              window.logDebug("Audio playback stalled");
-          };
-          
-          // Handle audio timeupdate to monitor progress
-          audio.ontimeupdate = () => {
-              // Update progress if needed
-              if (window.nagState.showPlaybackProgress && window.nagElements.volumeBar) {
-                  const progress = (audio.currentTime / audio.duration) * 100;
-                  window.nagElements.volumeBar.style.width = `${progress}%`;
-              }
-          };
-          
-          // Set a maximum playback timeout
-          const maxPlaytime = setTimeout(() => {
-              if (audio.currentTime > 0 && !audio.paused) {
-                  window.logDebug("Maximum playback time reached");
-                  audio.pause();
-                  
-                  // Reset UI
-                  window.nagElements.orb.classList.remove("speaking");
-                  window.nagElements.orb.classList.add("idle");
-              }
-          }, 120000); // 2 minutes max
-          
-          // Clear timeout when audio ends
-          audio.addEventListener('ended', () => {
-              clearTimeout(maxPlaytime);
-          }, { once: true });
+          playChatAudio(audioUrl);
       } else {
-          window.logDebug("No audio URL in response");
+          window.logDebug(data.degraded ? `Text-only reply (server ${data.degraded})` : "No audio URL in response");
           // Reset UI
           window.nagElements.orb.classList.remove("thinking");
           window.nagElements.orb.classList.add("idle");
@@ -877,6 +823,231 @@ async function sendToChat(message) {
   }
 }
 
+// Play a chat reply's audio and return to listening when it ends
+// Time from having the clip URL to audible playback, per delivery format
+function reportTimeToPlay(audioUrl, elapsedMs) {
+    try {
+        const format = new URL(audioUrl, window.location.origin).searchParams.get('format') || 'original';
+        fetch('/audio/report', {
+            method: 'POST',
+            keepalive: true,
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ format: format, time_to_play_ms: Math.round(elapsedMs) })
+        }).catch(() => {});
+    } catch (error) {
+        window.logDebug("Could not report audio timing: " + error.message);
+    }
+}
+
+// onEnded, if given, runs when the clip ends; returning true means it started the next clip
+function playChatAudio(audioUrl, onEnded) {
+    // Update UI
+    window.nagElements.orb.classList.remove("thinking");
+    window.nagElements.orb.classList.add("speaking");
+    
+    // Play audio
+    const audio = window.nagElements.audio;
+    const requestedAt = performance.now();
+    
+    // Stored clips (/audio/<hash>) never change; only bust the cache for other URLs
+    const cacheBuster = Date.now();
+    const urlWithCacheBuster = audioUrl.startsWith('/audio/')
+        ? audioUrl
+        : audioUrl.includes('?')
+            ? `${audioUrl}&_cb=${cacheBuster}`
+            : `${audioUrl}?_cb=${cacheBuster}`;
+    
+    audio.src = urlWithCacheBuster;
+    
+    audio.onplaying = () => {
+        audio.onplaying = null;
+        reportTimeToPlay(audioUrl, performance.now() - requestedAt);
+    };
+    
+    // Set up event handlers
+    audio.onloadeddata = () => {
+        window.logDebug("Audio loaded, playing...");
+        audio.play().catch(error => {
+            console.error("Error playing audio:", error);
+            window.logDebug("Error playing audio: " + error.message);
+            
+            // Reset UI in case of error
+            window.nagElements.orb.classList.remove("speaking");
+            window.nagElements.orb.classList.add("idle");
+            
+            // Try showing play button as fallback
+            if (window.showPlayButton) {
+                window.showPlayButton(audioUrl);
+            }
+        });
+    };
+    
+    audio.onended = () => {
+        window.logDebug("Audio playback ended");
+        if (onEnded && onEnded()) {
+            return;
+        }
+        // Reset UI
+        window.nagElements.orb.classList.remove("speaking");
+        window.nagElements.orb.classList.add("idle");
+        
+        // In continuous mode, start listening again if not paused
+        if (!window.nagState.isWalkieTalkieMode && 
+            window.nagState.listening && 
+            !window.nagState.isPaused) {
+            startListening();
+        }
+    };
+    
+    audio.onerror = (event) => {
+        window.logDebug(`Audio playback error: ${event.type}`);
+        // Reset UI
+        window.nagElements.orb.classList.remove("speaking");
+        window.nagElements.orb.classList.add("idle");
+        
+        // Try showing play button as fallback
+        if (window.showPlayButton) {
+            window.showPlayButton(audioUrl);
+        }
+    };
+    
+    // Handle stalled playback
+    audio.onstalled = () => {
+        window.logDebug("Audio playback stalled");
+    };
+    
+    // Handle audio timeupdate to monitor progress
+    audio.ontimeupdate = () => {
+        // Update progress if needed
+        if (window.nagState.showPlaybackProgress && window.nagElements.volumeBar) {
+            const progress = (audio.currentTime / audio.duration) * 100;
+            window.nagElements.volumeBar.style.width = `${progress}%`;
+        }
+    };
+    
+    // Set a maximum playback timeout
+    const maxPlaytime = setTimeout(() => {
+        if (audio.currentTime > 0 && !audio.paused) {
+            window.logDebug("Maximum playback time reached");
+            audio.pause();
+            
+            // Reset UI
+            window.nagElements.orb.classList.remove("speaking");
+            window.nagElements.orb.classList.add("idle");
+        }
+    }, 120000); // 2 minutes max
+    
+    // Clear timeout when audio ends
+    audio.addEventListener('ended', () => {
+        clearTimeout(maxPlaytime);
+    }, { once: true });
+}
+
+// Track a background audio job: the server pushes "audio_ready" over the
+// WebSocket; poll /audio/jobs/{id} if the push doesn't arrive in time
+function waitForAudioJob(jobId, pushed) {
+    const pending = window.nagState.pendingAudioJobs;
+    pending[jobId] = { startedAt: Date.now() };
+    
+    const poll = async () => {
+        if (!pending[jobId]) {
+            return; // Delivered over the WebSocket
+        }
+        try {
+            const response = await fetch(`/audio/jobs/${jobId}`);
+            if (response.ok) {
+                const job = await response.json();
+                if (job.status === "done" || job.status === "failed") {
+                    handleAudioJobResult(job);
+                    return;
+                }
+            } else if (response.status === 404) {
+                handleAudioJobResult({ job_id: jobId, status: "failed", error: "Audio job expired" });
+                return;
+            }
+        } catch (e) {
+            window.logDebug("Error polling audio job: " + e.message);
+        }
+        if (Date.now() - pending[jobId].startedAt < 60000) {
+            pending[jobId].timer = setTimeout(poll, 1000);
+        } else {
+            handleAudioJobResult({ job_id: jobId, status: "failed", error: "Audio job timed out" });
+        }
+    };
+    
+    // Give the push a head start when the socket is up and held by the job's worker
+    const socketOpen = window.nagState.webSocket && window.nagState.webSocket.readyState === WebSocket.OPEN;
+    pending[jobId].timer = setTimeout(poll, socketOpen && pushed !== false ? 5000 : 1000);
+}
+
+// Early playback: the server pushes each sentence as "audio_segment" while
+// the rest are synthesized; play them in order as they arrive
+function handleAudioSegment(segment) {
+    if (!window.nagState.pendingAudioJobs[segment.job_id]) {
+        return; // Job already finished or timed out
+    }
+    const streams = window.nagState.audioStreams;
+    let stream = streams[segment.job_id];
+    if (!stream) {
+        stream = streams[segment.job_id] = { segments: [], next: 0, playing: false };
+    }
+    stream.segments[segment.index] = segment.audio_url;
+    stream.count = segment.count;
+    if (!stream.playing) {
+        playNextSegment(segment.job_id);
+    }
+}
+
+function playNextSegment(jobId) {
+    const stream = window.nagState.audioStreams[jobId];
+    const url = stream && stream.segments[stream.next];
+    if (!url) {
+        if (stream) {
+            stream.playing = false; // Waiting for the next push
+        }
+        return false;
+    }
+    stream.playing = true;
+    stream.next += 1;
+    window.logDebug(`Playing segment ${stream.next} of ${stream.count} for job ${jobId}`);
+    playChatAudio(url, () => {
+        if (stream.next >= stream.count) {
+            delete window.nagState.audioStreams[jobId];
+            return false; // Whole reply played: back to idle / listening
+        }
+        return playNextSegment(jobId) || true;
+    });
+    return true;
+}
+
+function handleAudioJobResult(job) {
+    const pending = window.nagState.pendingAudioJobs;
+    if (!pending[job.job_id]) {
+        return; // Already handled (push and poll can race)
+    }
+    clearTimeout(pending[job.job_id].timer);
+    delete pending[job.job_id];
+    
+    const stream = window.nagState.audioStreams[job.job_id];
+    if (stream) {
+        // Already playing sentence by sentence; the full clip would repeat it
+        window.logDebug(`Audio job ${job.job_id} finished while streaming segments`);
+        if (job.status !== "done" && !stream.playing) {
+            // The rest of the reply won't come
+            delete window.nagState.audioStreams[job.job_id];
+            window.nagElements.orb.classList.remove("speaking");
+            window.nagElements.orb.classList.add("idle");
+        }
+    } else if (job.status === "done" && job.audio_url) {
+        window.logDebug(`Audio ready for job ${job.job_id}: ${job.audio_url}`);
+        playChatAudio(job.audio_url);
+    } else {
+        window.logDebug(`Audio job ${job.job_id} failed: ${job.error || "unknown error"}`);
+        window.nagElements.orb.classList.remove("thinking");
+        window.nagElements.orb.classList.add("idle");
+    }
+}
+
 // Function to send a direct message to the server over WebSocket
 function sendWebSocketMessage(message, type = 'message') {
   try {
@@ -984,6 +1155,7 @@ window.stopListening = stopListening;
 window.unlockAudioContext = unlockAudioContext;
 window.processAudioAndTranscribe = processAudioAndTranscribe;
 window.sendToChat = sendToChat;
+window.playChatAudio = playChatAudio;
 window.sendWebSocketMessage = sendWebSocketMessage;
 window.initWebRTC = initWebRTC;
 window.toggleKeyboardControls = toggleKeyboardControls;
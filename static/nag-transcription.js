@@ -83,7 +83,7 @@ async function processAudioAndTranscribe() {
     
     if (!res.ok) {
       const errorData = await res.json();
-      throw new Error(errorData.detail || "Failed to transcribe audio");
+      throw new Error(errorData.details || errorData.error || "Failed to transcribe audio");
     }
     
     const data = await res.json();
@@ -154,7 +154,7 @@ async function sendToChat(message) {
     
     if (!res.ok) {
       const errorData = await res.json();
-      throw new Error(errorData.detail || "Failed to get response from Nag");
+      throw new Error(errorData.details || errorData.error || "Failed to get response from Nag");
     }
     
     const data = await res.json();
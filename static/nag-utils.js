@@ -132,6 +132,12 @@ function sleep(ms) {
     return new Promise(resolve => setTimeout(resolve, ms));
 }
 
+// Adds the X-Tenant-Id header when the page was opened for a specific twin (?tenant=...)
+function tenantHeaders(headers = {}) {
+    const tenant = window.nagState && window.nagState.tenant;
+    return tenant ? { ...headers, "X-Tenant-Id": tenant } : headers;
+}
+
 // Make utilities available globally
 window.addStatusMessage = addStatusMessage;
 window.logDebug = logDebug;
@@ -140,6 +146,7 @@ window.isMimeTypeSupported = isMimeTypeSupported;
 window.getBrowserInfo = getBrowserInfo;
 window.logBrowserInfo = logBrowserInfo;
 window.sleep = sleep;
+window.tenantHeaders = tenantHeaders;
 
 // Log browser info on load
 if (window.nagState) {
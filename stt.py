@@ -0,0 +1,314 @@
+"""Speech-to-text backends.
+
+`STTBackend` is the interface `/transcribe` (and whisper_api.router) use:
+`await backend.transcribe(content, filename, content_type)` returns
+{"text", "language", "segments"}, with segments carrying Whisper's
+confidence fields for the transcript filter.
+
+Backends:
+    openai  - OpenAI Whisper API (default)
+    local   - faster-whisper running a quantized Whisper model on CPU in a
+              worker process pool; models stay loaded in each worker and
+              each request is its own pool job, so concurrent requests run
+              on separate workers. A pool whose worker dies is replaced.
+    auto    - OpenAI first; falls back to local when the upstream call
+              exceeds STT_LATENCY_BUDGET, fails, or its recent p95 is over
+              budget (then local is used directly for STT_COOLDOWN seconds)
+
+Environment:
+    STT_BACKEND            openai, local or auto (default openai)
+    STT_LOCAL_MODEL        faster-whisper model name or path (default base.en)
+    STT_LOCAL_COMPUTE      CTranslate2 compute type (default int8)
+    STT_LOCAL_WORKERS      worker processes, each holding a model (default 1)
+    STT_LATENCY_BUDGET     seconds before auto falls back (default 8)
+    STT_COOLDOWN           seconds auto skips the upstream after p95 breaches (default 60)
+"""
+import asyncio
+import importlib.util
+import io
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Optional
+
+from latency import LatencyWindow
+from transcoder import process_pool_context
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_FIELDS = ("no_speech_prob", "avg_logprob", "compression_ratio")
+
+class STTBackend:
+    name = "base"
+
+    def __init__(self):
+        self.latency = LatencyWindow()
+        self.errors = 0
+
+    @property
+    def cache_id(self) -> str:
+        """Identifies results from this backend in the transcription cache."""
+        return self.name
+
+    async def transcribe(self, content: bytes, filename: str, content_type: str, language: str = "en") -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            result = await self._transcribe(content, filename, content_type, language)
+        except Exception:
+            self.errors += 1
+            raise
+        self.latency.add(time.perf_counter() - started)
+        return result
+
+    async def _transcribe(self, content: bytes, filename: str, content_type: str, language: str) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def warm_up(self):
+        """Load models or open connections ahead of the first request."""
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "errors": self.errors, **self.latency.summary()}
+
+class OpenAIWhisperBackend(STTBackend):
+    name = "openai"
+
+    def __init__(self, whisper_client, model: str = "whisper-1"):
+        super().__init__()
+        self.client = whisper_client
+        self.model = model
+
+    @property
+    def cache_id(self) -> str:
+        return self.model
+
+    async def _transcribe(self, content, filename, content_type, language):
+        transcript = await self.client.audio.transcriptions.create(
+            model=self.model,
+            file=(filename, content, content_type),
+            language=language,
+            response_format="verbose_json"
+        )
+        segments = []
+        for segment in getattr(transcript, "segments", None) or []:
+            if not isinstance(segment, dict):
+                segment = segment.model_dump()
+            segments.append({key: segment.get(key) for key in SEGMENT_FIELDS})
+        return {
+            "text": transcript.text,
+            "language": getattr(transcript, "language", None) or language,
+            "segments": segments
+        }
+
+# -------------------- Local Engine (worker side) --------------------
+_local_model = None
+
+def _init_local_worker(model_name: str, compute_type: str, cpu_threads: int):
+    """Pool initializer: load the model once per worker process and keep it resident."""
+    global _local_model
+    from faster_whisper import WhisperModel
+    _local_model = WhisperModel(model_name, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads)
+
+def _transcribe_job(content: bytes, language: str) -> Dict[str, Any]:
+    """Runs in a worker process; errors are returned, not raised, so they never look like a dead worker."""
+    try:
+        segments, info = _local_model.transcribe(io.BytesIO(content), language=language, beam_size=1, vad_filter=True)
+        segments = list(segments)
+        return {
+            "text": "".join(s.text for s in segments).strip(),
+            "language": info.language,
+            "segments": [{key: getattr(s, key, None) for key in SEGMENT_FIELDS} for s in segments],
+        }
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {str(e)}"}
+
+class LocalWhisperBackend(STTBackend):
+    name = "local"
+
+    def __init__(self, model: str = "base.en", compute_type: str = "int8", workers: int = 1):
+        super().__init__()
+        self.model = model
+        self.compute_type = compute_type
+        self.workers = max(1, workers)
+        self.available = importlib.util.find_spec("faster_whisper") is not None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.waiting = 0
+        self.pool_restarts = 0
+        if not self.available:
+            logger.warning("faster-whisper is not installed; local speech-to-text is unavailable")
+
+    @property
+    def cache_id(self) -> str:
+        return f"local:{self.model}"
+
+    def _ensure_started(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            cpu_threads = max(1, (os.cpu_count() or 2) // self.workers)
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=process_pool_context(),
+                initializer=_init_local_worker,
+                initargs=(self.model, self.compute_type, cpu_threads)
+            )
+            logger.info(f"Started local STT pool: model={self.model}, workers={self.workers}, threads/worker={cpu_threads}")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        return self._pool
+
+    def warm_up(self):
+        # Start the worker processes so each loads its model before the first request
+        if not self.available:
+            return
+        pool = self._ensure_started()
+        for _ in range(self.workers):
+            pool.submit(os.getpid)
+
+    async def _transcribe(self, content, filename, content_type, language):
+        if not self.available:
+            raise RuntimeError("Local speech-to-text backend is not available")
+        self._ensure_started()
+        # One request per pool job: each waits here for a free worker, so a
+        # cancelled request never reaches the pool and busy workers never queue
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            pool = self._ensure_started()
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(pool, _transcribe_job, content, language)
+            except BrokenProcessPool:
+                self._restart(pool)
+                raise RuntimeError("Local speech-to-text worker died; the pool was restarted")
+        finally:
+            self._slots.release()
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result
+
+    def _restart(self, pool: ProcessPoolExecutor):
+        """Drop a pool whose worker died (OOM, crash); the next request starts a new one."""
+        if self._pool is pool:
+            self._pool = None
+            self.pool_restarts += 1
+            logger.error("Local STT worker died; restarting the pool")
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            "available": self.available,
+            "model": self.model,
+            "workers": self.workers,
+            "waiting": self.waiting,
+            "pool_restarts": self.pool_restarts,
+        }
+
+class FallbackSTTBackend(STTBackend):
+    """Primary backend with a latency budget; the fallback takes over when it is slow or failing."""
+
+    name = "auto"
+
+    def __init__(self, primary: STTBackend, fallback: STTBackend, latency_budget: float = 8.0, cooldown: float = 60.0):
+        super().__init__()
+        self.primary = primary
+        self.fallback = fallback
+        self.latency_budget = latency_budget
+        self.cooldown = cooldown
+        self.bypass_until = 0.0
+        self.fallbacks = 0
+
+    def _primary_degraded(self) -> bool:
+        if time.monotonic() < self.bypass_until:
+            return True
+        p95 = self.primary.latency.percentile(95)
+        if p95 is not None and len(self.primary.latency.samples) >= 10 and p95 > self.latency_budget:
+            logger.warning(f"STT upstream p95 {p95:.1f}s over budget; using {self.fallback.name} for {self.cooldown}s")
+            self.bypass_until = time.monotonic() + self.cooldown
+            # Start fresh once the cooldown ends
+            self.primary.latency.samples.clear()
+            return True
+        return False
+
+    async def _transcribe(self, content, filename, content_type, language):
+        if not getattr(self.fallback, "available", True):
+            return await self.primary.transcribe(content, filename, content_type, language)
+        if not self._primary_degraded():
+            try:
+                return await asyncio.wait_for(
+                    self.primary.transcribe(content, filename, content_type, language),
+                    timeout=self.latency_budget
+                )
+            except asyncio.TimeoutError:
+                # Count the miss so a run of slow calls trips the p95 check
+                self.primary.latency.add(self.latency_budget)
+                logger.warning(f"STT upstream exceeded {self.latency_budget}s budget; falling back to {self.fallback.name}")
+            except Exception as e:
+                logger.warning(f"STT upstream failed ({str(e)}); falling back to {self.fallback.name}")
+        self.fallbacks += 1
+        return await self.fallback.transcribe(content, filename, content_type, language)
+
+    def warm_up(self):
+        self.primary.warm_up()
+        self.fallback.warm_up()
+
+    async def shutdown(self):
+        await self.primary.shutdown()
+        await self.fallback.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **super().stats(),
+            "fallbacks": self.fallbacks,
+            "bypassing_primary": time.monotonic() < self.bypass_until,
+            "primary": self.primary.stats(),
+            "fallback": self.fallback.stats(),
+        }
+
+# -------------------- Selection --------------------
+_backend: Optional[STTBackend] = None
+
+def _create_local_backend() -> LocalWhisperBackend:
+    return LocalWhisperBackend(
+        model=os.getenv("STT_LOCAL_MODEL", "base.en"),
+        compute_type=os.getenv("STT_LOCAL_COMPUTE", "int8"),
+        workers=int(os.getenv("STT_LOCAL_WORKERS", "1"))
+    )
+
+def configure_stt_backend(whisper_client, name: Optional[str] = None) -> STTBackend:
+    """Build the deployment's STT backend around an OpenAI-compatible Whisper client."""
+    global _backend
+    name = (name or os.getenv("STT_BACKEND", "openai")).lower()
+    if name == "local":
+        _backend = _create_local_backend()
+    elif name == "auto":
+        _backend = FallbackSTTBackend(
+            OpenAIWhisperBackend(whisper_client),
+            _create_local_backend(),
+            latency_budget=float(os.getenv("STT_LATENCY_BUDGET", "8")),
+            cooldown=float(os.getenv("STT_COOLDOWN", "60"))
+        )
+    elif name == "openai":
+        _backend = OpenAIWhisperBackend(whisper_client)
+    else:
+        raise ValueError(f"Unknown STT backend '{name}'. Available: openai, local, auto")
+    logger.info(f"Using speech-to-text backend: {_backend.name}")
+    return _backend
+
+def get_stt_backend() -> STTBackend:
+    if _backend is None:
+        from upstream import get_upstream_provider
+        configure_stt_backend(get_upstream_provider().create_whisper_client())
+    return _backend
@@ -0,0 +1,282 @@
+"""Tenant registry: many twins served from one worker.
+
+Each twin (tenant) has a profile: display name, ElevenLabs voice, legacy
+context / book memory JSON files and its own SQLite memory store. Profiles
+live in TENANTS_DIR as `<tenant_id>.json`, for example:
+
+    {"name": "Asha", "voice_id": "...", "pronoun": "her",
+     "context_file": "data/tenants/asha/context.json",
+     "book_memory_file": "data/tenants/asha/book_memory.json"}
+
+Missing fields fall back to `data/tenants/<id>/...`. The default tenant
+(DEFAULT_TENANT) needs no profile file: it is built from the original
+single-twin settings (DINAKARA_VOICE_ID, data/dinakara_context_full.json,
+MEMORY_DB_PATH) and uses the `memory_store` / `memory_capture` singletons.
+
+A tenant is loaded on its first request (profile read, memory store
+opened, JSON imported once) and kept in an LRU of at most
+TENANT_MAX_ACTIVE tenants. Evicting one flushes and closes its memory
+store, drops its system prompt and calls `on_evict` so the shared caches
+can drop that tenant's partition; per-worker memory is bounded by the
+number of active tenants, not the number of profiles. The default tenant
+is pinned.
+
+Requests hold a lease on their tenant (`acquire` ... `Tenant.release`, or
+`Tenant.lease` for work that outlives the request, like an audio job). An
+evicted tenant is closed only once its last lease is released, so a reply
+still being generated can capture memories and fill its cache partition,
+which is dropped after it finishes.
+
+Environment:
+    DEFAULT_TENANT        tenant used when a request names none (default dinakara)
+    TENANTS_DIR           directory of tenant profiles (default data/tenants)
+    TENANT_MAX_ACTIVE     tenants kept loaded per worker (default 32)
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from memory_capture import MemoryCapture, create_memory_capture, memory_capture
+from memory_store import MemoryStore, memory_store
+
+logger = logging.getLogger(__name__)
+
+_TENANT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+class UnknownTenant(KeyError):
+    pass
+
+class TenantProfile:
+    def __init__(self, tenant_id: str, fields: Dict[str, Any], base_dir: str):
+        directory = os.path.join(base_dir, tenant_id)
+        self.id = tenant_id
+        self.name = fields.get("name", tenant_id)
+        self.voice_id = fields.get("voice_id") or os.getenv("DINAKARA_VOICE_ID", "q8zvC54Cb4AB0IZViZqT")
+        self.pronoun = fields.get("pronoun", "their")
+        self.context_file = fields.get("context_file", os.path.join(directory, "context.json"))
+        self.book_memory_file = fields.get("book_memory_file", os.path.join(directory, "book_memory.json"))
+        self.db_path = fields.get("db_path", os.path.join(directory, "memory.db"))
+
+def default_profile(tenant_id: str, base_dir: str) -> TenantProfile:
+    """The original single-twin configuration."""
+    return TenantProfile(tenant_id, {
+        "name": "Dinakara",
+        "voice_id": os.getenv("DINAKARA_VOICE_ID", "q8zvC54Cb4AB0IZViZqT"),
+        "pronoun": "his",
+        "context_file": os.path.join("data", "dinakara_context_full.json"),
+        "book_memory_file": os.path.join("data", "book_memory.json"),
+        "db_path": memory_store.path,
+    }, base_dir)
+
+class Tenant:
+    """A loaded tenant: profile, memory store and per-tenant derived state."""
+
+    def __init__(self, profile: TenantProfile, store: MemoryStore, capture: MemoryCapture, pinned: bool = False):
+        self.profile = profile
+        self.store = store
+        self.capture = capture
+        self.pinned = pinned
+        self.system_prompt: Optional[str] = None
+        self.system_prompt_version: Optional[int] = None
+        # Name, traits and background only: the semantic cache survives new memories
+        self.persona_version: Optional[str] = None
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.requests = 0
+        self.leases = 0
+        self.evicted = False
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def lease(self):
+        """Keep the tenant open until the matching `release`."""
+        self.leases += 1
+        self.idle.clear()
+
+    def release(self):
+        self.leases -= 1
+        if self.leases <= 0:
+            self.leases = 0
+            self.idle.set()
+
+    @property
+    def id(self) -> str:
+        return self.profile.id
+
+    @property
+    def voice_id(self) -> str:
+        return self.profile.voice_id
+
+class TenantRegistry:
+    def __init__(self, default_id: str = "dinakara", base_dir: str = os.path.join("data", "tenants"), max_active: int = 32):
+        self.default_id = default_id
+        self.base_dir = base_dir
+        self.max_active = max(1, max_active)
+        self.on_load: Optional[Callable[[Tenant], Awaitable[None]]] = None
+        self.on_evict: Optional[Callable[[str], Awaitable[None]]] = None
+        self._active: "OrderedDict[str, Tenant]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self._closing = set()
+        self._evicting = set()
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.unknown = 0
+        self.total_load_ms = 0.0
+
+    def resolve(self, tenant_id: Optional[str]) -> str:
+        tenant_id = (tenant_id or "").strip() or self.default_id
+        if not _TENANT_ID_RE.match(tenant_id):
+            raise UnknownTenant(tenant_id)
+        return tenant_id
+
+    def _profile(self, tenant_id: str) -> TenantProfile:
+        path = os.path.join(self.base_dir, f"{tenant_id}.json")
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                return TenantProfile(tenant_id, json.load(f), self.base_dir)
+        if tenant_id == self.default_id:
+            return default_profile(tenant_id, self.base_dir)
+        raise UnknownTenant(tenant_id)
+
+    def _load(self, tenant_id: str) -> Tenant:
+        """Blocking: read the profile, open the store and import the JSON files on first use."""
+        profile = self._profile(tenant_id)
+        if tenant_id == self.default_id:
+            tenant = Tenant(profile, memory_store, memory_capture, pinned=True)
+        else:
+            store = MemoryStore(profile.db_path)
+            tenant = Tenant(profile, store, create_memory_capture(store))
+        tenant.store.open()
+        if tenant.store.import_json(profile.context_file, profile.book_memory_file):
+            logger.info(f"Imported {profile.name}'s context and book memory into the memory store")
+        return tenant
+
+    async def get(self, tenant_id: Optional[str] = None) -> Tenant:
+        """The loaded tenant, loading it (once, even under concurrent requests) on first use."""
+        try:
+            tenant_id = self.resolve(tenant_id)
+        except UnknownTenant:
+            self.unknown += 1
+            raise
+        tenant = self._active.get(tenant_id)
+        if tenant is not None:
+            self._active.move_to_end(tenant_id)
+            self.hits += 1
+        else:
+            loading = self._loading.get(tenant_id)
+            if loading is None:
+                loading = self._loading[tenant_id] = asyncio.ensure_future(self._activate(tenant_id))
+                loading.add_done_callback(lambda _: self._loading.pop(tenant_id, None))
+            try:
+                tenant = await asyncio.shield(loading)
+            except UnknownTenant:
+                self.unknown += 1
+                raise
+        tenant.last_used = time.time()
+        tenant.requests += 1
+        return tenant
+
+    async def acquire(self, tenant_id: Optional[str] = None) -> Tenant:
+        """Like `get`, with a lease the caller must `release`."""
+        while True:
+            tenant = await self.get(tenant_id)
+            # Evicted while this request waited for it to load: use the next instance
+            if not tenant.evicted:
+                tenant.lease()
+                return tenant
+
+    async def _activate(self, tenant_id: str) -> Tenant:
+        started = time.perf_counter()
+        tenant = await asyncio.to_thread(self._load, tenant_id)
+        tenant.capture.start()
+        self._active[tenant_id] = tenant
+        self.loads += 1
+        self.total_load_ms += (time.perf_counter() - started) * 1000
+        logger.info(f"Loaded tenant {tenant_id} ({len(self._active)} active)")
+        self._evict_overflow(keep=tenant_id)
+        if self.on_load:
+            tenant.lease()
+            try:
+                await self.on_load(tenant)
+            except Exception as e:
+                logger.error(f"Tenant {tenant_id} load hook failed: {str(e)}")
+            finally:
+                tenant.release()
+        return tenant
+
+    def _evict_overflow(self, keep: Optional[str] = None):
+        """Evict least recently used tenants down to max_active, never the one just loaded (`keep`)."""
+        while len(self._active) > self.max_active:
+            # With max_active 1 the newcomer would otherwise evict itself and `acquire` would reload it forever
+            victim = next((t for t in self._active.values() if not t.pinned and t.id != keep), None)
+            if victim is None:
+                return
+            del self._active[victim.id]
+            victim.evicted = True
+            self.evictions += 1
+            task = asyncio.ensure_future(self._close(victim))
+            self._closing.add(task)
+            self._evicting.add(victim)
+            task.add_done_callback(self._closing.discard)
+            task.add_done_callback(lambda _, victim=victim: self._evicting.discard(victim))
+
+    async def _close(self, tenant: Tenant):
+        """Once the last request using it is done, flush and close an evicted tenant's store and drop its cache partitions."""
+        try:
+            if tenant.leases:
+                logger.info(f"Tenant {tenant.id} evicted; closing after {tenant.leases} requests release it")
+            await tenant.idle.wait()
+            await tenant.capture.stop()
+            await asyncio.to_thread(tenant.store.close)
+            # Reloaded meanwhile: the partitions belong to the new instance
+            if self.on_evict and tenant.id not in self._active:
+                await self.on_evict(tenant.id)
+            logger.info(f"Evicted tenant {tenant.id}")
+        except Exception as e:
+            logger.error(f"Error evicting tenant {tenant.id}: {str(e)}")
+
+    def active(self):
+        return list(self._active.values())
+
+    def _draining(self):
+        return [tenant for tenant in self._evicting if tenant.leases]
+
+    async def close(self):
+        """Shutdown: flush and close every loaded tenant."""
+        for tenant in self._draining():
+            # Work still holding a lease was cancelled with its queue; don't wait on it
+            tenant.idle.set()
+        await asyncio.gather(*self._closing, return_exceptions=True)
+        for tenant in list(self._active.values()):
+            await tenant.capture.stop()
+            tenant.store.close()
+        self._active.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "default": self.default_id,
+            "active": len(self._active),
+            "max_active": self.max_active,
+            "loads": self.loads,
+            "hits": self.hits,
+            "evictions": self.evictions,
+            "draining": len(self._draining()),
+            "unknown": self.unknown,
+            "avg_load_ms": round(self.total_load_ms / self.loads, 1) if self.loads else None,
+            "tenants": {
+                t.id: {"requests": t.requests, "idle_s": round(time.time() - t.last_used, 1), "pinned": t.pinned}
+                for t in self._active.values()
+            },
+        }
+
+tenant_registry = TenantRegistry(
+    default_id=os.getenv("DEFAULT_TENANT", "dinakara"),
+    base_dir=os.getenv("TENANTS_DIR", os.path.join("data", "tenants")),
+    max_active=int(os.getenv("TENANT_MAX_ACTIVE", "32"))
+)
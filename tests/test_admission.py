@@ -0,0 +1,144 @@
+"""PriorityLimiter hand-off and per-peer client buckets.
+
+Run from the repository root: python -m unittest discover -s tests
+"""
+import asyncio
+import unittest
+
+from admission import AdmissionController, ClientBuckets, Overloaded, PriorityLimiter
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+class PriorityLimiterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_grants_free_slots_immediately(self):
+        limiter = PriorityLimiter("test", limit=2)
+        await limiter.acquire()
+        await limiter.acquire()
+        self.assertEqual(limiter.in_flight, 2)
+        self.assertEqual(limiter.waiting, 0)
+        limiter.release()
+        limiter.release()
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_release_hands_the_slot_to_the_best_waiter(self):
+        limiter = PriorityLimiter("test", limit=1)
+        await limiter.acquire()
+        order = []
+
+        async def waiter(name, priority):
+            await limiter.acquire(priority)
+            order.append(name)
+
+        book = asyncio.create_task(waiter("book", 2))
+        await settle()
+        voice = asyncio.create_task(waiter("voice", 0))
+        await settle()
+        self.assertEqual(limiter.waiting, 2)
+
+        limiter.release()
+        await settle()
+        # The slot moves straight to the waiter, never back to the pool
+        self.assertEqual(order, ["voice"])
+        self.assertEqual(limiter.in_flight, 1)
+
+        limiter.release()
+        await asyncio.gather(book, voice)
+        self.assertEqual(order, ["voice", "book"])
+        limiter.release()
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.waiting, 0)
+
+    async def test_cancelled_waiter_is_skipped(self):
+        limiter = PriorityLimiter("test", limit=1)
+        await limiter.acquire()
+        gone = asyncio.create_task(limiter.acquire(0))
+        await settle()
+        gone.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await gone
+        self.assertEqual(limiter.waiting, 0)
+
+        limiter.release()
+        self.assertEqual(limiter.in_flight, 0)
+        await limiter.acquire()
+        self.assertEqual(limiter.in_flight, 1)
+
+    async def test_slot_granted_to_a_cancelled_waiter_is_passed_on(self):
+        limiter = PriorityLimiter("test", limit=1)
+        await limiter.acquire()
+        entered = []
+
+        async def user(name, priority):
+            async with limiter.slot(priority):
+                entered.append(name)
+
+        first = asyncio.create_task(user("first", 0))
+        second = asyncio.create_task(user("second", 1))
+        await settle()
+        # Grant and cancel before the first waiter gets to run
+        limiter.release()
+        first.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+
+        # Whether or not the cancelled waiter used the slot, it reached the next one and came back
+        self.assertIn("second", entered)
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.waiting, 0)
+
+    async def test_timeout_sheds_and_leaves_counts_consistent(self):
+        limiter = PriorityLimiter("test", limit=1, max_wait=0.05)
+        await limiter.acquire()
+        with self.assertRaises(Overloaded) as raised:
+            await limiter.acquire()
+        self.assertEqual(raised.exception.status_code, 503)
+        self.assertEqual(limiter.timeouts, 1)
+        self.assertEqual(limiter.waiting, 0)
+
+        # The timed-out waiter must not be handed the slot later
+        limiter.release()
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_full_queue_sheds_without_waiting(self):
+        limiter = PriorityLimiter("test", limit=1, max_queue=1)
+        await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await settle()
+        with self.assertRaises(Overloaded):
+            await limiter.acquire()
+        self.assertEqual(limiter.shed, 1)
+        limiter.release()
+        await queued
+        limiter.release()
+        self.assertEqual(limiter.in_flight, 0)
+
+class ClientKeyTest(unittest.TestCase):
+    def controller(self):
+        return AdmissionController(
+            ClientBuckets(rate=0.001, burst=2),
+            {},
+            peers=ClientBuckets(rate=0.001, burst=4)
+        )
+
+    def test_client_ids_split_a_peer_allowance(self):
+        admission = self.controller()
+        admission.admit("10.0.0.1", "a", None)
+        admission.admit("10.0.0.1", "a", None)
+        with self.assertRaises(Overloaded) as raised:
+            admission.admit("10.0.0.1", "a", None)
+        self.assertEqual(raised.exception.status_code, 429)
+        # Another client behind the same address has its own bucket
+        admission.admit("10.0.0.1", "b", None)
+
+    def test_rotating_client_ids_cannot_exceed_the_peer_bucket(self):
+        admission = self.controller()
+        for i in range(4):
+            admission.admit("10.0.0.1", f"id-{i}", None)
+        with self.assertRaises(Overloaded):
+            admission.admit("10.0.0.1", "id-new", None)
+        # Other addresses are unaffected
+        admission.admit("10.0.0.2", "id-new", None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Semantic cache hits and misses at the default threshold.
+
+Run from the repository root: python -m unittest discover -s tests
+"""
+import unittest
+
+from semantic_cache import SemanticCache, guard_terms, normalize
+
+# Rewordings that should reuse the stored reply
+HITS = [
+    ("how are you", "how're you doing today?"),
+    ("hey, how is it going?", "How are you?"),
+    ("what is your favorite book", "what's your favourite book?"),
+    ("what's your favorite color", "What is your favourite colour?"),
+    ("Tell me about your childhood", "Can you tell me about your childhood?"),
+    ("do you have any siblings", "Do you have siblings?"),
+    ("I'm not sure what to do", "i am not sure what to do"),
+]
+
+# Similar wording, different question
+MISSES = [
+    ("what is your favorite movie", "what is your favorite book"),
+    ("tell me about your father", "tell me about your mother"),
+    ("should I quit my job", "should I not quit my job"),
+    ("what did you do today", "what did you do yesterday"),
+    ("what are you doing today", "what are you doing tomorrow"),
+    ("how are you", "who are you"),
+    ("how old are you", "how old is your dog"),
+    ("where do you live", "where did you live"),
+    ("what is your name", "what is your dog's name"),
+    ("I have two kids", "I have three kids"),
+]
+
+class SemanticCacheTest(unittest.TestCase):
+    def cache_with(self, message):
+        cache = SemanticCache(max_entries=8)
+        cache.store("chat", message, "v1", "stored reply")
+        return cache
+
+    def test_rewordings_hit(self):
+        for stored, asked in HITS:
+            with self.subTest(stored=stored, asked=asked):
+                entry = self.cache_with(stored).lookup("chat", asked, "v1")
+                self.assertIsNotNone(entry)
+                self.assertEqual(entry["response"], "stored reply")
+
+    def test_different_questions_miss(self):
+        for stored, asked in MISSES:
+            with self.subTest(stored=stored, asked=asked):
+                self.assertIsNone(self.cache_with(stored).lookup("chat", asked, "v1"))
+
+    def test_small_talk_padding_is_not_a_guard_word(self):
+        self.assertEqual(normalize("How're you doing today?"), "how are you")
+        self.assertEqual(guard_terms(normalize("How're you doing today?")), frozenset())
+        # Outside small talk "today" still guards
+        self.assertEqual(guard_terms(normalize("what did you do today")), frozenset({"today"}))
+
+    def test_persona_change_and_tenants_isolate_entries(self):
+        cache = self.cache_with("where did you grow up")
+        self.assertIsNone(cache.lookup("chat", "where did you grow up", "v1", tenant="other"))
+        self.assertIsNone(cache.lookup("chat", "where did you grow up", "v2"))
+        self.assertIsNone(cache.lookup("chat", "where did you grow up", "v1"))
+
+if __name__ == "__main__":
+    unittest.main()
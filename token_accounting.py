@@ -0,0 +1,293 @@
+"""Token accounting: count prompt tokens locally, keep turns inside their budgets, record usage.
+
+Prompts went to the chat model without being measured, so their size (and
+the latency and cost that come with it) was only visible on the invoice.
+`TokenAccounting` now:
+
+  * counts tokens with tiktoken when it is installed and its encoding can
+    be loaded (once, by the warm-up; encodings and counts of repeated text
+    such as the system prompt are cached), else with a character/word
+    heuristic that errs high,
+  * fits each request to its mode's prompt budget (the router's
+    `prompt_budget`) before it is sent: the user message is trimmed first,
+    but never below TOKEN_USER_FLOOR tokens, then the system prompt, and
+    the completion cap (`max_tokens`) is lowered if prompt plus cap would
+    overflow the model's context window,
+  * caps the memories that go into the system prompt at
+    TOKEN_SYSTEM_BUDGET tokens (lowered by the router so that every
+    mode's budget leaves the user message its floor),
+  * records the `usage` of every response: prompt and completion tokens,
+    completion tokens per second, replies cut off at the cap, estimate
+    error and cost (per model prices in USD per 1K tokens).
+
+Totals per mode and model, with average cost per turn, are in
+/debug/metrics under "tokens".
+
+Environment:
+    TOKEN_COUNTER          tiktoken or heuristic (default tiktoken, when installed)
+    TOKEN_SYSTEM_BUDGET    tokens of system prompt, memories included (default 1200)
+    TOKEN_USER_FLOOR       tokens of the user message that are never trimmed (default 200)
+    TOKEN_PRICES           JSON of per-model [prompt, completion] USD per 1K tokens, e.g.
+                           {"gpt-4": [0.03, 0.06]}; merged over the built-in table
+"""
+import importlib.util
+import json
+import logging
+import math
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from latency import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+# USD per 1K tokens: (prompt, completion); the longest matching prefix of the model name wins
+DEFAULT_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4o": (0.005, 0.015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+}
+
+CONTEXT_WINDOWS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-3.5-turbo": 16385,
+}
+
+# Chat format overhead: per message, and priming the assistant's reply
+_MESSAGE_OVERHEAD = 4
+_REPLY_OVERHEAD = 3
+_SENTENCE_END = re.compile(r"[.!?…][\"')\]]*(?=\s|$)")
+
+def _by_prefix(table: Dict[str, Any], model: str) -> Optional[Any]:
+    matches = [name for name in table if model.startswith(name)]
+    return table[max(matches, key=len)] if matches else None
+
+def trim_to_sentence(text: str) -> str:
+    """Drop a trailing unfinished sentence (a reply cut off at max_tokens), if a finished one precedes it."""
+    ends = list(_SENTENCE_END.finditer(text))
+    if not ends:
+        return text
+    return text[:ends[-1].end()]
+
+class TokenAccounting:
+    def __init__(self, use_tiktoken: bool = True, system_budget: int = 1200, user_floor: int = 200,
+                 prices: Optional[Dict[str, Any]] = None, cache_size: int = 256):
+        self.use_tiktoken = use_tiktoken and importlib.util.find_spec("tiktoken") is not None
+        self.system_budget = system_budget
+        self.user_floor = max(0, user_floor)
+        self.prices = {**DEFAULT_PRICES, **{k: tuple(v) for k, v in (prices or {}).items()}}
+        self._encodings: Dict[str, Any] = {}
+        self._failed = set()
+        # (encoding, text) -> count; the system prompt is counted once per version, not per turn
+        self._counts: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.trimmed: Dict[str, int] = {}
+        self.capped: Dict[str, int] = {}
+        self.modes: Dict[str, Dict[str, Any]] = {}
+        self.models: Dict[str, Dict[str, Any]] = {}
+
+    # -------------------- Counting --------------------
+    def load(self, models: List[str]) -> Dict[str, str]:
+        """Blocking: load the tokenizer for each model (may download the encoding once); run off the request path."""
+        return {model: self._encoding_name(model, load=True) for model in models}
+
+    def _encoding(self, model: str, load: bool = False):
+        encoding = self._encodings.get(model)
+        if encoding is not None or not self.use_tiktoken or not load or model in self._failed:
+            return encoding
+        import tiktoken
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # Usually no network to fetch the encoding; the heuristic stands in
+            self._failed.add(model)
+            logger.warning(f"No tokenizer for {model}, estimating token counts: {str(e)}")
+            return None
+        self._encodings[model] = encoding
+        return encoding
+
+    def _encoding_name(self, model: str, load: bool = False) -> str:
+        encoding = self._encoding(model, load)
+        return encoding.name if encoding is not None else "heuristic"
+
+    @staticmethod
+    def _estimate(text: str) -> int:
+        # About 4 characters or 0.75 words per token in English; take the larger
+        return max(math.ceil(len(text) / 4), math.ceil(len(text.split()) * 4 / 3))
+
+    def count(self, text: str, model: str) -> int:
+        if not text:
+            return 0
+        encoding = self._encoding(model)
+        name = encoding.name if encoding is not None else "heuristic"
+        key = (name, text)
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+            self.cache_hits += 1
+            return count
+        self.cache_misses += 1
+        count = len(encoding.encode(text, disallowed_special=())) if encoding is not None else self._estimate(text)
+        self._counts[key] = count
+        while len(self._counts) > self._cache_size:
+            self._counts.popitem(last=False)
+        return count
+
+    def count_messages(self, messages: List[Dict[str, str]], model: str) -> int:
+        return sum(_MESSAGE_OVERHEAD + self.count(m.get("content") or "", model) for m in messages) + _REPLY_OVERHEAD
+
+    def truncate(self, text: str, tokens: int, model: str) -> str:
+        """The beginning of text, at most `tokens` tokens long."""
+        if tokens <= 0:
+            return ""
+        if self.count(text, model) <= tokens:
+            return text
+        encoding = self._encoding(model)
+        if encoding is not None:
+            return encoding.decode(encoding.encode(text, disallowed_special=())[:tokens]).rstrip() + "…"
+        # The estimate is close to linear in length, so cut proportionally, then back off to fit
+        cut = text[:int(len(text) * tokens / self._estimate(text))].rsplit(" ", 1)[0]
+        while cut and self._estimate(cut) > tokens:
+            cut = cut[:int(len(cut) * 0.95)].rsplit(" ", 1)[0]
+        return cut.rstrip() + "…"
+
+    # -------------------- Budgets --------------------
+    def fit(self, route, messages: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], int]:
+        """Trim messages to the route's prompt budget and cap max_tokens to the context window.
+
+        The user message gives up tokens first, down to `user_floor`; the
+        system prompt gives up the rest. Returns the messages to send and
+        their prompt token count."""
+        prompt_tokens = self.count_messages(messages, route.model)
+        budget = route.prompt_budget
+        if budget and prompt_tokens > budget:
+            messages = [dict(m) for m in messages]
+            # The user's words go first, but keep enough of them to answer
+            for message in reversed(messages):
+                over = self.count_messages(messages, route.model) - budget
+                if over <= 0:
+                    break
+                content = message.get("content") or ""
+                tokens = self.count(content, route.model)
+                floor = min(tokens, self.user_floor) if message.get("role") == "user" else 0
+                # One token of slack for the ellipsis
+                keep = max(floor, tokens - over - 1)
+                if keep < tokens:
+                    message["content"] = self.truncate(content, keep, route.model)
+            self.trimmed[route.mode] = self.trimmed.get(route.mode, 0) + 1
+            new_tokens = self.count_messages(messages, route.model)
+            logger.warning(f"Trimmed {route.mode} prompt from {prompt_tokens} to {new_tokens} tokens (budget {budget})")
+            prompt_tokens = new_tokens
+        window = _by_prefix(CONTEXT_WINDOWS, route.model)
+        if window and route.max_tokens and prompt_tokens + route.max_tokens > window:
+            route.max_tokens = max(1, window - prompt_tokens)
+            self.capped[route.mode] = self.capped.get(route.mode, 0) + 1
+        return messages, prompt_tokens
+
+    def fit_lines(self, lines: List[str], budget: int, model: str) -> List[str]:
+        """As many of the lines as fit in `budget` tokens, in order."""
+        kept, used = [], 0
+        for line in lines:
+            tokens = self.count(line, model) + 1
+            if used + tokens > budget:
+                break
+            kept.append(line)
+            used += tokens
+        return kept
+
+    # -------------------- Usage --------------------
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+        prices = _by_prefix(self.prices, model)
+        if prices is None:
+            return None
+        return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000
+
+    @staticmethod
+    def _totals() -> Dict[str, Any]:
+        return {"turns": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "hit_cap": 0,
+                "estimate_error": 0.0, "tokens_per_second": LatencyWindow(200)}
+
+    def record(self, route, prompt_estimate: int, response, seconds: float) -> Dict[str, Any]:
+        """Record one completion's usage; returns the turn's numbers for tracing."""
+        usage = getattr(response, "usage", None)
+        choice = response.choices[0]
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or prompt_estimate
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        if completion_tokens is None:
+            completion_tokens = self.count(choice.message.content or "", route.model)
+        cost = self.cost(route.model, prompt_tokens, completion_tokens)
+        hit_cap = getattr(choice, "finish_reason", None) == "length"
+        for key, table in ((route.mode, self.modes), (route.model, self.models)):
+            totals = table.get(key)
+            if totals is None:
+                totals = table[key] = self._totals()
+            totals["turns"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["cost_usd"] += cost or 0.0
+            totals["hit_cap"] += hit_cap
+            totals["estimate_error"] += abs(prompt_estimate - prompt_tokens) / prompt_tokens if prompt_tokens else 0.0
+            if seconds > 0 and completion_tokens:
+                totals["tokens_per_second"].add(completion_tokens / seconds)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "cost_usd": round(cost, 6) if cost is not None else None, "hit_cap": hit_cap}
+
+    @staticmethod
+    def _report(totals: Dict[str, Any]) -> Dict[str, Any]:
+        turns = totals["turns"]
+        rate = totals["tokens_per_second"]
+        p50, p95 = rate.percentile(50), rate.percentile(95)
+        return {
+            "turns": turns,
+            "prompt_tokens": totals["prompt_tokens"],
+            "completion_tokens": totals["completion_tokens"],
+            "avg_prompt_tokens": round(totals["prompt_tokens"] / turns) if turns else None,
+            "avg_completion_tokens": round(totals["completion_tokens"] / turns) if turns else None,
+            "cost_usd": round(totals["cost_usd"], 4),
+            "cost_per_turn_usd": round(totals["cost_usd"] / turns, 5) if turns else None,
+            "hit_cap": totals["hit_cap"],
+            "prompt_estimate_error": round(totals["estimate_error"] / turns, 3) if turns else None,
+            "tokens_per_second": {"p50": round(p50, 1) if p50 else None, "p95": round(p95, 1) if p95 else None},
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "counter": {model: encoding.name for model, encoding in self._encodings.items()} or "heuristic",
+            "system_budget": self.system_budget,
+            "user_floor": self.user_floor,
+            "count_cache": {"size": len(self._counts), "hits": self.cache_hits, "misses": self.cache_misses},
+            "trimmed": self.trimmed,
+            "max_tokens_capped": self.capped,
+            "modes": {mode: self._report(totals) for mode, totals in self.modes.items()},
+            "models": {model: self._report(totals) for model, totals in self.models.items()},
+        }
+
+def _prices() -> Dict[str, Any]:
+    raw = os.getenv("TOKEN_PRICES")
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError as e:
+        logger.error(f"Ignoring TOKEN_PRICES: {str(e)}")
+        return {}
+
+token_accounting = TokenAccounting(
+    use_tiktoken=os.getenv("TOKEN_COUNTER", "tiktoken").lower() == "tiktoken",
+    system_budget=int(os.getenv("TOKEN_SYSTEM_BUDGET", "1200")),
+    user_floor=int(os.getenv("TOKEN_USER_FLOOR", "200")),
+    prices=_prices()
+)
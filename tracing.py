@@ -0,0 +1,325 @@
+"""Lightweight request-scoped tracing.
+
+`TracingMiddleware` gives every HTTP request a trace id (taken from the
+X-Request-ID / traceparent headers when present) and returns it in the
+X-Trace-Id response header. When a request is sampled, `span()` blocks
+record timings for upstream calls and disk writes, and the finished trace
+goes to an in-memory ring plus a "slowest traces" set served by
+/debug/traces, and optionally to a JSON lines file (written by a
+background thread, never on the event loop).
+
+Unsampled requests never allocate spans: `span()` checks one context
+variable and returns a shared no-op context manager.
+
+Environment:
+    TRACE_SAMPLE_RATE   fraction of requests to trace (default 0.1, 0 disables)
+    TRACE_RING_SIZE     recent traces kept in memory (default 200)
+    TRACE_SLOWEST_SIZE  slowest traces kept in memory (default 20)
+    TRACE_FILE          append finished traces to this JSON lines file
+"""
+import contextvars
+import heapq
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "duration_ms", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, trace_start: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "offset_ms": round((self.start - trace_start) * 1000, 2),
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+class Trace:
+    def __init__(self, trace_id: str, method: str, path: str):
+        self.trace_id = trace_id
+        self.request_id = None
+        self.method = method
+        self.path = path
+        self.status = None
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.spans: List[Span] = []
+        self.attributes: Dict[str, Any] = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "timestamp": self.timestamp,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "spans": [s.to_dict(self.start) for s in self.spans],
+        }
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+_trace_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+_trace_var: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+_span_var: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("span", default=None)
+
+# -------------------- Exporters --------------------
+class InMemoryExporter:
+    """Ring of recent traces plus a min-heap of the slowest ones."""
+
+    def __init__(self, ring_size: int = 200, slowest_size: int = 20):
+        self.recent = deque(maxlen=ring_size)
+        self.slowest_size = slowest_size
+        self._slowest: List = []
+        self._lock = threading.Lock()
+
+    def export(self, trace: Dict[str, Any]):
+        with self._lock:
+            self.recent.append(trace)
+            entry = (trace["duration_ms"], trace["trace_id"], trace)
+            if len(self._slowest) < self.slowest_size:
+                heapq.heappush(self._slowest, entry)
+            elif entry[0] > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def get_recent(self, limit: int = 50) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self.recent)[-limit:][::-1]
+
+    def get_slowest(self, limit: int = 20) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [t for _, _, t in sorted(self._slowest, reverse=True)[:limit]]
+
+    def find(self, trace_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            for trace in list(self.recent) + [t for _, _, t in self._slowest]:
+                if trace["trace_id"] == trace_id or trace.get("request_id") == trace_id:
+                    return trace
+        return None
+
+class JSONFileExporter:
+    """Append finished traces to a JSON lines file from a writer thread.
+
+    `export` runs on the event loop, so it only queues the trace; the thread
+    encodes and writes whatever has queued up. When the queue is full (the
+    disk can't keep up) traces are dropped and counted rather than blocking.
+    """
+
+    def __init__(self, path: str, max_queue: int = 1000):
+        self.path = path
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.written = 0
+        self.dropped = 0
+
+    def export(self, trace: Dict[str, Any]):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            traces = [trace for trace in batch if trace is not None]
+            if traces:
+                try:
+                    with open(self.path, "a") as f:
+                        f.write("".join(json.dumps(trace, default=str) + "\n" for trace in traces))
+                    self.written += len(traces)
+                except Exception as e:
+                    logger.error(f"Error writing {len(traces)} traces to {self.path}: {str(e)}")
+            if stop:
+                return
+
+    def close(self, timeout: float = 5.0):
+        """Flush queued traces (blocking; call from a worker thread at shutdown)."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped}
+
+class Tracer:
+    def __init__(self, sample_rate: float = 0.1, exporters: Optional[List] = None):
+        self.sample_rate = sample_rate
+        self.memory = InMemoryExporter(
+            ring_size=int(os.getenv("TRACE_RING_SIZE", "200")),
+            slowest_size=int(os.getenv("TRACE_SLOWEST_SIZE", "20"))
+        )
+        self.exporters = [self.memory] + (exporters or [])
+
+    def should_sample(self, forced: bool = False) -> bool:
+        if forced:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def finish(self, trace: Trace):
+        trace.duration_ms = round((time.perf_counter() - trace.start) * 1000, 2)
+        record = trace.to_dict()
+        for exporter in self.exporters:
+            exporter.export(record)
+
+    def close(self):
+        """Flush exporters that buffer (blocking)."""
+        for exporter in self.exporters:
+            if hasattr(exporter, "close"):
+                exporter.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "exporters": {type(e).__name__: e.stats() for e in self.exporters if hasattr(e, "stats")},
+        }
+
+def _create_tracer() -> Tracer:
+    exporters = []
+    if os.getenv("TRACE_FILE"):
+        exporters.append(JSONFileExporter(os.getenv("TRACE_FILE")))
+    return Tracer(sample_rate=float(os.getenv("TRACE_SAMPLE_RATE", "0.1")), exporters=exporters)
+
+tracer = _create_tracer()
+
+# -------------------- Public Helpers --------------------
+def current_trace_id() -> Optional[str]:
+    return _trace_id_var.get()
+
+def set_request_id(request_id: Optional[str]):
+    """Attach the client-supplied request_id to the current trace."""
+    trace = _trace_var.get()
+    if trace is not None and request_id:
+        trace.request_id = request_id
+
+def annotate(**attributes):
+    """Add attributes to the current trace (no-op when unsampled)."""
+    trace = _trace_var.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+@contextmanager
+def _record_span(trace: Trace, name: str, attributes: Dict[str, Any]):
+    parent = _span_var.get()
+    current = Span(name, parent.span_id if parent else None, attributes)
+    token = _span_var.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {str(e)}"[:500]
+        raise
+    finally:
+        current.duration_ms = round((time.perf_counter() - current.start) * 1000, 2)
+        _span_var.reset(token)
+        trace.spans.append(current)
+
+def span(name: str, **attributes):
+    """Time a block of work as part of the current trace.
+
+    Works in sync and async code: `with span("openai.chat", model="gpt-4"):`
+    """
+    trace = _trace_var.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return _record_span(trace, name, attributes)
+
+def _incoming_trace_id(headers: Dict[bytes, bytes]) -> Optional[str]:
+    request_id = headers.get(b"x-request-id")
+    if request_id:
+        return request_id.decode("latin-1")[:128]
+    traceparent = headers.get(b"traceparent")
+    if traceparent:
+        # W3C format: version-traceid-parentid-flags
+        parts = traceparent.decode("latin-1").split("-")
+        if len(parts) == 4 and len(parts[1]) == 32:
+            return parts[1]
+    return None
+
+# -------------------- Middleware --------------------
+class TracingMiddleware:
+    """Pure ASGI middleware so the trace context reaches the endpoint task."""
+
+    def __init__(self, app, tracer: Tracer = tracer, exclude_prefixes=("/static", "/debug")):
+        self.app = app
+        self.tracer = tracer
+        self.exclude_prefixes = exclude_prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        trace_id = _incoming_trace_id(headers) or uuid.uuid4().hex
+        id_token = _trace_id_var.set(trace_id)
+
+        path = scope.get("path", "")
+        trace = None
+        if not path.startswith(self.exclude_prefixes) and self.tracer.should_sample(headers.get(b"x-trace-sample") == b"1"):
+            trace = Trace(trace_id, scope.get("method", ""), path)
+        trace_token = _trace_var.set(trace)
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                if trace is not None:
+                    trace.status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-trace-id", trace_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            _trace_var.reset(trace_token)
+            _trace_id_var.reset(id_token)
+            if trace is not None:
+                self.tracer.finish(trace)
@@ -0,0 +1,215 @@
+"""Process-pool audio transcoding with ffmpeg.
+
+iOS/Safari uploads arrive as large AAC/MP4 containers that are slow to send
+to Whisper and occasionally rejected. `AudioTranscoder` normalizes any
+input to compact mono Opus (or 16 kHz WAV) before transcription.
+
+Jobs run in a ProcessPoolExecutor sized by core count, so decoding never
+touches the event loop. Each job has a hard timeout, the pending queue is
+bounded (when it is full the original file is sent as-is), and queue and
+timing metrics are kept for /debug/metrics.
+
+Environment:
+    TRANSCODE_FORMAT      opus, wav or off (default opus)
+    TRANSCODE_WORKERS     pool size (default: CPU count - 1, at least 1)
+    TRANSCODE_TIMEOUT     seconds per job (default 20)
+    TRANSCODE_MAX_QUEUE   jobs allowed to wait for a worker (default 32)
+    FFMPEG_BINARY         ffmpeg executable (default "ffmpeg")
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Dict, Any
+
+import ffmpeg
+
+from file_io import remove_quietly
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+OUTPUT_FORMATS = {
+    # format: (extension, content type, ffmpeg output options)
+    "opus": (".ogg", "audio/ogg", {"ac": 1, "ar": 16000, "acodec": "libopus", "audio_bitrate": "24k", "application": "voip", "format": "ogg"}),
+    "wav": (".wav", "audio/wav", {"ac": 1, "ar": 16000, "acodec": "pcm_s16le", "format": "wav"}),
+}
+
+def process_pool_context():
+    """Start method for worker pools.
+
+    Defaults to fork: the deployed entry point (startup.py) starts uvicorn at
+    import time, so spawn/forkserver workers, which re-import __main__, would
+    each start another server. Override with WORKER_MP_CONTEXT.
+    """
+    return multiprocessing.get_context(os.getenv("WORKER_MP_CONTEXT", "fork"))
+
+class TranscodeError(Exception):
+    pass
+
+class TranscodeTimeout(TranscodeError):
+    pass
+
+class TranscodeResult:
+    __slots__ = ("path", "content_type", "input_bytes", "output_bytes", "queue_ms", "run_ms")
+
+    def __init__(self, path, content_type, input_bytes, output_bytes, queue_ms, run_ms):
+        self.path = path
+        self.content_type = content_type
+        self.input_bytes = input_bytes
+        self.output_bytes = output_bytes
+        self.queue_ms = queue_ms
+        self.run_ms = run_ms
+
+def run_ffmpeg(stream, timeout: float):
+    """Run a compiled ffmpeg-python graph with a hard timeout (worker side)."""
+    args = ffmpeg.compile(stream.global_args("-nostdin", "-loglevel", "error"), cmd=FFMPEG_BINARY, overwrite_output=True)
+    try:
+        process = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise TranscodeTimeout(f"ffmpeg timed out after {timeout}s")
+    if process.returncode != 0:
+        raise TranscodeError(process.stderr.decode("utf-8", "replace").strip()[-500:] or f"ffmpeg exited with {process.returncode}")
+    return process
+
+def _transcode_job(src: str, dst: str, output_format: str, timeout: float) -> Dict[str, Any]:
+    """Runs in a worker process."""
+    started = time.time()
+    options = OUTPUT_FORMATS[output_format][2]
+    stream = ffmpeg.input(src).audio.output(dst, **options)
+    run_ffmpeg(stream, timeout)
+    return {"started": started, "run_s": time.time() - started, "output_bytes": os.path.getsize(dst)}
+
+class AudioTranscoder:
+    def __init__(self, output_format: str = "opus", workers: Optional[int] = None, timeout: float = 20.0, max_queue: int = 32):
+        self.output_format = output_format
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.available = output_format in OUTPUT_FORMATS and shutil.which(FFMPEG_BINARY) is not None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.skipped = 0
+        self.in_flight = 0
+        self.total_queue_ms = 0.0
+        self.total_run_ms = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        if output_format != "off" and not self.available:
+            logger.warning(f"Audio transcoding disabled: format={output_format}, ffmpeg={shutil.which(FFMPEG_BINARY)}")
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=process_pool_context())
+            logger.info(f"Started transcoding pool with {self.workers} workers")
+        return self._pool
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    def accepts_job(self) -> bool:
+        return self.available and self.queued < self.max_queue
+
+    async def submit(self, func, *args, timeout: Optional[float] = None):
+        """Run a picklable function in the pool, bounded by a timeout; returns its result."""
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        submitted_at = time.time()
+        self.submitted += 1
+        self.in_flight += 1
+        try:
+            # The worker enforces the ffmpeg timeout; the outer one also covers time spent queued
+            future = loop.run_in_executor(self.pool, func, *args)
+            result = await asyncio.wait_for(future, timeout=timeout * 2 + 5)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            self.failed += 1
+            raise TranscodeTimeout("Transcoding job timed out")
+        except TranscodeError as e:
+            if isinstance(e, TranscodeTimeout):
+                self.timed_out += 1
+            self.failed += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+        self.completed += 1
+        if isinstance(result, dict) and "started" in result:
+            self.total_queue_ms += max(0.0, result["started"] - submitted_at) * 1000
+            self.total_run_ms += result["run_s"] * 1000
+        return result
+
+    async def transcode(self, src: str, input_bytes: int) -> Optional[TranscodeResult]:
+        """Normalize src to the configured format; returns None when the original should be used."""
+        if not self.accepts_job():
+            if self.available:
+                self.skipped += 1
+                logger.warning(f"Transcode queue full ({self.queued} waiting); sending original audio")
+            return None
+        extension, content_type, _ = OUTPUT_FORMATS[self.output_format]
+        dst = f"{os.path.splitext(src)[0]}.norm{extension}"
+        submitted_at = time.time()
+        try:
+            result = await self.submit(_transcode_job, src, dst, self.output_format, self.timeout)
+        except BaseException:
+            # ffmpeg may have written part of the output before failing or being killed
+            await remove_quietly(dst)
+            raise
+        self.bytes_in += input_bytes
+        self.bytes_out += result["output_bytes"]
+        return TranscodeResult(
+            path=dst,
+            content_type=content_type,
+            input_bytes=input_bytes,
+            output_bytes=result["output_bytes"],
+            queue_ms=round(max(0.0, result["started"] - submitted_at) * 1000, 1),
+            run_ms=round(result["run_s"] * 1000, 1)
+        )
+
+    def warm_up(self):
+        """Start the worker processes ahead of the first upload."""
+        if self.available:
+            for _ in range(self.workers):
+                self.pool.submit(os.getpid)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": self.available,
+            "format": self.output_format,
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "skipped_queue_full": self.skipped,
+            "avg_queue_ms": round(self.total_queue_ms / self.completed, 1) if self.completed else None,
+            "avg_run_ms": round(self.total_run_ms / self.completed, 1) if self.completed else None,
+            "compression_ratio": round(self.bytes_in / self.bytes_out, 2) if self.bytes_out else None,
+        }
+
+transcoder = AudioTranscoder(
+    output_format=os.getenv("TRANSCODE_FORMAT", "opus").lower(),
+    workers=int(os.getenv("TRANSCODE_WORKERS", "0")) or None,
+    timeout=float(os.getenv("TRANSCODE_TIMEOUT", "20")),
+    max_queue=int(os.getenv("TRANSCODE_MAX_QUEUE", "32"))
+)
@@ -0,0 +1,166 @@
+"""Fast classifier for junk transcripts (Whisper hallucinations and noise).
+
+Whisper reliably "hears" things on silence or background noise: "Thank
+you.", lone fillers, "MBC 뉴스", subtitle credits. Each of those used to
+cost a full GPT + TTS turn. `TranscriptFilter.classify` flags them with:
+
+  * precompiled hallucination patterns,
+  * per-language stoplists of filler words,
+  * Whisper's own confidence signals from `verbose_json` segments
+    (`no_speech_prob`, `avg_logprob`, `compression_ratio`).
+
+Environment:
+    TRANSCRIPT_FILTER_ENABLED        classify transcripts at all (default true)
+    TRANSCRIPT_FILTER_CONFIG         JSON file with extra "patterns" and "stoplists"
+    TRANSCRIPT_NO_SPEECH_THRESHOLD   segment no_speech_prob above this is silence (default 0.6)
+    TRANSCRIPT_LOGPROB_THRESHOLD     ...when avg_logprob is also below this (default -1.0)
+    TRANSCRIPT_COMPRESSION_THRESHOLD compression_ratio above this is a repetition loop (default 2.4)
+"""
+import json
+import logging
+import os
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATTERNS = [
+    # Stock phrases Whisper emits on silence
+    r"^(thank you|thanks)( (so|very) much)?( for (watching|listening))?[.!]?$",
+    r"^(please )?(like and )?subscribe( to (my|the|our) channel)?[.!]?$",
+    r"^(bye|bye-bye|goodbye)[.!]?$",
+    r"subtitles? (by|created by)",
+    r"amara\.org",
+    r"^\[?(music|applause|laughter|silence|blank_audio|inaudible)\]?[.!]?$",
+    r"^\(?(music|applause|laughter|silence)\)?$",
+    # Korean/Japanese news-sign-off hallucinations
+    r"mbc\s*뉴스",
+    r"이덕영입니다",
+    r"워싱턴에서",
+    r"ご視聴ありがとうございました",
+    r"시청해\s*주셔서\s*감사합니다",
+    # Nothing but punctuation or symbols
+    r"^[\W_]+$",
+]
+
+DEFAULT_STOPLISTS = {
+    "en": {"you", "the", "a", "an", "and", "i", "it", "is", "um", "uh", "uhm", "hmm", "mm", "mhm", "ah", "oh", "so"},
+    "es": {"gracias", "eh", "este", "pues", "y"},
+    "fr": {"merci", "euh", "bah", "et"},
+    "de": {"danke", "äh", "ähm", "und"},
+}
+
+_WORD_RE = re.compile(r"[\w']+", re.UNICODE)
+
+class TranscriptVerdict:
+    __slots__ = ("is_junk", "reason", "text")
+
+    def __init__(self, is_junk: bool, reason: Optional[str], text: str):
+        self.is_junk = is_junk
+        self.reason = reason
+        self.text = text
+
+class TranscriptFilter:
+    def __init__(
+        self,
+        patterns: Iterable[str] = DEFAULT_PATTERNS,
+        stoplists: Optional[Dict[str, Iterable[str]]] = None,
+        no_speech_threshold: float = 0.6,
+        logprob_threshold: float = -1.0,
+        compression_threshold: float = 2.4,
+        enabled: bool = True
+    ):
+        self.enabled = enabled
+        self.patterns = [re.compile(p, re.IGNORECASE | re.UNICODE) for p in patterns]
+        self.stoplists = {lang: {w.lower().strip(".!?,") for w in words} for lang, words in (stoplists or DEFAULT_STOPLISTS).items()}
+        self.no_speech_threshold = no_speech_threshold
+        self.logprob_threshold = logprob_threshold
+        self.compression_threshold = compression_threshold
+        self.checked = 0
+        self.junk_by_reason: Counter = Counter()
+        self.upstream_calls_avoided: Counter = Counter()
+
+    def classify(self, text: Optional[str], language: Optional[str] = "en", segments: Optional[List[Dict[str, Any]]] = None) -> TranscriptVerdict:
+        cleaned = (text or "").strip()
+        if not self.enabled:
+            return TranscriptVerdict(False, None, cleaned)
+        self.checked += 1
+        reason = self._reason(cleaned, _language_code(language), segments)
+        if reason:
+            self.junk_by_reason[reason] += 1
+            logger.warning(f"Filtered transcript ({reason}): {cleaned[:80]!r}")
+        return TranscriptVerdict(reason is not None, reason, cleaned)
+
+    def _reason(self, text: str, language: str, segments) -> Optional[str]:
+        if not text or text.lower() == "undefined":
+            return "empty"
+
+        lowered = text.lower()
+        for pattern in self.patterns:
+            if pattern.search(lowered):
+                return "hallucination"
+
+        words = _WORD_RE.findall(lowered)
+        stoplist = self.stoplists.get(language, set())
+        if words and all(w in stoplist for w in words) and len(words) <= 3:
+            return "filler"
+        if len(words) >= 4 and len(set(words)) == 1:
+            return "repetition"
+
+        if segments:
+            silent = [
+                s for s in segments
+                if (s.get("no_speech_prob") or 0) > self.no_speech_threshold
+                and (s.get("avg_logprob") or 0) < self.logprob_threshold
+            ]
+            if len(silent) == len(segments):
+                return "no_speech"
+            if all((s.get("compression_ratio") or 0) > self.compression_threshold for s in segments):
+                return "repetition"
+        return None
+
+    def record_avoided(self, *calls: str):
+        for call in calls:
+            self.upstream_calls_avoided[call] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        junk = sum(self.junk_by_reason.values())
+        return {
+            "enabled": self.enabled,
+            "checked": self.checked,
+            "junk": junk,
+            "junk_rate": round(junk / self.checked, 3) if self.checked else None,
+            "by_reason": dict(self.junk_by_reason),
+            "upstream_calls_avoided": dict(self.upstream_calls_avoided),
+        }
+
+def _language_code(language: Optional[str]) -> str:
+    # verbose_json reports full names ("english"); requests use ISO codes ("en")
+    names = {"english": "en", "spanish": "es", "french": "fr", "german": "de"}
+    language = (language or "en").lower()
+    return names.get(language, language[:2])
+
+def _create_filter() -> TranscriptFilter:
+    patterns = list(DEFAULT_PATTERNS)
+    stoplists = {lang: set(words) for lang, words in DEFAULT_STOPLISTS.items()}
+    config_path = os.getenv("TRANSCRIPT_FILTER_CONFIG")
+    if config_path:
+        try:
+            with open(config_path, "r") as f:
+                config = json.load(f)
+            patterns.extend(config.get("patterns", []))
+            for lang, words in config.get("stoplists", {}).items():
+                stoplists.setdefault(lang, set()).update(words)
+        except Exception as e:
+            logger.error(f"Error loading transcript filter config {config_path}: {str(e)}")
+    return TranscriptFilter(
+        patterns=patterns,
+        stoplists=stoplists,
+        no_speech_threshold=float(os.getenv("TRANSCRIPT_NO_SPEECH_THRESHOLD", "0.6")),
+        logprob_threshold=float(os.getenv("TRANSCRIPT_LOGPROB_THRESHOLD", "-1.0")),
+        compression_threshold=float(os.getenv("TRANSCRIPT_COMPRESSION_THRESHOLD", "2.4")),
+        enabled=os.getenv("TRANSCRIPT_FILTER_ENABLED", "true").lower() == "true"
+    )
+
+transcript_filter = _create_filter()
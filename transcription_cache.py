@@ -0,0 +1,238 @@
+"""Transcription cache keyed by an audio fingerprint.
+
+Safari retries and the frontend's timeout-then-resend path often upload the
+same recording twice. Results are cached by a SHA-256 of the uploaded bytes
+(plus model and language), bounded with LRU eviction. Concurrent identical
+uploads share one in-flight Whisper call.
+
+With TRANSCRIPTION_PCM_FINGERPRINT=true an upload whose exact hash
+misses is also decoded by ffmpeg to 8 kHz mono PCM and reduced to a
+quantized loudness envelope (one level per 100 ms), so a re-encoded copy
+of the same recording also hits. Envelopes are compared, not hashed: a
+match needs the same speech duration (at least ENVELOPE_MIN_FRAMES
+frames) and every frame within one level, with few off by one at all.
+Short or flat clips, where unrelated recordings look alike, never match.
+
+Entries are partitioned by tenant (keys are prefixed with the tenant id)
+so an evicted tenant's transcripts can be dropped with `drop_partition`.
+
+Environment:
+    TRANSCRIPTION_CACHE_SIZE        entries kept (default 512, 0 disables)
+    TRANSCRIPTION_CACHE_TTL         seconds an entry stays valid (default 3600)
+    TRANSCRIPTION_PCM_FINGERPRINT   also match re-encoded copies (default false)
+"""
+import asyncio
+import array
+import hashlib
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+PCM_SAMPLE_RATE = 8000
+ENVELOPE_FRAME_MS = 100
+# 2 s of speech; below that too many recordings share an envelope
+ENVELOPE_MIN_FRAMES = 20
+# Share of frames allowed one level off after lossy re-encoding
+ENVELOPE_TOLERANCE = 0.2
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+async def content_key(data: bytes, model: str, language: Optional[str]) -> str:
+    # hashlib releases the GIL on large buffers, so a worker thread keeps the loop free
+    digest = await asyncio.to_thread(_sha256, data)
+    return f"sha256:{model}:{language}:{digest}"
+
+def _envelope(pcm: bytes) -> Optional[bytes]:
+    samples = array.array("h")
+    samples.frombytes(pcm[: len(pcm) - len(pcm) % 2])
+    frame = PCM_SAMPLE_RATE * ENVELOPE_FRAME_MS // 1000
+    levels = []
+    for start in range(0, len(samples) - frame + 1, frame):
+        chunk = samples[start:start + frame]
+        rms = math.sqrt(sum(s * s for s in chunk) / frame)
+        # 3 dB steps survive lossy re-encoding; leading/trailing silence is trimmed below
+        levels.append(int(20 * math.log10(rms + 1) / 3))
+    while levels and levels[0] <= 1:
+        levels.pop(0)
+    while levels and levels[-1] <= 1:
+        levels.pop()
+    # Near-constant level (hum, steady noise) says nothing about the content
+    if len(levels) < ENVELOPE_MIN_FRAMES or max(levels) - min(levels) < 3:
+        return None
+    return bytes(min(level, 255) for level in levels)
+
+def similar_envelopes(a: bytes, b: bytes) -> bool:
+    """Same duration, no frame more than one level apart, and few frames off at all."""
+    if len(a) != len(b):
+        return False
+    off = 0
+    for x, y in zip(a, b):
+        if abs(x - y) > 1:
+            return False
+        off += x != y
+    return off <= len(a) * ENVELOPE_TOLERANCE
+
+async def pcm_fingerprint(path: str, timeout: float = 15.0) -> Optional[bytes]:
+    """Decode with ffmpeg (in a subprocess) and return the loudness envelope."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            os.getenv("FFMPEG_BINARY", "ffmpeg"), "-nostdin", "-loglevel", "error", "-i", path,
+            "-ac", "1", "-ar", str(PCM_SAMPLE_RATE), "-f", "s16le", "-",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            pcm, _ = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return None
+        if process.returncode != 0 or not pcm:
+            return None
+        return await asyncio.to_thread(_envelope, pcm)
+    except FileNotFoundError:
+        logger.warning("ffmpeg not found; PCM fingerprinting disabled for this request")
+        return None
+    except Exception as e:
+        logger.error(f"PCM fingerprint failed for {path}: {str(e)}")
+        return None
+
+class TranscriptionCache:
+    def __init__(self, max_entries: int = 512, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Envelope of each exact key, for matching re-encoded copies
+        self._envelopes: "OrderedDict[str, bytes]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.fingerprint_hits = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if self.ttl and time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key: str, value: Any):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def has(self, key: str, partition: str = "") -> bool:
+        """Whether the exact key is cached or being transcribed, so fingerprinting can be skipped."""
+        key = f"{partition}:{key}"
+        return self.enabled and (key in self._inflight or self._get(key) is not None)
+
+    def _remember(self, key: str, envelope: bytes):
+        self._envelopes[key] = envelope
+        self._envelopes.move_to_end(key)
+        while len(self._envelopes) > self.max_entries:
+            self._envelopes.popitem(last=False)
+
+    def _similar(self, partition: str, envelope: bytes) -> Optional[str]:
+        prefix = f"{partition}:"
+        for key, stored in reversed(self._envelopes.items()):
+            if key.startswith(prefix) and similar_envelopes(envelope, stored) and self._get(key) is not None:
+                return key
+        return None
+
+    async def get_or_transcribe(self, key: str, transcribe: Callable[[], Awaitable[Any]], partition: str = "",
+                                envelope: Optional[bytes] = None):
+        """Return (result, status) where status is 'hit', 'coalesced', 'miss' or 'bypass'.
+
+        `key` is the exact hash of the upload. With an `envelope` (see
+        `pcm_fingerprint`), a cached recording with a similar one also hits,
+        and the result is stored under this key too.
+        """
+        if not self.enabled or not key:
+            return await transcribe(), "bypass"
+        key = f"{partition}:{key}"
+
+        value = self._get(key)
+        if value is not None:
+            self.hits += 1
+            return value, "hit"
+        if envelope:
+            match = self._similar(partition, envelope)
+            if match is not None:
+                value = self._get(match)
+                self.hits += 1
+                self.fingerprint_hits += 1
+                self._put(key, value)
+                self._remember(key, envelope)
+                return value, "hit"
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight), "coalesced"
+
+        self.misses += 1
+        # Run the upstream call as its own task so a disconnecting first caller
+        # doesn't cancel the work the other callers are waiting on
+        task = asyncio.ensure_future(transcribe())
+        self._inflight[key] = task
+
+        def _finish(done: asyncio.Future):
+            if self._inflight.get(key) is done:
+                del self._inflight[key]
+            if not done.cancelled() and done.exception() is None:
+                self._put(key, done.result())
+                if envelope:
+                    self._remember(key, envelope)
+
+        task.add_done_callback(_finish)
+        return await asyncio.shield(task), "miss"
+
+    def drop_partition(self, partition: str) -> int:
+        """Remove a tenant's entries; returns how many were dropped."""
+        prefix = f"{partition}:"
+        dropped = [key for key in self._entries if key.startswith(prefix)]
+        for key in dropped:
+            del self._entries[key]
+        for key in [key for key in self._envelopes if key.startswith(prefix)]:
+            del self._envelopes[key]
+        return len(dropped)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "fingerprint_hits": self.fingerprint_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "inflight": len({id(f) for f in self._inflight.values()}),
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else None,
+        }
+
+transcription_cache = TranscriptionCache(
+    max_entries=int(os.getenv("TRANSCRIPTION_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("TRANSCRIPTION_CACHE_TTL", "3600"))
+)
+
+def pcm_fingerprint_enabled() -> bool:
+    return os.getenv("TRANSCRIPTION_PCM_FINGERPRINT", "false").lower() == "true"
@@ -0,0 +1,494 @@
+"""Text-to-speech backends.
+
+`TTSBackend.synthesize(text, voice_id)` returns encoded audio bytes in the
+backend's `extension`/`content_type`.
+
+Backends:
+    elevenlabs  - ElevenLabs API (default); the SDK is synchronous, so calls
+                  run in a worker thread
+    local       - Piper (ONNX neural TTS) on CPU in a worker process pool,
+                  with the voice model resident in each worker; writes WAV
+    auto        - ElevenLabs, routed to local for TTS_COOLDOWN seconds once
+                  its recent p95 reaches TTS_LATENCY_BUDGET (a call cut off at
+                  the budget counts as the budget), or while its circuit
+                  breaker is open; a half-open breaker lets one trial call
+                  through
+
+Replies are split into sentences and synthesized concurrently, so the first
+sentence is ready long before the whole reply would have been, and latency
+tracks the slowest sentence instead of the full text. With `on_clip`,
+`synthesize_reply` hands each clip over, in order, as soon as it and the
+ones before it are ready; background audio jobs push these to the client
+over /ws (`audio_segment`) so playback starts with the first sentence.
+The stored reply is always spoken by one backend: if the primary fails on
+any sentence, the whole reply is redone on the fallback rather than mixing
+voices (a listener already hearing it gets the remaining sentences from
+the fallback).
+
+`TTSRouter.phrases` holds pre-rendered audio for stock replies (filled at
+startup by warm-up), so those never wait on synthesis.
+
+Environment:
+    TTS_BACKEND               elevenlabs, local or auto (default elevenlabs)
+    TTS_ELEVENLABS_MODEL      ElevenLabs model (default eleven_monolingual_v1)
+    TTS_LOCAL_MODEL           path to a Piper .onnx voice (its .onnx.json alongside)
+    TTS_LOCAL_WORKERS         worker processes, each holding the voice (default 1)
+    TTS_LATENCY_BUDGET        seconds per sentence before auto falls back (default 4)
+    TTS_BREAKER_FAILURES      consecutive failures that open the circuit (default 3)
+    TTS_BREAKER_RESET         seconds before a half-open retry (default 30)
+    TTS_COOLDOWN              seconds auto stays on local after a p95 breach (default 60)
+    TTS_SENTENCE_PARALLELISM  sentences synthesized at once per reply (default 3)
+    TTS_MIN_SENTENCE_CHARS    short sentences are merged up to this length (default 40)
+"""
+import asyncio
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import re
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from admission import Overloaded, admission
+from latency import LatencyWindow
+from transcoder import process_pool_context
+
+logger = logging.getLogger(__name__)
+
+_SENTENCE_RE = re.compile(r"[^.!?…]+(?:[.!?…]+[\"')\]]*|$)")
+
+def split_sentences(text: str, min_chars: int = 40, max_chars: int = 400) -> List[str]:
+    """Split text into sentences, merging short ones so each clip has some prosody to work with."""
+    sentences = [s.strip() for s in _SENTENCE_RE.findall(text or "") if s.strip()]
+    merged: List[str] = []
+    for sentence in sentences:
+        if merged and (len(merged[-1]) < min_chars or len(sentence) < min_chars // 2) and len(merged[-1]) + len(sentence) < max_chars:
+            merged[-1] = f"{merged[-1]} {sentence}"
+        else:
+            merged.append(sentence)
+    return merged
+
+def join_audio(parts: List[bytes], extension: str) -> bytes:
+    """Concatenate clips of one format into a single file."""
+    if extension == ".mp3":
+        # MP3 is a stream of self-contained frames; byte concatenation plays back in order
+        return b"".join(parts)
+    if extension == ".wav":
+        output = io.BytesIO()
+        with wave.open(output, "wb") as joined:
+            for i, part in enumerate(parts):
+                with wave.open(io.BytesIO(part), "rb") as clip:
+                    if i == 0:
+                        joined.setparams(clip.getparams())
+                    joined.writeframes(clip.readframes(clip.getnframes()))
+        return output.getvalue()
+    raise ValueError(f"Cannot join {extension} audio")
+
+class CircuitBreaker:
+    """Opens after consecutive failures; lets one trial call through after `reset_timeout`."""
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        # When the half-open trial call was let through; a trial that never reports expires after reset_timeout
+        self.probe_started: Optional[float] = None
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Whether a call may go to the backend; in half_open only the first caller gets the trial."""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open":
+            return False
+        now = time.monotonic()
+        if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+            return False
+        self.probe_started = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.trips += 1
+            self.opened_at = time.monotonic()
+        self.probe_started = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.failures, "trips": self.trips,
+                "probing": self.probe_started is not None}
+
+class TTSBackend:
+    name = "base"
+    extension = ".mp3"
+    content_type = "audio/mpeg"
+
+    def __init__(self):
+        self.latency = LatencyWindow()
+        self.errors = 0
+        self.characters = 0
+
+    @property
+    def available(self) -> bool:
+        return True
+
+    async def synthesize(self, text: str, voice_id: str) -> bytes:
+        started = time.perf_counter()
+        try:
+            audio = await self._synthesize(text, voice_id)
+        except Exception:
+            self.errors += 1
+            raise
+        self.latency.add(time.perf_counter() - started)
+        self.characters += len(text)
+        return audio
+
+    async def _synthesize(self, text: str, voice_id: str) -> bytes:
+        raise NotImplementedError
+
+    def warm_up(self):
+        """Load models or open connections ahead of the first request."""
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "errors": self.errors, "characters": self.characters, **self.latency.summary()}
+
+class ElevenLabsBackend(TTSBackend):
+    name = "elevenlabs"
+
+    def __init__(self, tts_client, model: str = "eleven_monolingual_v1"):
+        super().__init__()
+        self.client = tts_client
+        self.model = model
+
+    def _generate(self, text: str, voice_id: str) -> bytes:
+        audio = self.client.generate(text=text, voice=voice_id, model=self.model, stream=False)
+        # The SDK returns a generator of chunks
+        if hasattr(audio, "__iter__") and not isinstance(audio, (bytes, bytearray)):
+            return b"".join(audio)
+        return audio
+
+    async def _synthesize(self, text, voice_id):
+        return await asyncio.to_thread(self._generate, text, voice_id)
+
+# -------------------- Local Engine (worker side) --------------------
+_local_voice = None
+
+def _init_local_tts_worker(model_path: str):
+    """Pool initializer: load the Piper voice once per worker process."""
+    global _local_voice
+    from piper.voice import PiperVoice
+    _local_voice = PiperVoice.load(model_path)
+
+def _synthesize_job(text: str) -> bytes:
+    """Runs in a worker process; returns a WAV file."""
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav_file:
+        # piper-tts >= 1.3 renamed synthesize(text, wav) to synthesize_wav
+        synthesize_wav = getattr(_local_voice, "synthesize_wav", None) or _local_voice.synthesize
+        synthesize_wav(text, wav_file)
+    return output.getvalue()
+
+class LocalTTSBackend(TTSBackend):
+    name = "local"
+    extension = ".wav"
+    content_type = "audio/wav"
+
+    def __init__(self, model_path: Optional[str], workers: int = 1):
+        super().__init__()
+        self.model_path = model_path
+        self.workers = max(1, workers)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._available = bool(model_path) and os.path.isfile(model_path) and importlib.util.find_spec("piper") is not None
+        if not self._available:
+            logger.warning(f"Local TTS unavailable: piper-tts installed={importlib.util.find_spec('piper') is not None}, model={model_path}")
+
+    @property
+    def available(self) -> bool:
+        return self._available
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=process_pool_context(),
+                initializer=_init_local_tts_worker,
+                initargs=(self.model_path,)
+            )
+            logger.info(f"Started local TTS pool: model={self.model_path}, workers={self.workers}")
+        return self._pool
+
+    def warm_up(self):
+        if self.available:
+            for _ in range(self.workers):
+                self.pool.submit(_synthesize_job, "Ready.")
+
+    async def _synthesize(self, text, voice_id):
+        if not self.available:
+            raise RuntimeError("Local text-to-speech backend is not available")
+        # One Piper voice per worker; voice_id selects ElevenLabs voices only
+        return await asyncio.get_running_loop().run_in_executor(self.pool, _synthesize_job, text)
+
+    async def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "available": self.available, "workers": self.workers}
+
+class PhraseCache:
+    """Audio for stock replies, keyed by voice and normalized text, partitioned by tenant.
+
+    Clips are written under a stable name, so a restarted worker finds
+    phrases rendered by its predecessor on disk instead of paying for them
+    again.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, voice_id: str) -> str:
+        normalized = " ".join(re.findall(r"[\w']+", (text or "").lower()))
+        return hashlib.sha1(f"{voice_id}|{normalized}".encode("utf-8")).hexdigest()[:20]
+
+    def get(self, text: str, voice_id: str, tenant: str = "") -> Optional[Dict[str, Any]]:
+        audio = self._entries.get(tenant, {}).get(self.key(text, voice_id))
+        if audio is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return audio
+
+    def put(self, text: str, voice_id: str, audio: Dict[str, Any], tenant: str = ""):
+        self._entries.setdefault(tenant, {})[self.key(text, voice_id)] = audio
+
+    def drop_tenant(self, tenant: str) -> int:
+        return len(self._entries.pop(tenant, {}))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": sum(len(entries) for entries in self._entries.values()),
+            "tenants": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+class TTSRouter:
+    """Synthesizes a reply sentence by sentence on the primary backend, or the fallback when it's degraded."""
+
+    def __init__(
+        self,
+        primary: TTSBackend,
+        fallback: Optional[TTSBackend] = None,
+        latency_budget: float = 4.0,
+        breaker: Optional[CircuitBreaker] = None,
+        parallelism: int = 3,
+        min_sentence_chars: int = 40,
+        cooldown: float = 60.0
+    ):
+        self.primary = primary
+        self.fallback = fallback if fallback is not None and fallback.available else None
+        self.latency_budget = latency_budget
+        self.breaker = breaker or CircuitBreaker()
+        self.cooldown = cooldown
+        self.bypass_until = 0.0
+        self.parallelism = max(1, parallelism)
+        self.min_sentence_chars = min_sentence_chars
+        self.replies = 0
+        self.sentences = 0
+        self.fallbacks = 0
+        self.routed_by_reason: Dict[str, int] = {}
+        self.phrases = PhraseCache()
+
+    @property
+    def name(self) -> str:
+        return f"{self.primary.name}+{self.fallback.name}" if self.fallback else self.primary.name
+
+    def _route(self) -> Tuple[TTSBackend, Optional[str]]:
+        if self.fallback is None:
+            return self.primary, None
+        if time.monotonic() < self.bypass_until:
+            return self.fallback, "p95_over_budget"
+        p95 = self.primary.latency.percentile(95)
+        # Timed-out calls are recorded as exactly the budget, so reaching it is the breach
+        if p95 is not None and len(self.primary.latency.samples) >= 10 and p95 >= self.latency_budget:
+            logger.warning(f"TTS {self.primary.name} p95 {p95:.1f}s at budget; using {self.fallback.name} for {self.cooldown}s")
+            self.bypass_until = time.monotonic() + self.cooldown
+            # Start fresh once the cooldown ends: the next calls probe the primary again
+            self.primary.latency.samples.clear()
+            return self.fallback, "p95_over_budget"
+        if not self.breaker.allow():
+            return self.fallback, "circuit_open"
+        return self.primary, None
+
+    async def _synthesize_all(self, backend: TTSBackend, sentences: List[str], voice_id: str, timeout: Optional[float],
+                              deliver: Optional[Callable[[int, bytes, TTSBackend], Awaitable[None]]] = None,
+                              priority: int = 1) -> List[bytes]:
+        semaphore = asyncio.Semaphore(self.parallelism)
+
+        async def call(sentence: str) -> bytes:
+            if timeout is None:
+                return await backend.synthesize(sentence, voice_id)
+            return await asyncio.wait_for(backend.synthesize(sentence, voice_id), timeout=timeout)
+
+        async def one(sentence: str) -> bytes:
+            async with semaphore:
+                if backend is not self.primary:
+                    return await call(sentence)
+                # Every upstream call holds its own admission slot, so the "tts" limit counts real in-flight calls
+                async with admission.limit("tts", priority):
+                    return await call(sentence)
+
+        tasks = [asyncio.ensure_future(one(s)) for s in sentences]
+        try:
+            clips = []
+            # In order, so a clip is handed over as soon as it and every earlier one are ready
+            for index, task in enumerate(tasks):
+                clips.append(await task)
+                if deliver is not None:
+                    await deliver(index, clips[-1], backend)
+            return clips
+        finally:
+            # One sentence failed: don't leave the others running (and billing) for a reply that is redone
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def synthesize_reply(self, text: str, voice_id: str,
+                               on_clip: Optional[Callable[[int, int, bytes, TTSBackend], Awaitable[None]]] = None,
+                               priority: int = 1) -> Tuple[TTSBackend, List[str], List[bytes]]:
+        """Returns (backend used, sentences, one audio clip per sentence).
+
+        `on_clip(index, count, clip, backend)` is awaited for each sentence in
+        order as soon as it can be played; each index is delivered once.
+        Calls to the primary take "tts" admission slots at `priority` and
+        raise Overloaded when shed."""
+        sentences = split_sentences(text, self.min_sentence_chars)
+        if not sentences:
+            raise ValueError("Nothing to synthesize")
+        self.replies += 1
+        self.sentences += len(sentences)
+        delivered = 0
+
+        async def deliver(index: int, clip: bytes, backend: TTSBackend):
+            nonlocal delivered
+            if on_clip is None or index < delivered:
+                return
+            delivered = index + 1
+            try:
+                await on_clip(index, len(sentences), clip, backend)
+            except Exception as e:
+                # The listener's problem, not the backend's: don't count it against the breaker
+                logger.warning(f"Delivering TTS clip {index} failed: {str(e)}")
+
+        backend, reason = self._route()
+        if backend is self.primary:
+            try:
+                timeout = self.latency_budget if self.fallback else None
+                clips = await self._synthesize_all(self.primary, sentences, voice_id, timeout, deliver, priority)
+                self.breaker.record_success()
+                return self.primary, sentences, clips
+            except Overloaded:
+                # Shed by our own limiter: says nothing about the primary's health
+                raise
+            except asyncio.TimeoutError:
+                # Count the miss so a run of slow calls trips the p95 check
+                self.primary.latency.add(self.latency_budget)
+                self.breaker.record_failure()
+                if self.fallback is None:
+                    raise
+                reason = "timeout"
+            except Exception as e:
+                self.breaker.record_failure()
+                if self.fallback is None:
+                    raise
+                reason = "error"
+                logger.warning(f"TTS {self.primary.name} failed ({str(e)})")
+            logger.warning(f"TTS falling back to {self.fallback.name} ({reason})")
+
+        self.fallbacks += 1
+        self.routed_by_reason[reason] = self.routed_by_reason.get(reason, 0) + 1
+        clips = await self._synthesize_all(self.fallback, sentences, voice_id, None, deliver)
+        return self.fallback, sentences, clips
+
+    def warm_up(self):
+        self.primary.warm_up()
+        if self.fallback:
+            self.fallback.warm_up()
+
+    async def shutdown(self):
+        await self.primary.shutdown()
+        if self.fallback:
+            await self.fallback.shutdown()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "replies": self.replies,
+            "avg_sentences": round(self.sentences / self.replies, 2) if self.replies else None,
+            "fallbacks": self.fallbacks,
+            "fallback_reasons": dict(self.routed_by_reason),
+            "bypassing_primary": time.monotonic() < self.bypass_until,
+            "circuit": self.breaker.stats(),
+            "phrases": self.phrases.stats(),
+            "primary": self.primary.stats(),
+            "fallback": self.fallback.stats() if self.fallback else None,
+        }
+
+def configure_tts_router(tts_client, name: Optional[str] = None) -> TTSRouter:
+    """Build the deployment's TTS router around an ElevenLabs client."""
+    name = (name or os.getenv("TTS_BACKEND", "elevenlabs")).lower()
+    elevenlabs = ElevenLabsBackend(tts_client, model=os.getenv("TTS_ELEVENLABS_MODEL", "eleven_monolingual_v1"))
+    if name in ("local", "auto"):
+        local = LocalTTSBackend(os.getenv("TTS_LOCAL_MODEL"), workers=int(os.getenv("TTS_LOCAL_WORKERS", "1")))
+    router_options = dict(
+        parallelism=int(os.getenv("TTS_SENTENCE_PARALLELISM", "3")),
+        min_sentence_chars=int(os.getenv("TTS_MIN_SENTENCE_CHARS", "40"))
+    )
+    if name == "elevenlabs":
+        router = TTSRouter(elevenlabs, **router_options)
+    elif name == "local":
+        router = TTSRouter(local, **router_options)
+    elif name == "auto":
+        router = TTSRouter(
+            elevenlabs,
+            local,
+            latency_budget=float(os.getenv("TTS_LATENCY_BUDGET", "4")),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv("TTS_BREAKER_FAILURES", "3")),
+                reset_timeout=float(os.getenv("TTS_BREAKER_RESET", "30"))
+            ),
+            cooldown=float(os.getenv("TTS_COOLDOWN", "60")),
+            **router_options
+        )
+    else:
+        raise ValueError(f"Unknown TTS backend '{name}'. Available: elevenlabs, local, auto")
+    logger.info(f"Using text-to-speech backend: {router.name}")
+    return router
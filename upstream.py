@@ -0,0 +1,108 @@
+"""Upstream API providers for chat, transcription and text-to-speech.
+
+`main.py` talks to OpenAI and ElevenLabs through the clients built here, so
+the same code can run against the real services or against the bundled
+mock server (`mock_upstream.py`) for offline profiling and load tests.
+
+Select a provider with the UPSTREAM_PROVIDER environment variable:
+    openai  - real OpenAI and ElevenLabs APIs (default)
+    mock    - local mock server at MOCK_UPSTREAM_URL (default http://127.0.0.1:9100)
+"""
+import os
+import logging
+from typing import Dict, Type
+
+import httpx
+from openai import AsyncOpenAI
+from elevenlabs.client import ElevenLabs
+
+logger = logging.getLogger(__name__)
+
+class UpstreamProvider:
+    """Builds the API clients used by the app. Subclass and register to add a provider."""
+
+    name = "base"
+    requires_api_keys = True
+
+    def __init__(self):
+        self.openai_api_key = os.getenv("OPENAI_API_KEY")
+        self.elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY")
+        self.chat_timeout = float(os.getenv("CHAT_TIMEOUT", "30"))
+        self.whisper_timeout = float(os.getenv("WHISPER_TIMEOUT", "60"))
+        self.tts_timeout = float(os.getenv("TTS_TIMEOUT", "60"))
+
+    @property
+    def openai_base_url(self):
+        return None
+
+    @property
+    def elevenlabs_base_url(self):
+        return None
+
+    def create_chat_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            api_key=self.openai_api_key,
+            base_url=self.openai_base_url,
+            http_client=httpx.AsyncClient(timeout=self.chat_timeout, verify=True)
+        )
+
+    def create_whisper_client(self) -> AsyncOpenAI:
+        # Transcription uploads need a longer timeout than chat completions
+        return AsyncOpenAI(
+            api_key=self.openai_api_key,
+            base_url=self.openai_base_url,
+            http_client=httpx.AsyncClient(timeout=self.whisper_timeout, verify=True)
+        )
+
+    def create_tts_client(self) -> ElevenLabs:
+        return ElevenLabs(
+            api_key=self.elevenlabs_api_key,
+            base_url=self.elevenlabs_base_url,
+            timeout=self.tts_timeout
+        )
+
+class OpenAIUpstream(UpstreamProvider):
+    """The real OpenAI and ElevenLabs APIs."""
+
+    name = "openai"
+
+class MockUpstream(UpstreamProvider):
+    """The local mock server from mock_upstream.py."""
+
+    name = "mock"
+    requires_api_keys = False
+
+    def __init__(self):
+        super().__init__()
+        self.base_url = os.getenv("MOCK_UPSTREAM_URL", "http://127.0.0.1:9100").rstrip("/")
+        # The SDKs refuse to build clients without a key; the mock ignores it
+        self.openai_api_key = self.openai_api_key or "sk-mock"
+        self.elevenlabs_api_key = self.elevenlabs_api_key or "mock"
+
+    @property
+    def openai_base_url(self):
+        return f"{self.base_url}/v1"
+
+    @property
+    def elevenlabs_base_url(self):
+        return self.base_url
+
+PROVIDERS: Dict[str, Type[UpstreamProvider]] = {
+    OpenAIUpstream.name: OpenAIUpstream,
+    MockUpstream.name: MockUpstream,
+}
+
+def register_provider(provider_class: Type[UpstreamProvider]):
+    PROVIDERS[provider_class.name] = provider_class
+    return provider_class
+
+def get_upstream_provider(name: str = None) -> UpstreamProvider:
+    name = (name or os.getenv("UPSTREAM_PROVIDER", "openai")).lower()
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown upstream provider '{name}'. Available: {', '.join(sorted(PROVIDERS))}")
+    provider = PROVIDERS[name]()
+    if provider.requires_api_keys and not provider.openai_api_key:
+        logger.error("OPENAI_API_KEY not found in environment variables")
+        raise ValueError("OPENAI_API_KEY environment variable is required")
+    logger.info(f"Using upstream provider: {provider.name}")
+    return provider
@@ -0,0 +1,165 @@
+"""Startup warm-up and readiness.
+
+The first requests after a deploy or worker recycle paid for TLS
+handshakes, model and pool start-up, and uncached audio. `WarmUp` runs
+named steps concurrently at startup (each with its own timeout) and marks
+the worker ready when they finish; `/ready` reports 503 until then, so a
+load balancer only routes to warm workers. A failing step is logged and
+reported, it doesn't keep the worker out of rotation.
+
+`FirstRequestMiddleware` records the latency of the first requests per
+path and compares them with the steady-state median, so the effect of
+warm-up shows up in /debug/metrics (compare deploys with WARMUP_ENABLED
+on and off).
+
+Environment:
+    WARMUP_ENABLED          run the warm-up steps (default true)
+    WARMUP_BLOCKING         hold startup until warm-up is done (default false)
+    WARMUP_STEP_TIMEOUT     seconds per step (default 30)
+    WARMUP_FIRST_REQUESTS   requests per path counted as "first" (default 3)
+    WARMUP_PHRASES_FILE     JSON list of frequent replies to pre-render as audio
+    TTS_FAILURE_PHRASE      spoken when a reply's own audio can't be generated
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from latency import LatencyWindow
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PHRASES = [
+    "Hi! How can I help you today?",
+    "Sorry, I didn't catch that. Could you say it again?",
+    "Give me a moment to think about that.",
+]
+
+def tts_failure_phrase() -> str:
+    return os.getenv("TTS_FAILURE_PHRASE", "Sorry, I can't speak right now. My reply is on your screen.")
+
+def load_phrases() -> List[str]:
+    """Frequent replies to pre-render, plus the TTS failure phrase."""
+    phrases = list(DEFAULT_PHRASES)
+    path = os.getenv("WARMUP_PHRASES_FILE")
+    if path:
+        try:
+            with open(path, "r") as f:
+                phrases = [p for p in json.load(f) if isinstance(p, str) and p.strip()]
+        except Exception as e:
+            logger.error(f"Error loading warm-up phrases {path}: {str(e)}")
+    phrases.append(tts_failure_phrase())
+    return list(dict.fromkeys(phrases))
+
+class WarmUp:
+    def __init__(self, enabled: bool = True, step_timeout: float = 30.0):
+        self.enabled = enabled
+        self.step_timeout = step_timeout
+        self._steps: List[Tuple[str, Callable[[], Awaitable[Any]]]] = []
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.started_at: Optional[float] = None
+        self.duration_ms: Optional[float] = None
+        self.ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def add_step(self, name: str, step: Callable[[], Awaitable[Any]]):
+        self._steps.append((name, step))
+
+    async def _run_step(self, name: str, step: Callable[[], Awaitable[Any]]):
+        started = time.perf_counter()
+        try:
+            detail = await asyncio.wait_for(step(), timeout=self.step_timeout)
+            self.results[name] = {"ok": True, "ms": round((time.perf_counter() - started) * 1000, 1)}
+            if detail is not None:
+                self.results[name]["detail"] = detail
+        except Exception as e:
+            message = "timed out" if isinstance(e, asyncio.TimeoutError) else str(e)
+            self.results[name] = {"ok": False, "ms": round((time.perf_counter() - started) * 1000, 1), "error": message}
+            logger.warning(f"Warm-up step {name} failed: {message}")
+
+    async def run(self):
+        self.started_at = time.time()
+        started = time.perf_counter()
+        try:
+            if self.enabled:
+                await asyncio.gather(*(self._run_step(name, step) for name, step in self._steps))
+        finally:
+            self.duration_ms = round((time.perf_counter() - started) * 1000, 1)
+            self.ready.set()
+            failed = [name for name, result in self.results.items() if not result["ok"]]
+            logger.info(f"Warm-up finished in {self.duration_ms}ms" + (f" (failed: {', '.join(failed)})" if failed else ""))
+
+    def start(self, blocking: bool = False) -> Optional[Awaitable[None]]:
+        """Schedule the warm-up; returns an awaitable when the caller should wait for it."""
+        self._task = asyncio.create_task(self.run(), name="warm-up")
+        return self._task if blocking else None
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+
+    @property
+    def is_ready(self) -> bool:
+        return self.ready.is_set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "ready": self.is_ready,
+            "duration_ms": self.duration_ms,
+            "steps": self.results,
+        }
+
+class FirstRequestMiddleware:
+    """Pure ASGI middleware recording first-request vs steady-state latency per path."""
+
+    def __init__(self, app, paths=("/chat", "/transcribe"), first_requests: Optional[int] = None):
+        self.app = app
+        self.paths = paths
+        self.first_requests = first_requests or int(os.getenv("WARMUP_FIRST_REQUESTS", "3"))
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path not in self.paths:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_latency.record(path, time.perf_counter() - started, self.first_requests)
+
+class RequestLatency:
+    def __init__(self):
+        self.first: Dict[str, List[float]] = {}
+        self.steady: Dict[str, LatencyWindow] = {}
+
+    def record(self, path: str, seconds: float, first_requests: int):
+        first = self.first.setdefault(path, [])
+        if len(first) < first_requests:
+            first.append(round(seconds * 1000, 1))
+        else:
+            self.steady.setdefault(path, LatencyWindow()).add(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        report = {}
+        for path, first in self.first.items():
+            steady = self.steady.get(path)
+            p50 = steady.percentile(50) if steady else None
+            report[path] = {
+                "first_ms": first,
+                "steady_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "first_vs_steady": round(first[0] / (p50 * 1000), 2) if p50 else None,
+            }
+        return report
+
+request_latency = RequestLatency()
+
+warm_up = WarmUp(
+    enabled=os.getenv("WARMUP_ENABLED", "true").lower() == "true",
+    step_timeout=float(os.getenv("WARMUP_STEP_TIMEOUT", "30"))
+)
+
+def warm_up_blocking() -> bool:
+    return os.getenv("WARMUP_BLOCKING", "false").lower() == "true"
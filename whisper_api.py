@@ -1,22 +1,17 @@
 from fastapi import UploadFile, APIRouter
-import tempfile
-import openai
-import os
+from stt import get_stt_backend
 
 router = APIRouter()
 
 @router.post("/transcribe")
 async def transcribe(file: UploadFile):
     try:
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            contents = await file.read()
-            tmp.write(contents)
-            tmp_path = tmp.name
-
-        with open(tmp_path, "rb") as audio_file:
-            transcript = openai.Audio.transcribe("whisper-1", audio_file)
-
-        os.remove(tmp_path)
-        return {"text": transcript["text"]}
+        contents = await file.read()
+        result = await get_stt_backend().transcribe(
+            contents,
+            file.filename or "audio.mp4",
+            file.content_type or "audio/mp4"
+        )
+        return {"text": result["text"]}
     except Exception as e:
         return {"error": str(e)}